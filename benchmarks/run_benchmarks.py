@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+"""run_benchmarks
+
+Measures the wall time, number of API calls and peak memory of the executor for uploads, polling of an invocation,
+downloads and library exports at different scales, against the in-process fake Galaxy of wfexecutor.fakegalaxy,
+so that performance work can be checked offline.
+
+running syntax
+
+python benchmarks/run_benchmarks.py --scales 10,100,1000 --dataset-size 100000 --latency 0.005 -o results.json
+
+The scale is the number of files uploaded, or of datasets produced by the invocation, downloaded or exported.
+Peak memory is measured with tracemalloc on a separate run of each scenario, as tracing slows Python down, and
+includes the allocations of the fake server, which runs in the same process. The script can be run from a
+checkout, without installing the package.
+"""
+
+import argparse
+import json
+import logging
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+# run from a checkout, the package is in the parent directory of the benchmarks
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from wfexecutor import (  # noqa: E402
+    InvocationProgress,
+    PollingPolicy,
+    completion_state,
+    download_results,
+    export_results_to_data_library,
+    get_galaxy_instance,
+    load_input_files,
+)
+from wfexecutor.fakegalaxy import FakeGalaxyServer  # noqa: E402
+
+SCENARIOS = ('upload', 'polling', 'download', 'library_export')
+
+bench_workflow = {'name': 'benchmark', 'steps': {
+    '0': {'label': 'input', 'type': 'data_input', 'tool_id': None},
+    '1': {'label': 'process', 'type': 'tool', 'tool_id': 'benchmark_tool', 'tool_version': '1.0'},
+}}
+
+
+def get_args():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--scales',
+                            default='10,100,1000',
+                            help='Comma separated scales to run each scenario at.')
+    arg_parser.add_argument('--scenarios',
+                            default=','.join(SCENARIOS),
+                            help='Comma separated scenarios to run, among {}.'.format(', '.join(SCENARIOS)))
+    arg_parser.add_argument('--dataset-size', type=int,
+                            default=10000,
+                            help='Size in bytes of each file uploaded or dataset produced.')
+    arg_parser.add_argument('--latency', type=float,
+                            default=0.0,
+                            help='Seconds the fake server waits before answering each request.')
+    arg_parser.add_argument('--job-seconds', type=float,
+                            default=1.0,
+                            help='Seconds each job of the invocation runs, for the polling scenario.')
+    arg_parser.add_argument('--poll-interval', type=float,
+                            default=0.2,
+                            help='Shortest wait in seconds between polls, for the polling scenario.')
+    arg_parser.add_argument('--workers', type=int,
+                            default=4,
+                            help='Number of concurrent uploads, downloads and library imports.')
+    arg_parser.add_argument('--repeat', type=int,
+                            default=1,
+                            help='Times each scenario is timed, the median is reported.')
+    arg_parser.add_argument('--no-memory',
+                            action='store_true',
+                            default=False,
+                            help='Skip the run that measures peak memory.')
+    arg_parser.add_argument('-o', '--output',
+                            default=None,
+                            help='JSON file where the results are written.')
+    arg_parser.add_argument('--debug',
+                            action='store_true',
+                            default=False,
+                            help='Print debug information')
+    return arg_parser.parse_args()
+
+
+def setup_upload(server, gi, scale, work_dir, args):
+    inputs = {}
+    workflow = {'inputs': {}}
+    for number in range(scale):
+        path = os.path.join(work_dir, 'input_{}.txt'.format(number))
+        with open(path, mode='wb') as f:
+            f.write(b'A' * args.dataset_size)
+        inputs['input_{}'.format(number)] = {'path': path, 'type': 'txt'}
+        workflow['inputs'][str(number)] = {'label': 'input_{}'.format(number)}
+    history = gi.histories.create_history(name='benchmark_inputs')
+    return lambda: load_input_files(gi, inputs=inputs, workflow=workflow, history=history, workers=args.workers)
+
+
+def setup_polling(server, gi, scale, work_dir, args):
+    server.datasets = scale
+    server.job_seconds = args.job_seconds
+    workflow = gi.workflows.import_workflow_dict(bench_workflow)
+
+    def poll():
+        invocation = gi.workflows.invoke_workflow(workflow_id=workflow['id'], history_name='benchmark_results')
+        polling = PollingPolicy(first_check=0, min_interval=args.poll_interval, max_interval=args.poll_interval * 4,
+                                jitter=0)
+        while gi.workflows.show_invocation(workflow['id'], invocation['id'])['state'] != 'scheduled':
+            polling.wait()
+        polling.reset()
+        progress = InvocationProgress(gi, invocation_id=invocation['id'], history_id=invocation['history_id'])
+        allowed_error_states = {'tools': {}, 'datasets': set()}
+        checked_errors = set()
+        while True:
+            history = progress.poll()
+            error_state, completed = completion_state(gi, history, allowed_error_states,
+                                                      checked_errors=checked_errors)
+            if error_state or completed:
+                return
+            polling.observe(progress.observed())
+            polling.wait()
+    return poll
+
+
+def setup_download(server, gi, scale, work_dir, args):
+    history_id = server.add_history('benchmark_results', datasets=scale, size=args.dataset_size)
+    output_dir = os.path.join(work_dir, 'results')
+    os.makedirs(output_dir)
+    return lambda: download_results(gi, history_id, output_dir, {'tools': {}, 'datasets': set()}, use_names=True,
+                                    workers=args.workers)
+
+
+def setup_library_export(server, gi, scale, work_dir, args):
+    history_id = server.add_history('benchmark_results', datasets=scale, size=args.dataset_size)
+    library = gi.libraries.create_library(name='benchmark')
+    return lambda: export_results_to_data_library(gi, history_id, library['id'], {'tools': {}, 'datasets': set()},
+                                                  workers=args.workers)
+
+
+SETUPS = {'upload': setup_upload, 'polling': setup_polling, 'download': setup_download,
+          'library_export': setup_library_export}
+
+
+def run_scenario(scenario, scale, args, trace_memory=False):
+    """
+    Runs a scenario once on a new fake server, measuring only the operation, not its preparation.
+
+    :return: dictionary with seconds, api_calls and, if traced, peak_memory in bytes.
+    """
+    work_dir = tempfile.mkdtemp(prefix='wfexecutor_benchmark_')
+    try:
+        with FakeGalaxyServer(latency=args.latency, dataset_size=args.dataset_size) as server:
+            gi = get_galaxy_instance({'url': server.url, 'key': 'benchmark'}, workers=args.workers)
+            operation = SETUPS[scenario](server, gi, scale, work_dir, args)
+            server.reset_counts()
+            if trace_memory:
+                tracemalloc.start()
+            start = time.perf_counter()
+            operation()
+            seconds = time.perf_counter() - start
+            result = {'seconds': seconds, 'api_calls': server.request_count, 'requests': dict(server.requests),
+                      'bytes_sent': server.bytes_sent, 'bytes_received': server.bytes_received}
+            if trace_memory:
+                result['peak_memory'] = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+            return result
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def main():
+    args = get_args()
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.WARNING,
+                        format='%(asctime)s - %(message)s',
+                        datefmt='%d-%m-%y %H:%M:%S')
+    scenarios = args.scenarios.split(',')
+    for scenario in scenarios:
+        if scenario not in SETUPS:
+            raise ValueError("Unknown scenario {}, choose among {}".format(scenario, ', '.join(SCENARIOS)))
+    results = []
+    print("\t".join(["Scenario", "Scale", "Seconds", "API calls", "Peak MiB"]))
+    for scenario in scenarios:
+        for scale in [int(scale) for scale in args.scales.split(',')]:
+            runs = [run_scenario(scenario, scale, args) for _ in range(args.repeat)]
+            result = dict(runs[0], scenario=scenario, scale=scale,
+                          seconds=statistics.median(run['seconds'] for run in runs))
+            if not args.no_memory:
+                result['peak_memory'] = run_scenario(scenario, scale, args, trace_memory=True)['peak_memory']
+            results.append(result)
+            print("\t".join([scenario, str(scale), "{:.3f}".format(result['seconds']), str(result['api_calls']),
+                             "{:.1f}".format(result['peak_memory'] / 2 ** 20) if 'peak_memory' in result else '-']))
+    if args.output:
+        with open(args.output, mode='w') as f:
+            json.dump({'parameters': vars(args), 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
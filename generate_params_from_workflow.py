@@ -21,7 +21,6 @@ Output parameter file will be appended with workflow_filename as workflow_filena
 
 import argparse
 import os.path
-from bioblend.galaxy import GalaxyInstance
 
 from wfexecutor import *
 
@@ -68,7 +67,7 @@ def main():
         # Prepare environment
         logging.info('Prepare galaxy environment ...')
         ins = get_instance(args.conf, name=args.galaxy_instance)
-        gi = GalaxyInstance(ins['url'], key=ins['key'])
+        gi = get_galaxy_instance(ins)
 
         # get saved workflow defined in the galaxy instance
         logging.info('Workflow setup ...')
@@ -18,27 +18,26 @@ File inputs.yaml must contain paths to all input labels in the workflow.
 import argparse
 import logging
 import os
-import time
 from collections.abc import Mapping
 from sys import exit
 
-from bioblend import ConnectionError
-from bioblend.galaxy import GalaxyInstance
-
 from wfexecutor import (
-    ExecutionState,
+    RETRIEVAL_MODES,
+    Metrics,
     completion_state,
     download_results,
-    export_results_to_data_library,
+    get_galaxy_instance,
     get_instance,
     get_workflow_from_file,
     get_workflow_id,
+    has_path_inputs,
     load_input_files,
     process_allowed_errors,
     produce_versions_file,
     read_json_file,
     read_yaml_file,
     set_params,
+    validate_allowed_errors,
     validate_dataset_id_exists,
     validate_file_exists,
     validate_input_labels,
@@ -52,8 +51,9 @@ from wfexecutor import (
 def get_args():
     arg_parser = argparse.ArgumentParser()
     arg_parser.add_argument('-C', '--conf',
-                            required=True,
-                            help='A yaml file describing the galaxy credentials')
+                            required=False,
+                            help='A yaml file describing the galaxy credentials, required unless '
+                                 '--replay-traffic is given')
     arg_parser.add_argument('-G', '--galaxy-instance',
                             default='embassy',
                             help='Galaxy server instance name')
@@ -82,6 +82,28 @@ def get_args():
                             action='store_true',
                             default=False,
                             help='Print debug information')
+    arg_parser.add_argument('--validate-only',
+                            action='store_true',
+                            default=False,
+                            help='Only run the checks that need no Galaxy instance: workflow and parameter labels, '
+                                 'input labels, existence of input files and allowed errors, then exit.')
+    arg_parser.add_argument('--metrics-file',
+                            default=None,
+                            help='JSON file where the metrics of the run are written: time per phase, API calls and '
+                                 'bytes transferred. Not written unless given.')
+    arg_parser.add_argument('--prometheus-textfile',
+                            action='store_true',
+                            default=False,
+                            help='Besides the JSON report of run metrics, write them in the Prometheus text format '
+                                 'to a file next to it, with the .prom extension. Needs --metrics-file.')
+    arg_parser.add_argument('--record-traffic',
+                            default=None,
+                            help='JSON lines file where every request to the Galaxy instance is recorded, with its '
+                                 'response, size and timing, to replay the run later with --replay-traffic.')
+    arg_parser.add_argument('--replay-traffic',
+                            default=None,
+                            help='Run against the responses recorded with --record-traffic instead of a Galaxy '
+                                 'instance, for instance to check the number of API calls offline.')
     arg_parser.add_argument('-a', '--allowed-errors',
                             required=False,
                             default=None,
@@ -99,6 +121,33 @@ def get_args():
                             action='store_true',
                             default=False,
                             help="Keeps workflow created, it will be purged if not.")
+    arg_parser.add_argument('--reuse-workflow',
+                            action='store_true',
+                            default=False,
+                            help="Reuse a workflow already imported with identical content instead of importing "
+                                 "it again. The workflow is kept at the end of the run.")
+    arg_parser.add_argument('--workflow-index',
+                            default='~/.wfexecutor/workflows.json',
+                            help="Local file mapping workflow content hashes to imported workflow ids, "
+                                 "used with --reuse-workflow.")
+    arg_parser.add_argument('--upload-workers', type=int,
+                            default=4,
+                            help="Number of input files to upload concurrently.")
+    arg_parser.add_argument('--upload-cache',
+                            default=None,
+                            help="Local index file used to reuse input files already uploaded to the instance, "
+                                 "recognised by the checksum of their content. Disabled if not given.")
+    arg_parser.add_argument('--upload-cache-history',
+                            default='wfexecutor_upload_cache',
+                            help="Name of the history where cached input files are uploaded, used with "
+                                 "--upload-cache. This history is never deleted by the executor.")
+    arg_parser.add_argument('--tool-cache',
+                            default=None,
+                            help="Local file where tool metadata for the software versions file is cached "
+                                 "across runs. Disabled if not given.")
+    arg_parser.add_argument('--tool-cache-ttl', type=float,
+                            default=7 * 24 * 3600,
+                            help="Seconds after which cached tool metadata is retrieved again, a week by default.")
     arg_parser.add_argument('-l', '--library-name',
                             required=False,
                             default=None,
@@ -110,6 +159,51 @@ def get_args():
                             help="Do not download the results. Make sure to specify a "
                                  "library name or to keep the created histories."
                             )
+    arg_parser.add_argument('--retrieval-mode',
+                            choices=RETRIEVAL_MODES,
+                            default='http',
+                            help="How results are retrieved: downloaded over 'http', or when the Galaxy object "
+                                 "store is mounted locally, hard linked (or copied across file systems) with "
+                                 "'link' or copied with 'copy'. Files not visible locally are downloaded.")
+    arg_parser.add_argument('--collection-archives', action='store_true',
+                            default=False,
+                            help="Download the elements of each collection with a single request for an archive "
+                                 "of the collection, instead of one request per element.")
+    arg_parser.add_argument('--download-workers', type=int,
+                            default=4,
+                            help="Number of result files to download concurrently.")
+    arg_parser.add_argument('--incremental-downloads', action='store_true',
+                            default=False,
+                            help="Download results as they become ready while the workflow "
+                                 "is still running, instead of only at the end.")
+    arg_parser.add_argument('--api-rate', type=float,
+                            default=10,
+                            help="Maximum metadata requests per second to the Galaxy instance, 0 for no limit.")
+    arg_parser.add_argument('--upload-rate', type=float,
+                            default=2,
+                            help="Maximum upload requests per second to the Galaxy instance, 0 for no limit.")
+    arg_parser.add_argument('--download-rate', type=float,
+                            default=5,
+                            help="Maximum download requests per second to the Galaxy instance, 0 for no limit.")
+    arg_parser.add_argument('--max-in-flight', type=int,
+                            default=8,
+                            help="Maximum number of requests waiting for a response from the Galaxy instance "
+                                 "at the same time.")
+    arg_parser.add_argument('--poll-first-check', type=float,
+                            default=5,
+                            help="Seconds to wait before the first check of the invocation state.")
+    arg_parser.add_argument('--poll-min-interval', type=float,
+                            default=10,
+                            help="Shortest wait in seconds between polls, used again whenever states change.")
+    arg_parser.add_argument('--poll-max-interval', type=float,
+                            default=120,
+                            help="Longest wait in seconds between polls.")
+    arg_parser.add_argument('--poll-backoff', type=float,
+                            default=1.5,
+                            help="Factor by which the wait between polls grows while states don't change.")
+    arg_parser.add_argument('--poll-jitter', type=float,
+                            default=0.1,
+                            help="Random variation applied to each wait, as a fraction of it.")
     arg_parser.add_argument('--publish', action='store_true',
                             default=False, 
                             help="Keep result history and make it public/accesible.")
@@ -118,6 +212,8 @@ def get_args():
                             help="Keep result history and make it accessible "
                             "via link only.")
     args = arg_parser.parse_args()
+    if args.prometheus_textfile and args.metrics_file is None:
+        arg_parser.error("--prometheus-textfile needs --metrics-file")
     return args
 
 
@@ -129,9 +225,13 @@ def set_logging_level(debug=False):
 
 
 def main():
+    metrics = Metrics()
+    recorder = None
+    run_started = False
     try:
         args = get_args()
         set_logging_level(args.debug)
+        metrics.start_phase('validation')
 
         # Load workflows, inputs and parameters
         wf_from_json = read_json_file(args.workflow)
@@ -146,9 +246,9 @@ def main():
         inputs_data = read_yaml_file(args.yaml_inputs_path)
         allowed_error_states = {'tools': {}, 'datasets': set()}
         if args.allowed_errors is not None:
-            allowed_error_states = \
-                process_allowed_errors(read_yaml_file(args.allowed_errors),
-                                       wf_from_json)
+            allowed_errors = read_yaml_file(args.allowed_errors)
+            validate_allowed_errors(allowed_errors, wf_from_json)
+            allowed_error_states = process_allowed_errors(allowed_errors, wf_from_json)
 
         # Move any simple parameters from parameters to inputs
         params_to_move = []
@@ -167,11 +267,46 @@ def main():
         num_inputs = validate_input_labels(wf_json=wf_from_json, inputs=inputs_data)
         if num_inputs > 0:
             validate_file_exists(inputs_data)
+        if args.validate_only:
+            logging.info("Validation of workflow {} with inputs {}: OK".format(args.workflow, args.yaml_inputs_path))
+            exit(0)
+
+        # Imported only once a connection is needed, as bioblend and its dependencies take longer to import than
+        # the whole validation.
+        from bioblend import ConnectionError
+        from wfexecutor import (
+            ExecutionState,
+            IncrementalDownloader,
+            InvocationProgress,
+            MetadataCache,
+            PollingPolicy,
+            RateLimiter,
+            ReplayGalaxyInstance,
+            ToolMetadataCache,
+            TrafficRecorder,
+            UploadCache,
+            export_results_to_data_library,
+            supports_resumable_uploads,
+        )
 
         # Prepare environment and do any post connection validations.
         logging.info('Prepare galaxy environment...')
-        ins = get_instance(args.conf, name=args.galaxy_instance)
-        gi = GalaxyInstance(ins['url'], key=ins['key'])
+        run_started = True
+        metrics.start_phase('connection')
+        if args.replay_traffic:
+            gi = ReplayGalaxyInstance.load(args.replay_traffic)
+        elif args.conf is None:
+            raise ValueError("Galaxy credentials are needed, pass them with -C/--conf")
+        else:
+            ins = get_instance(args.conf, name=args.galaxy_instance)
+            gi = get_galaxy_instance(ins, workers=max(args.upload_workers, args.download_workers))
+        if args.record_traffic:
+            recorder = TrafficRecorder()
+            recorder.install(gi)
+        metrics.install(gi)
+        rate_limiter = RateLimiter(metadata_rate=args.api_rate, upload_rate=args.upload_rate,
+                                   download_rate=args.download_rate, max_in_flight=args.max_in_flight)
+        rate_limiter.install(gi)
         validate_dataset_id_exists(gi, inputs_data)
 
         state = ExecutionState.start(path=args.state_file)
@@ -189,8 +324,10 @@ def main():
 
         # get saved workflow defined in the galaxy instance
         logging.info('Workflow setup ...')
+        metrics.start_phase('workflow_import')
         if state.wf_from_file is None:
-            workflow = get_workflow_from_file(gi, workflow_file=args.workflow)
+            workflow = get_workflow_from_file(gi, workflow_file=args.workflow,
+                                              reuse=args.reuse_workflow, index_path=args.workflow_index)
             state.wf_from_file = workflow
             state.save_state()
         else:
@@ -199,11 +336,19 @@ def main():
         show_wf = gi.workflows.show_workflow(workflow_id)
 
         # upload dataset to history
+        metrics.start_phase('upload')
         if state.datamap is None:
             logging.info('Uploading dataset to history ...')
             if num_inputs > 0:
+                upload_cache = None
+                if args.upload_cache:
+                    upload_cache = UploadCache(args.upload_cache, history_name=args.upload_cache_history)
                 datamap = load_input_files(gi, inputs=inputs_data,
-                                           workflow=show_wf, history=history)
+                                           workflow=show_wf, history=history,
+                                           upload_cache=upload_cache,
+                                           workers=args.upload_workers, state=state,
+                                           resumable=has_path_inputs(inputs_data) and
+                                           supports_resumable_uploads(gi))
             else:
                 datamap = {}
             state.datamap = datamap
@@ -216,6 +361,7 @@ def main():
             datamap = state.datamap
             params = state.params
 
+        metrics.start_phase('invocation')
         if state.results is None:
             try:
                 logging.info('Running workflow {}...'.format(show_wf['name']))
@@ -237,135 +383,207 @@ def main():
             results = state.results
 
         # Produce tool versions file
+        metrics.start_phase('versions_file')
+        tool_cache = None
+        if args.tool_cache:
+            tool_cache = ToolMetadataCache(args.tool_cache, ttl=args.tool_cache_ttl)
         produce_versions_file(gi=gi, workflow_from_json=wf_from_json,
                               table_path=(
                                   "{}/software_versions_galaxy.txt".format(args.output_dir)
-                              ))
+                              ),
+                              tool_cache=tool_cache)
         
-        # wait for a little while and check if the status is ok
-        logging.info("Waiting for results to be available...")
-        logging.info("...in the mean time, you can check {}/histories/view?id={} for progress."
-                     "You need to login with the user that owns the API Key.".
-                     format(gi.base_url, results['history_id']))
-        time.sleep(100)
-
-        # get_run_state
-        results_hid = gi.histories.show_history(results['history_id'])
-        state = results_hid['state']
-
-        # wait until workflow invocation is fully scheduled, cancelled of failed
-        while True:
-            invocation = gi.workflows.show_invocation(workflow_id=results['workflow_id'], invocation_id=results['id'])
-            # These are the terminal states of the invocation process. Scheduled means that all jobs needed for the
-            # workflow have been scheduled, not that the workflow is finished. However, there is no point in
-            # checking completion through history elements if this hasn't happened yet.
-            if invocation['state'] == 'cancelled':
-                logging.error("Invocation was cancelled... exiting.")
-                logging.info(f"Invocation id: {invocation['id']}")
-                exit(4)
-            if invocation['state'] == 'failed':
-                logging.error("Invocation failed... exiting.")
-                logging.info(f"Invocation id: {invocation['id']}")
-                exit(5)
-            if invocation['state'] == 'scheduled':
-                logging.info(f"Workflow invocation has entered a terminal state: {invocation['state']}")
-                logging.info("Proceeding to check individual jobs state to determine completion or failure...")
-                break
-            time.sleep(10)
-
-        # wait until the jobs are completed, once workflow scheduling is done.
-        logging.debug("Got state: {}".format(state))
-        while True:
-            logging.debug("Got state: {}".format(state))
-            error_state, finalized_state = completion_state(gi, results_hid, allowed_error_states)
-            # TODO could a resubmission be caught here in the 'error' state?
-            if error_state:
-                logging.error("Execution failed, see {}/histories/view?id={} for input details."
-                              "You might require login with a particular user.".
-                              format(gi.base_url, results_hid['id']))
-                exit(1)
-            elif finalized_state:
-                logging.info("Workflow finished successfully OK or with allowed errors.")
-                break
-            # TODO downloads could be triggered here to gain time.
-            time.sleep(10)
-            results_hid = gi.histories.show_history(results['history_id'])
-            state = results_hid['state']
-
-        download = not args.no_downloads
-
-        # Upload results to Library
-        if args.library_name:
-            logging.info('Uploading results to Library')
-            lib = gi.libraries.get_libraries(name=args.library_name)
-
-            if lib == []:
-                lib = gi.libraries.create_library(name=args.library_name, description="Generated from galaxy-workflow-executor")
-                lib_id = lib['id']
-            else:
-                lib_id = lib[0]['id']
+        if state.is_done('results_retrieved'):
+            logging.info("Results were already retrieved according to the state file, proceeding to clean up")
+        else:
+            polling = PollingPolicy(first_check=args.poll_first_check,
+                                    min_interval=args.poll_min_interval,
+                                    max_interval=args.poll_max_interval,
+                                    backoff=args.poll_backoff,
+                                    jitter=args.poll_jitter)
+
+            # wait for a little while and check if the status is ok
+            logging.info("Waiting for results to be available...")
+            logging.info("...in the mean time, you can check {}/histories/view?id={} for progress."
+                         "You need to login with the user that owns the API Key.".
+                         format(gi.base_url, results['history_id']))
+
+            # wait until workflow invocation is fully scheduled, cancelled of failed
+            metrics.start_phase('scheduling')
+            while True:
+                polling.wait()
+                invocation = gi.workflows.show_invocation(workflow_id=results['workflow_id'], invocation_id=results['id'])
+                polling.observe((invocation['state'], len(invocation.get('steps', []))))
+                # These are the terminal states of the invocation process. Scheduled means that all jobs needed for the
+                # workflow have been scheduled, not that the workflow is finished. However, there is no point in
+                # checking completion through history elements if this hasn't happened yet.
+                if invocation['state'] == 'cancelled':
+                    logging.error("Invocation was cancelled... exiting.")
+                    logging.info(f"Invocation id: {invocation['id']}")
+                    exit(4)
+                if invocation['state'] == 'failed':
+                    logging.error("Invocation failed... exiting.")
+                    logging.info(f"Invocation id: {invocation['id']}")
+                    exit(5)
+                if invocation['state'] == 'scheduled':
+                    logging.info(f"Workflow invocation has entered a terminal state: {invocation['state']}")
+                    logging.info("Proceeding to check individual jobs state to determine completion or failure...")
+                    break
+
+            # get_run_state
+            metrics.start_phase('execution')
+            progress = InvocationProgress(gi, invocation_id=results['id'], history_id=results['history_id'])
+            results_hid = progress.poll()
+            history_state = results_hid['state']
+            polling.reset()
+
+            download = not args.no_downloads
+
+            downloader = None
+            if args.incremental_downloads and download and not args.library_name:
+                downloader = IncrementalDownloader(gi, history_id=results['history_id'],
+                                                   output_dir=args.output_dir,
+                                                   allowed_error_states=allowed_error_states,
+                                                   use_names=True, workers=args.download_workers,
+                                                   state=state, retrieval_mode=args.retrieval_mode,
+                                                   collection_archives=args.collection_archives)
+
+            # wait until the jobs are completed, once workflow scheduling is done.
+            logging.debug("Got state: {}".format(history_state))
+            checked_errors = set()
+            metadata_cache = MetadataCache()
+            while True:
+                logging.debug("Got state: {}".format(history_state))
+                error_state, finalized_state = completion_state(gi, results_hid, allowed_error_states,
+                                                                checked_errors=checked_errors,
+                                                                cache=metadata_cache)
+                # TODO could a resubmission be caught here in the 'error' state?
+                if error_state:
+                    logging.error("Execution failed, see {}/histories/view?id={} for input details."
+                                  "You might require login with a particular user.".
+                                  format(gi.base_url, results_hid['id']))
+                    if downloader is not None:
+                        downloader.cancel()
+                    exit(1)
+                elif finalized_state:
+                    logging.info("Workflow finished successfully OK or with allowed errors.")
+                    break
+                if downloader is not None:
+                    downloader.poll(results_hid)
+                polling.wait()
+                results_hid = progress.poll()
+                polling.observe(progress.observed())
+                history_state = results_hid['state']
+            polling.log_summary()
+
+            # Upload results to Library
+            if args.library_name:
+                logging.info('Uploading results to Library')
+                metrics.start_phase('library_export')
+                lib = gi.libraries.get_libraries(name=args.library_name)
+
+                if lib == []:
+                    lib = gi.libraries.create_library(name=args.library_name, description="Generated from galaxy-workflow-executor")
+                    lib_id = lib['id']
+                else:
+                    lib_id = lib[0]['id']
                    
-            if lib_id:
-                export_results_to_data_library(gi=gi, history_id=results['history_id'], lib_id=lib_id, allowed_error_states=allowed_error_states)
+                if lib_id:
+                    export_results_to_data_library(gi=gi, history_id=results['history_id'], lib_id=lib_id,
+                                                   allowed_error_states=allowed_error_states, cache=metadata_cache)
+                else:
+                    logging.error(f'Library {args.library_name} not found, results not uploaded to library')
+
+            elif downloader is not None:
+                logging.info('Downloading remaining results ...')
+                metrics.start_phase('download')
+                downloader.finish()
+                logging.info('Results available.')
+            elif download:
+                logging.info('Downloading results ...')
+                metrics.start_phase('download')
+                download_results(gi, history_id=results['history_id'],
+                    output_dir=args.output_dir, allowed_error_states=allowed_error_states,
+                    use_names=True, workers=args.download_workers, state=state,
+                    retrieval_mode=args.retrieval_mode, collection_archives=args.collection_archives)
+                logging.info('Results available.')
+            elif not args.keep_histories:
+                logging.info("Downloads turned off, no library specified and deleting the histories... you won't keep results.")
             else:
-                logging.error(f'Library {args.library_name} not found, results not uploaded to library')
-
-        elif download:
-            logging.info('Downloading results ...')
-            download_results(gi, history_id=results['history_id'],
-                output_dir=args.output_dir, allowed_error_states=allowed_error_states,
-                use_names=True)
-            logging.info('Results available.')
-        elif not args.keep_histories:
-            logging.info("Downloads turned off, no library specified and deleting the histories... you won't keep results.")
-        else:
-            logging.info('Results kept in history.')
-
-        logging.info('Deleting state file {}'.format(args.state_file))
-        os.unlink(args.state_file)
+                logging.info('Results kept in history.')
+            metadata_cache.log_stats()
+            rate_limiter.log_stats()
+            state.record_action('results_retrieved')
 
-        if args.publish:
+        metrics.start_phase('cleanup')
+        if args.publish and not state.is_done('share_history'):
             gi.histories.update_history(results['history_id'], published=True)
+            state.record_action('share_history')
             logging.info("Results history made public...")
-        elif args.accessible:
+        elif args.accessible and not state.is_done('share_history'):
             gi.histories.update_history(results['history_id'], importable=True)
+            state.record_action('share_history')
             logging.info("Results history made accesible...")
 
         if not args.keep_histories:
             logging.info('Deleting histories...')
             try:
-                if not args.publish and not args.accessible:
+                if not args.publish and not args.accessible and not state.is_done('delete_results_history'):
                     logging.info("Deleting results history as not marked as shared or published...")
                     gi.histories.delete_history(results['history_id'], purge=True)
-                if num_inputs > 0:
+                    state.record_action('delete_results_history')
+                if num_inputs > 0 and not state.is_done('delete_input_history'):
                     gi.histories.delete_history(history['id'], purge=True)
+                    state.record_action('delete_input_history')
             except ConnectionError:
                 logging.error('Connection was interrupted while trying to delete histories, '
                               'although this probably succeded at the server, you should check that they have been deleted.')
                 hist_to_delete_path = os.path.join(args.output_dir, 'histories_to_check.txt')
                 logging.info('Adding collection identifiers to be checked to {}'.format(hist_to_delete_path))
                 with open(hist_to_delete_path, mode="w") as f:
-                    for hist in results['history_id'], history['id']:
+                    # there is no input history when the workflow has no inputs
+                    for hist in [results['history_id']] + ([history['id']] if num_inputs > 0 else []):
                         f.write(str(hist)+"\n")
+                # the state file is kept, so that running again with it only retries the clean up
                 logging.info("Exiting with error code 3 now to signal the connection error on history deletion.")
                 logging.info("Data should have been downloaded fine, "
                              "and there is no reason not to proceed with any posterior analysis")
                 exit(3)
             logging.info('Histories purged...')
 
-        if not args.keep_workflow:
+        if not args.keep_workflow and not args.reuse_workflow and not state.is_done('delete_workflow'):
             logging.info('Deleting workflow...')
             try:
                 gi.workflows.delete_workflow(workflow_id=workflow_id)
+                state.record_action('delete_workflow')
                 logging.info('Workflow deleted.')
             except ConnectionError:
                 logging.error('Connection was interrupted while trying to delete the workflow, '
                               'although this probably succeeded at the server... ignoring.')
 
+        logging.info('Deleting state file {}'.format(args.state_file))
+        os.unlink(args.state_file)
+
         exit(0)
+    except SystemExit as e:
+        metrics.exit_status = e.code
+        raise e
     except Exception as e:
+        metrics.exit_status = 1
         logging.error("Failed due to {}".format(str(e)))
         raise e
+    finally:
+        # metrics are only written for runs that got past validation
+        if run_started:
+            metrics.end_phase()
+            metrics.log_summary()
+            try:
+                if args.metrics_file is not None:
+                    metrics.write(args.metrics_file, prometheus=args.prometheus_textfile)
+                if recorder is not None:
+                    recorder.save(args.record_traffic)
+            except OSError as e:
+                logging.warning("Run metrics or traffic could not be written: {}".format(e))
 
 
 if __name__ == '__main__':
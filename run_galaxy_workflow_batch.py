@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+"""run_galaxy_workflow_batch
+
+This script runs the same workflow for many sets of inputs and parameters on a galaxy instance, using a single
+connection and a single import of the workflow. Runs are listed in a YAML manifest:
+
+- history: sample_1
+  inputs: sample_1/inputs.yaml
+  parameters: sample_1/parameters.json
+- history: sample_2
+  inputs: sample_2/inputs.yaml
+  output_dir: results/sample_2
+
+running syntax
+
+python run_galaxy_workflow_batch.py -C galaxy_credentials.yml -G 'embassy' -o output_dir \
+       -W Galaxy-Workflow-Scanpy_default_params.json \
+       -m batch.yaml
+
+Each run gets its own output directory (by default named after its history within the output directory), with
+its results and execution state. A summary with the exit status of each run is written to batch_summary.tsv.
+"""
+
+import argparse
+import logging
+import os
+from sys import exit
+
+from wfexecutor import (
+    RETRIEVAL_MODES,
+    PollingPolicy,
+    RateLimiter,
+    ToolMetadataCache,
+    UploadCache,
+    get_galaxy_instance,
+    get_instance,
+    has_path_inputs,
+    supports_resumable_uploads,
+    read_yaml_file,
+)
+from wfexecutor.batch import batch_exit_code, read_batch_manifest, run_batch
+
+# Exit status:
+# 0 - all runs succeeded
+# 1 - at least one run failed, see the summary for the exit status of each run
+# 3 - results of all runs were retrieved, but the histories of some could not be deleted
+
+
+def get_args():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('-C', '--conf',
+                            required=True,
+                            help='A yaml file describing the galaxy credentials')
+    arg_parser.add_argument('-G', '--galaxy-instance',
+                            default='embassy',
+                            help='Galaxy server instance name')
+    arg_parser.add_argument('-m', '--manifest',
+                            required=True,
+                            help='YAML file listing the runs, each with history, inputs and optionally '
+                                 'parameters and output_dir')
+    arg_parser.add_argument('-o', '--output-dir',
+                            default=os.getcwd(),
+                            help='Path to output directory, where each run gets its own directory by default')
+    arg_parser.add_argument('-W', '--workflow',
+                            required=True,
+                            help='Workflow to run')
+    arg_parser.add_argument('-a', '--allowed-errors',
+                            required=False,
+                            default=None,
+                            help="Yaml file with allowed steps that can have errors.")
+    arg_parser.add_argument('--max-concurrent-runs', type=int,
+                            default=4,
+                            help="Maximum number of runs in progress at the same time.")
+    arg_parser.add_argument('--debug',
+                            action='store_true',
+                            default=False,
+                            help='Print debug information')
+    arg_parser.add_argument('-k', '--keep-histories',
+                            action='store_true',
+                            default=False,
+                            help="Keeps histories created, they will be purged if not.")
+    arg_parser.add_argument('-w', '--keep-workflow',
+                            action='store_true',
+                            default=False,
+                            help="Keeps workflow created, it will be purged if not.")
+    arg_parser.add_argument('--reuse-workflow',
+                            action='store_true',
+                            default=False,
+                            help="Reuse a workflow already imported with identical content instead of importing "
+                                 "it again. The workflow is kept at the end of the batch.")
+    arg_parser.add_argument('--workflow-index',
+                            default='~/.wfexecutor/workflows.json',
+                            help="Local file mapping workflow content hashes to imported workflow ids, "
+                                 "used with --reuse-workflow.")
+    arg_parser.add_argument('--upload-workers', type=int,
+                            default=4,
+                            help="Number of input files of each run to upload concurrently.")
+    arg_parser.add_argument('--upload-cache',
+                            default=None,
+                            help="Local index file used to reuse input files already uploaded to the instance, "
+                                 "recognised by the checksum of their content. Disabled if not given.")
+    arg_parser.add_argument('--upload-cache-history',
+                            default='wfexecutor_upload_cache',
+                            help="Name of the history where cached input files are uploaded, used with "
+                                 "--upload-cache. This history is never deleted by the executor.")
+    arg_parser.add_argument('--tool-cache',
+                            default=None,
+                            help="Local file where tool metadata for the software versions file is cached "
+                                 "across runs. Disabled if not given.")
+    arg_parser.add_argument('--tool-cache-ttl', type=float,
+                            default=7 * 24 * 3600,
+                            help="Seconds after which cached tool metadata is retrieved again, a week by default.")
+    arg_parser.add_argument('--retrieval-mode',
+                            choices=RETRIEVAL_MODES,
+                            default='http',
+                            help="How results are retrieved: downloaded over 'http', or when the Galaxy object "
+                                 "store is mounted locally, hard linked (or copied across file systems) with "
+                                 "'link' or copied with 'copy'. Files not visible locally are downloaded.")
+    arg_parser.add_argument('--collection-archives', action='store_true',
+                            default=False,
+                            help="Download the elements of each collection with a single request for an archive "
+                                 "of the collection, instead of one request per element.")
+    arg_parser.add_argument('--download-workers', type=int,
+                            default=4,
+                            help="Number of result files of each run to download concurrently.")
+    arg_parser.add_argument('--api-rate', type=float,
+                            default=10,
+                            help="Maximum metadata requests per second to the Galaxy instance, 0 for no limit.")
+    arg_parser.add_argument('--upload-rate', type=float,
+                            default=2,
+                            help="Maximum upload requests per second to the Galaxy instance, 0 for no limit.")
+    arg_parser.add_argument('--download-rate', type=float,
+                            default=5,
+                            help="Maximum download requests per second to the Galaxy instance, 0 for no limit.")
+    arg_parser.add_argument('--max-in-flight', type=int,
+                            default=8,
+                            help="Maximum number of requests waiting for a response from the Galaxy instance "
+                                 "at the same time.")
+    arg_parser.add_argument('--poll-first-check', type=float,
+                            default=5,
+                            help="Seconds to wait before the first check of the invocations.")
+    arg_parser.add_argument('--poll-min-interval', type=float,
+                            default=10,
+                            help="Shortest wait in seconds between polls, used again whenever states change.")
+    arg_parser.add_argument('--poll-max-interval', type=float,
+                            default=120,
+                            help="Longest wait in seconds between polls.")
+    arg_parser.add_argument('--poll-backoff', type=float,
+                            default=1.5,
+                            help="Factor by which the wait between polls grows while states don't change.")
+    arg_parser.add_argument('--poll-jitter', type=float,
+                            default=0.1,
+                            help="Random variation applied to each wait, as a fraction of it.")
+    args = arg_parser.parse_args()
+    return args
+
+
+def set_logging_level(debug=False):
+    logging.basicConfig(
+        level=logging.DEBUG if debug else logging.INFO,
+        format='%(asctime)s - %(message)s',
+        datefmt='%d-%m-%y %H:%M:%S')
+
+
+def main():
+    try:
+        args = get_args()
+        set_logging_level(args.debug)
+
+        runs = read_batch_manifest(args.manifest, args.output_dir)
+        allowed_errors = read_yaml_file(args.allowed_errors) if args.allowed_errors is not None else None
+
+        logging.info('Prepare galaxy environment...')
+        ins = get_instance(args.conf, name=args.galaxy_instance)
+        gi = get_galaxy_instance(ins, workers=min(args.max_in_flight, args.max_concurrent_runs *
+                                                  max(args.upload_workers, args.download_workers)))
+        rate_limiter = RateLimiter(metadata_rate=args.api_rate, upload_rate=args.upload_rate,
+                                   download_rate=args.download_rate, max_in_flight=args.max_in_flight)
+        rate_limiter.install(gi)
+
+        upload_cache = None
+        if args.upload_cache:
+            upload_cache = UploadCache(args.upload_cache, history_name=args.upload_cache_history)
+        tool_cache = None
+        if args.tool_cache:
+            tool_cache = ToolMetadataCache(args.tool_cache, ttl=args.tool_cache_ttl)
+        polling = PollingPolicy(first_check=args.poll_first_check,
+                                min_interval=args.poll_min_interval,
+                                max_interval=args.poll_max_interval,
+                                backoff=args.poll_backoff,
+                                jitter=args.poll_jitter)
+
+        runs = run_batch(gi, args.workflow, runs, args.output_dir, allowed_errors=allowed_errors,
+                         max_concurrent_runs=args.max_concurrent_runs, upload_workers=args.upload_workers,
+                         download_workers=args.download_workers, retrieval_mode=args.retrieval_mode,
+                         collection_archives=args.collection_archives,
+                         polling=polling,
+                         keep_histories=args.keep_histories, keep_workflow=args.keep_workflow,
+                         reuse_workflow=args.reuse_workflow, workflow_index=args.workflow_index,
+                         upload_cache=upload_cache, tool_cache=tool_cache,
+                         resumable_uploads=any(has_path_inputs(run.inputs) for run in runs) and
+                         supports_resumable_uploads(gi))
+        rate_limiter.log_stats()
+        exit(batch_exit_code(runs))
+    except Exception as e:
+        logging.error("Failed due to {}".format(str(e)))
+        raise e
+
+
+if __name__ == '__main__':
+    main()
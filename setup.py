@@ -18,6 +18,6 @@ setup(
         author='Suhaib Mohammed, Pablo Moreno, Anil Thanki',
         long_description_content_type='text/markdown',
         author_email='',
-        scripts=['run_galaxy_workflow.py', 'generate_params_from_workflow.py'],
+        scripts=['run_galaxy_workflow.py', 'run_galaxy_workflow_batch.py', 'generate_params_from_workflow.py'],
         license='MIT'
     )
@@ -1,3 +1,4 @@
+import importlib
 import logging
 import os
 import time
@@ -8,6 +9,60 @@ from collections.abc import Mapping
 import yaml
 import json
 import pickle
+import hashlib
+
+# How results are retrieved, see downloads.stream_dataset.
+RETRIEVAL_MODES = ('http', 'link', 'copy')
+
+# Names re-exported from the submodules. Those need bioblend, requests or asyncio, which take several times longer
+# to import than validating the files of a run, so they are only imported when first used, once a connection
+# to Galaxy is needed.
+_SUBMODULE_NAMES = {
+    'aio': (),
+    'batch': (),
+    'cache': ('JsonFileIndex', 'MetadataCache', 'ToolMetadataCache', 'UploadCache', 'file_digest'),
+    'connection': ('PooledGalaxyInstance', 'pooled_session'),
+    'contents': ('iter_history_contents',),
+    'downloads': ('DownloadManifest', 'IncrementalDownloader', 'plan_downloads', 'run_downloads',
+                  'run_downloads_async'),
+    'library': ('LibraryFolders', 'export_results_to_data_library', 'export_results_to_data_library_async'),
+    'metrics': ('Metrics', 'endpoint_name'),
+    'polling': ('PollingPolicy',),
+    'progress': ('InvocationProgress',),
+    'recording': ('ReplayGalaxyInstance', 'TrafficRecorder', 'read_traffic', 'summarize_traffic'),
+    'state': ('ExecutionState',),
+    'throttle': ('RateLimiter', 'TokenBucket'),
+    'uploads': ('resumable_upload', 'supports_resumable_uploads', 'upload_path_input'),
+}
+_LAZY_NAMES = {name: module for module, names in _SUBMODULE_NAMES.items() for name in names}
+
+# Names exported by `from wfexecutor import *`, which generate_params_from_workflow.py and other scripts use. The
+# modules come first, as the star import has always made them available. Importing the lazy names this way
+# imports the submodules they come from.
+__all__ = [
+    'logging', 'os', 'time', 'Mapping', 'yaml', 'json', 'pickle',
+    'RETRIEVAL_MODES', 'WORKFLOW_HASH_TAG',
+    'get_instance', 'get_galaxy_instance', 'read_json_file', 'read_yaml_file', 'get_workflow_from_file',
+    'workflow_hash', 'get_workflow_from_name', 'get_workflow_id', 'get_history_id', 'get_input_data_id',
+    'get_run_state', 'download_results_async', 'download_results', 'set_params', 'load_input_files_async',
+    'load_input_files', 'validate_labels', 'validate_input_labels', 'validate_file_exists', 'has_path_inputs',
+    'validate_dataset_id_exists', 'completion_state_async', 'completion_state', 'validate_allowed_errors',
+    'process_allowed_errors', 'produce_versions_file',
+] + sorted(_LAZY_NAMES)
+
+
+def __getattr__(name):
+    if name in _SUBMODULE_NAMES:
+        return importlib.import_module('.' + name, __name__)
+    if name not in _LAZY_NAMES:
+        raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+    value = getattr(importlib.import_module('.' + _LAZY_NAMES[name], __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_SUBMODULE_NAMES) | set(_LAZY_NAMES))
 
 
 def get_instance(conf, name='__default'):
@@ -20,6 +75,37 @@ def get_instance(conf, name='__default'):
         return data[entry]
 
 
+def get_galaxy_instance(ins, workers=4):
+    """
+    Creates the connection to a Galaxy instance, with a shared session that keeps connections alive. Besides
+    url and key, the instance entry in the credentials file can set:
+
+    embassy:
+        url: "https://galaxy.example.org"
+        key: "xx"
+        pool_size: 16         # connections kept alive, by default the number of workers plus two for polling
+        connect_timeout: 10   # seconds to establish a connection
+        read_timeout: 300     # seconds to wait for data from the server
+        retries: 3            # retries of idempotent requests on connection or read errors
+        retry_backoff: 0.5    # base in seconds of the jittered exponential backoff between retries
+        verify: true          # whether to verify TLS certificates
+
+    :param ins: instance entry of the credentials file, as given by get_instance
+    :param workers: number of concurrent requests the executor is configured to make
+    :return: galaxy instance object
+    """
+    from . import connection
+    from .connection import PooledGalaxyInstance, pooled_session
+
+    session = pooled_session(pool_size=ins.get('pool_size', workers + 2),
+                             retries=ins.get('retries', connection.DEFAULT_RETRIES),
+                             backoff=ins.get('retry_backoff', connection.DEFAULT_RETRY_BACKOFF))
+    timeout = (ins.get('connect_timeout', connection.DEFAULT_CONNECT_TIMEOUT),
+               ins.get('read_timeout', connection.DEFAULT_READ_TIMEOUT))
+    return PooledGalaxyInstance(ins['url'], key=ins['key'], session=session, timeout=timeout,
+                                verify=ins.get('verify', True))
+
+
 def read_json_file(json_file_path):
     with open(json_file_path) as json_file:
         json_obj = json.load(json_file)
@@ -33,13 +119,76 @@ def read_yaml_file(yaml_path):
     :param yaml_path:
     :return: dictionary object from YAML content.
     """
-    stream = open(yaml_path, "r")
-    return yaml.safe_load(stream)
+    with open(yaml_path, "r") as stream:
+        # the libyaml parser, when available, is several times faster
+        return yaml.load(stream, Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader))
+
+
+WORKFLOW_HASH_TAG = 'wfe_hash'
+
+
+def get_workflow_from_file(gi, workflow_file, reuse=False, index_path=None):
+    """
+    Imports the workflow in the file given into the Galaxy instance. When reuse is set, a workflow previously
+    imported from the same content, recognised by a tag with the hash of its normalised JSON, is used instead
+    if it is still available. An optional local index from hashes to workflow ids avoids searching the
+    instance for it.
 
+    :param gi: galaxy instance object
+    :param workflow_file: path to the workflow JSON file
+    :param reuse: whether to reuse an already imported workflow with the same content
+    :param index_path: path to the JSON file where hashes are mapped to workflow ids
+    :return: list with the workflow dictionary
+    """
+    if not reuse:
+        import_workflow = [gi.workflows.import_workflow_from_local_path(file_local_path=workflow_file)]
+        return import_workflow
 
-def get_workflow_from_file(gi, workflow_file):
-    import_workflow = [gi.workflows.import_workflow_from_local_path(file_local_path=workflow_file)]
-    return import_workflow
+    from bioblend import ConnectionError
+
+    from .cache import JsonFileIndex
+
+    wf_json = read_json_file(workflow_file)
+    digest = workflow_hash(wf_json)
+    index = JsonFileIndex(index_path) if index_path else None
+    if index is not None:
+        wf_id = index.get(gi.base_url, digest)
+        if wf_id is not None:
+            try:
+                wf = gi.workflows.show_workflow(wf_id)
+                if not wf.get('deleted', False):
+                    logging.info("Reusing workflow {} from local index for hash {}".format(wf_id, digest))
+                    return [wf]
+            except ConnectionError:
+                pass
+            logging.info("Workflow {} from local index is no longer available".format(wf_id))
+            index.remove(gi.base_url, digest)
+
+    tag = "{}:{}".format(WORKFLOW_HASH_TAG, digest)
+    wf = None
+    for candidate in gi.workflows.get_workflows(name=wf_json.get('name')):
+        if tag in candidate.get('tags', []) and not candidate.get('deleted', False):
+            logging.info("Reusing workflow {} already imported with hash {}".format(candidate['id'], digest))
+            wf = candidate
+            break
+    if wf is None:
+        wf = gi.workflows.import_workflow_dict(wf_json)
+        gi.workflows.update_workflow(wf['id'], tags=list(wf.get('tags', [])) + [tag])
+        logging.info("Imported workflow {} with hash {}".format(wf['id'], digest))
+    if index is not None:
+        index.put(gi.base_url, digest, wf['id'])
+    return [wf]
+
+
+def workflow_hash(wf_json):
+    """
+    Computes a hash of the workflow content that doesn't depend on formatting or key order of the JSON file.
+
+    :param wf_json: workflow dictionary as read from the JSON file
+    :return: hexadecimal SHA-256 digest
+    """
+    normalised = json.dumps(wf_json, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(normalised.encode('utf-8')).hexdigest()
 
 
 def get_workflow_from_name(gi, workflow_name):
@@ -73,7 +222,8 @@ def get_run_state(gi, results):
     return state
 
 
-def download_results(gi, history_id, output_dir, allowed_error_states, use_names=False):
+async def download_results_async(gi, history_id, output_dir, allowed_error_states, use_names=False, workers=1,
+                                 state=None, retrieval_mode='http', collection_archives=False):
     """
     Downloads results from a given Galaxy instance and history to a specified filesystem location.
 
@@ -82,117 +232,35 @@ def download_results(gi, history_id, output_dir, allowed_error_states, use_names
     :param output_dir: path to where result file should be written.
     :param allowed_error_states: dictionary with elements known to be allowed to fail.
     :param use_names: whether to trust or not the internal Galaxy name for the final file name
-    :return:
+    :param workers: number of datasets to download concurrently.
+    :param state: optional ExecutionState, to skip datasets already downloaded and record new downloads.
+    :param retrieval_mode: 'http' to download files, or 'link' or 'copy' to take them from the Galaxy object
+     store when it is mounted locally, downloading those that are not visible.
+    :param collection_archives: whether to download the elements of each collection as a single archive.
+    :return: total number of bytes downloaded.
     """
-    datasets = gi.histories.show_history(history_id,
-                                         contents=True,
-                                         visible=True, details='all')
-    used_names = set()
-    for dataset in datasets:
-        if dataset['type'] == 'file':
-            if dataset['state'] == 'error' and dataset['id'] in allowed_error_states['datasets']:
-                logging.info('Skipping download of failed {} as it is an allowed failure.'
-                             .format(dataset['name']))
-                continue
-            if use_names and dataset['name'] is not None and dataset['name'] not in used_names:
-                gi.datasets.download_dataset(dataset['id'], file_path=os.path.join(output_dir, dataset['name']),
-                                             use_default_filename=False)
-                used_names.add(dataset['name'])
-            else:
-                gi.datasets.download_dataset(dataset['id'],
-                                             file_path=output_dir,
-                                             use_default_filename=True)
-        elif dataset['type'] == 'collection':
-            for ds_in_coll in dataset['elements']:
-                if ds_in_coll['object']['state'] == 'error' and ds_in_coll['object']['id'] in allowed_error_states['datasets']:
-                    logging.info('Skipping download of failed {} as it is an allowed failure.'
-                                 .format(ds_in_coll['object']['name']))
-                    continue
-                if use_names and ds_in_coll['object']['name'] is not None \
-                        and ds_in_coll['object']['name'] not in used_names:
-                    # TODO it fails here to download if it is in 'error' state
-                    gi.datasets.download_dataset(ds_in_coll['object']['id'],
-                                                 file_path=os.path.join(output_dir, ds_in_coll['object']['name']),
-                                                 use_default_filename=False)
-                    used_names.add(ds_in_coll['object']['name'])
-                else:
-                    gi.datasets.download_dataset(ds_in_coll['object']['id'],
-                                                 file_path=output_dir,
-                                                 use_default_filename=True)
+    from . import aio
+    from .contents import iter_history_contents
+    from .downloads import DownloadManifest, plan_downloads, run_downloads_async
 
+    # history contents are retrieved page by page as the downloads are planned
+    downloads = await aio.call(lambda: plan_downloads(iter_history_contents(gi, history_id), output_dir,
+                                                      allowed_error_states, use_names=use_names))
+    return await run_downloads_async(gi, downloads, workers=workers, state=state,
+                                     manifest=DownloadManifest(output_dir), retrieval_mode=retrieval_mode,
+                                     collection_archives=collection_archives)
 
-def export_results_to_data_library(gi, history_id, lib_id, allowed_error_states):
+
+def download_results(gi, history_id, output_dir, allowed_error_states, use_names=False, workers=1, state=None,
+                     retrieval_mode='http', collection_archives=False):
     """
-    Downloads results from a given Galaxy instance and history to a specified filesystem location.
-    :param gi: galaxy instance object
-    :param history_id: ID of the history from where results should be retrieved.
-    :param output_dir: path to where result file should be written.
-    :param allowed_error_states: dictionary with elements known to be allowed to fail.
-    :return:
+    Synchronous version of download_results_async.
     """
-    datasets = gi.histories.show_history(history_id,
-                                         contents=True,
-                                         visible=True, details='all')
+    from . import aio
 
-    for dataset in datasets:
-        if dataset['type'] == 'file':
-            if dataset['state'] == 'error' and dataset['id'] in allowed_error_states['datasets']:
-                logging.info('Skipping upload of failed {} as it is an allowed failure.'
-                             .format(dataset['name']))
-                continue
-            if dataset['name'] is not None:
-
-                file_path = dataset['file_name']
-                folder_name = gi.histories.show_history(history_id)['name']
-                folder = gi.libraries.get_folders(library_id=lib_id, name='/'+folder_name)
-
-                if folder == []:
-                    folder = gi.libraries.gi.libraries.create_folder(library_id=lib_id, folder_name=folder_name)
-
-                folder_id = folder[0]['id']
-                uploaded_dataset = gi.libraries.upload_from_galaxy_filesystem(lib_id, file_path, folder_id=folder_id, link_data_only="copy_files", tag_using_filenames=True)
-                gi.libraries.wait_for_dataset(library_id=lib_id, dataset_id=uploaded_dataset[0]['id']) 
-                updated_dataset = gi.libraries.update_library_dataset(dataset_id=uploaded_dataset[0]['id'], name=dataset['name'])
-
-                logging.info('data uploaded updating name to {}.'
-                             .format(dataset['name']))
-                
-                gi.libraries.update_library_dataset(dataset_id=uploaded_dataset[0]['id'], name=dataset['name'])
-
-        elif dataset['type'] == 'collection':
-            
-            base_folder_name = gi.histories.show_history(history_id)['name']
-            base_folder = gi.libraries.get_folders(library_id=lib_id, name='/'+base_folder_name)
-
-            if base_folder == []:
-                base_folder = gi.libraries.gi.libraries.create_folder(library_id=lib_id, folder_name=base_folder_name)
-
-            folder_name = gi.dataset_collections.show_dataset_collection(dataset['id'], 'history')['name']
-            folder = gi.libraries.get_folders(library_id=lib_id, name='/'+base_folder_name+'/'+folder_name)
-
-            if folder == []:
-                folder = gi.libraries.gi.libraries.create_folder(library_id=lib_id, folder_name=folder_name, base_folder_id=base_folder[0]['id'])
-
-            folder_id = folder[0]['id']
-            
-            for ds_in_coll in dataset['elements']:
-                
-                if ds_in_coll['object']['state'] == 'error' and ds_in_coll['object']['id'] in allowed_error_states['datasets']:
-                    logging.info('Skipping upload of failed {} as it is an allowed failure.'
-                             .format(ds_in_coll['object']['name']))
-                    continue
-                if ds_in_coll['object']['name'] is not None:
-                    
-                    # Get dataset object for the collection element
-                    dataset = gi.datasets.show_dataset(ds_in_coll['object']['id'])
-                    file_path = dataset['file_name']
-                    
-                    uploaded_dataset = gi.libraries.upload_from_galaxy_filesystem(lib_id, file_path, folder_id=folder_id, link_data_only="copy_files", tag_using_filenames=True)
-                    gi.libraries.wait_for_dataset(library_id=lib_id, dataset_id=uploaded_dataset[0]['id']) 
-                    updated_dataset = gi.libraries.update_library_dataset(dataset_id=uploaded_dataset[0]['id'], name=dataset['name'])
-
-                    logging.info('data uploaded updating name to {}.'
-                         .format(dataset['name']))
+    return aio.run(download_results_async(gi, history_id, output_dir, allowed_error_states, use_names=use_names,
+                                          workers=workers, state=state, retrieval_mode=retrieval_mode,
+                                          collection_archives=collection_archives))
 
 
 def set_params(json_wf, param_data):
@@ -219,7 +287,8 @@ def set_params(json_wf, param_data):
     return params
 
 
-def load_input_files(gi, inputs, workflow, history):
+async def load_input_files_async(gi, inputs, workflow, history, upload_cache=None, workers=1, state=None,
+                                 resumable=False):
     """
     Loads file in the inputs yaml to the Galaxy instance given. Returns
     datasets dictionary with names and histories. It associates existing datasets on Galaxy given by dataset_id
@@ -245,21 +314,24 @@ def load_input_files(gi, inputs, workflow, history):
     :param inputs: dictionary of inputs as read from the inputs YAML file
     :param workflow: workflow object produced by gi.workflows.show_workflow
     :param history: the history object to where the files should be uploaded
+    :param upload_cache: optional UploadCache, to reuse files already uploaded instead of uploading them again
+    :param workers: number of files to upload concurrently
+    :param state: optional ExecutionState where progress of each upload is recorded, to resume them
+    :param resumable: whether to upload large files in chunks that can be resumed after an interruption
     :return: inputs object for invoke_workflow
     """
+    from . import aio
+    from .uploads import upload_path_input
 
     inputs_for_invoke = {}
+    path_uploads = []
 
     for step, step_data in workflow['inputs'].items():
         # upload file and record the identifier
         if step_data['label'] in inputs and 'path' in inputs[step_data['label']]:
-            upload_res = gi.tools.upload_file(path=inputs[step_data['label']]['path'], history_id=history['id'],
-                                              file_name=step_data['label'],
-                                              file_type=inputs[step_data['label']]['type'])
-            inputs_for_invoke[step] = {
-                    'id': upload_res['outputs'][0]['id'],
-                    'src': 'hda'
-                }
+            # uploads are done together afterwards, keeping the place of the step in the inputs
+            inputs_for_invoke[step] = None
+            path_uploads.append(step)
         elif step_data['label'] in inputs and 'dataset_id' in inputs[step_data['label']]:
             inputs_for_invoke[step] = {
                 'id': inputs[step_data['label']]['dataset_id'],
@@ -274,8 +346,8 @@ def load_input_files(gi, inputs, workflow, history):
             # We are in the presence of a simple parameter input
             inputs_for_invoke[step] = inputs[step_data['label']]
         elif step_data['label'] in inputs and 'library_id' in inputs[step_data['label']]:
-            upload_res = gi.histories.upload_dataset_from_library(history_id=history['id'], 
-                                                                  lib_dataset_id=inputs[step_data['label']]['library_id'])
+            upload_res = await aio.call(gi.histories.upload_dataset_from_library, history_id=history['id'],
+                                        lib_dataset_id=inputs[step_data['label']]['library_id'])
             inputs_for_invoke[step] = {
                  'id': upload_res['id'],
                  'src': 'hda'
@@ -283,9 +355,32 @@ def load_input_files(gi, inputs, workflow, history):
         else:
             raise ValueError("Label '{}' is not present in inputs yaml".format(step_data['label']))
 
+    def upload(step):
+        label = workflow['inputs'][step]['label']
+        return upload_path_input(gi, label, inputs[label], history, upload_cache=upload_cache, state=state,
+                                 resumable=resumable)
+
+    for step, dataset_id in zip(path_uploads, await aio.map_in_threads(upload, path_uploads, workers)):
+        inputs_for_invoke[step] = {
+            'id': dataset_id,
+            'src': 'hda'
+        }
+
     return inputs_for_invoke
 
 
+def load_input_files(gi, inputs, workflow, history, upload_cache=None, workers=1, state=None, resumable=False):
+    """
+    Synchronous version of load_input_files_async.
+
+    :return: inputs object for invoke_workflow
+    """
+    from . import aio
+
+    return aio.run(load_input_files_async(gi, inputs, workflow, history, upload_cache=upload_cache,
+                                          workers=workers, state=state, resumable=resumable))
+
+
 def validate_labels(wf_from_json, param_data, exit_on_error=True):
     """
     Checks that all workflow steps have labels (although if not the case, it will only
@@ -350,6 +445,16 @@ def validate_file_exists(inputs):
             raise ValueError("Input file {} does not exist for input label {}".format(input_content['path'], input_key))
 
 
+def has_path_inputs(inputs):
+    """
+    Checks whether any input is given by a path in the local file system, so that files need uploading.
+
+    :param inputs: dictionary with inputs
+    :return: boolean
+    """
+    return any(isinstance(input_content, Mapping) and 'path' in input_content for input_content in inputs.values())
+
+
 def validate_dataset_id_exists(gi, inputs):
     """
     Checks that dataset_id exists in the Galaxy instance when dataset_id are specified. Raises an error if the dataset
@@ -372,7 +477,8 @@ def validate_dataset_id_exists(gi, inputs):
                                  .format(input_content['dataset_id']))
 
 
-def completion_state(gi, history, allowed_error_states, wait_for_resubmission=True):
+async def completion_state_async(gi, history, allowed_error_states, wait_for_resubmission=True,
+                                 checked_errors=None, resubmission_wait=20, workers=8, cache=None, sleep=None):
     """
     Checks whether the history is in error state considering potential acceptable error states
     in the allowed error states definition.
@@ -381,54 +487,78 @@ def completion_state(gi, history, allowed_error_states, wait_for_resubmission=Tr
     :param gi: The galaxy instance connection
     :param history:
     :param allowed_error_states: dictionary containing acceptable error states for steps
+    :param checked_errors: set of errored dataset ids that already had their resubmission grace period
+     in previous calls, updated in place. Pass the same set on every poll to avoid waiting again for them.
+    :param resubmission_wait: seconds to wait for errored jobs to be resubmitted.
+    :param workers: maximum number of errored datasets to re-check concurrently.
+    :param cache: MetadataCache shared across polls, to avoid retrieving the same datasets and jobs again.
+    :param sleep: coroutine function used to wait for resubmissions, asyncio.sleep by default.
     :return: two booleans, error_state and completed
     """
+    import asyncio
+
+    from . import aio
+    from .cache import MetadataCache
+
+    if cache is None:
+        cache = MetadataCache()
+    if sleep is None:
+        sleep = asyncio.sleep
 
     # First easy check for error state if there are no allowed errors
     error_state = len(allowed_error_states['tools']) == 0 and history['state_details']['error'] > 0
 
     # If there are allowed error states, check details
     if not error_state:
-        for dataset_id in history['state_ids']['error']:
+        # if the dataset was already in allowed error states, then we know it doesn't represent
+        # a complete workflow execution error
+        error_ids = [dataset_id for dataset_id in history['state_ids']['error']
+                     if dataset_id not in allowed_error_states['datasets']]
+        error_datasets = {}
+        if wait_for_resubmission and error_ids:
             # Sometimes transient error states will be found for jobs that are in the process
             # of being resubmitted. This part accounts for that, waiting for the state to go back
-            # from error.
-            if wait_for_resubmission:
+            # from error. All newly errored datasets share a single waiting period, while those
+            # seen in previous polls already had theirs and are just checked again.
+            if checked_errors is None:
+                checked_errors = set()
+            new_error_ids = [dataset_id for dataset_id in error_ids if dataset_id not in checked_errors]
+            if new_error_ids:
                 # We have seen jobs circling from error to running again in lapses of around 10 seconds
                 # at the most, so we wait for conservative period. This could be improved later.
-                logging.info("Waiting 20 sec to check if the job gets re-submitted")
-                time.sleep(20)
-                ds = gi.datasets.show_dataset(dataset_id)
-                if not ds['resubmitted']:
-                    logging.info("Job was not resubmitted")
-                    error_state = True
-                elif ds['state'] != 'error':
-                    logging.info("Job was resubmitted and is not in error any more...")
+                logging.info("Waiting {} sec to check if {} errored jobs get re-submitted"
+                             .format(resubmission_wait, len(new_error_ids)))
+                await sleep(resubmission_wait)
+            # only datasets that just went through the waiting period need to be seen afresh
+            error_datasets = dict(zip(error_ids, await aio.map_in_threads(
+                lambda dataset_id: cache.show_dataset(gi, dataset_id, refresh=dataset_id in new_error_ids),
+                error_ids, workers)))
+            checked_errors.update(error_ids)
+
+        for dataset_id in error_ids:
+            if wait_for_resubmission:
+                dataset = error_datasets[dataset_id]
+                if not dataset['resubmitted']:
+                    logging.info("Job for dataset {} was not resubmitted".format(dataset_id))
+                elif dataset['state'] != 'error':
+                    logging.info("Job for dataset {} was resubmitted and is not in error any more...".format(dataset_id))
+                    continue
                 else:
-                    logging.info("Job was resubmitted at some point, but still shows to be in error state...")
-                    error_state = True
+                    logging.info("Job for dataset {} was resubmitted at some point, but still shows to be in error "
+                                 "state...".format(dataset_id))
             else:
-                error_state = True
-
-            if error_state:
-                if dataset_id in allowed_error_states['datasets']:
-                    # if the dataset was already in allowed error states, then we know it doesn't represent
-                    # a complete workflow execution error
-                    error_state = False
-                    continue
-                dataset = gi.datasets.show_dataset(dataset_id)
-                job = gi.jobs.show_job(dataset['creating_job'])
-                if job['tool_id'] in allowed_error_states['tools']:
-                    allowed_error_states['datasets'].add(dataset_id)
-                    error_state = False
-                    # TODO decide based on individual error codes.
-                    continue
-                # The tool has failed and it wasn't allowed to fail, we signal this and we stop checking for errored
-                # datasets. This will signal the setup that we are in a terminal error state
-                logging.info("Tool {} is not marked as allowed to fail, but has failed.".format(job['tool_id']))
-                break
-
+                dataset = await aio.call(cache.show_dataset, gi, dataset_id)
 
+            job = await aio.call(cache.show_job, gi, dataset['creating_job'])
+            if job['tool_id'] in allowed_error_states['tools']:
+                allowed_error_states['datasets'].add(dataset_id)
+                # TODO decide based on individual error codes.
+                continue
+            # The tool has failed and it wasn't allowed to fail, we signal this and we stop checking for errored
+            # datasets. This will signal the setup that we are in a terminal error state
+            logging.info("Tool {} is not marked as allowed to fail, but has failed.".format(job['tool_id']))
+            error_state = True
+            break
 
     # We separate completion from errors, so a workflow might have completed with or without errors
     # (this includes allowed errors). We say the workflow is in completed state when all datasets are in states:
@@ -448,8 +578,8 @@ def completion_state(gi, history, allowed_error_states, wait_for_resubmission=Tr
     if completed_state:
         # add all paused jobs to allowed_error_states or fail if jobs are paused that are not allowed
         for dataset_id in history['state_ids']['paused']:
-            dataset = gi.datasets.show_dataset(dataset_id)
-            job = gi.jobs.show_job(dataset['creating_job'])
+            dataset = await aio.call(cache.show_dataset, gi, dataset_id)
+            job = await aio.call(cache.show_job, gi, dataset['creating_job'])
             if job['tool_id'] in allowed_error_states['tools']:
                 allowed_error_states['datasets'].add(dataset_id)
                 # TODO decide based on individual error codes.
@@ -465,6 +595,43 @@ def completion_state(gi, history, allowed_error_states, wait_for_resubmission=Tr
     return error_state, completed_state
 
 
+def completion_state(gi, history, allowed_error_states, wait_for_resubmission=True, checked_errors=None,
+                     resubmission_wait=20, workers=8, cache=None, sleep=None):
+    """
+    Synchronous version of completion_state_async.
+
+    :return: two booleans, error_state and completed
+    """
+    from . import aio
+
+    return aio.run(completion_state_async(gi, history, allowed_error_states,
+                                          wait_for_resubmission=wait_for_resubmission,
+                                          checked_errors=checked_errors, resubmission_wait=resubmission_wait,
+                                          workers=workers, cache=cache, sleep=sleep))
+
+
+def validate_allowed_errors(allowed_errors_dict, wf_from_json):
+    """
+    Checks that each step label in the allowed errors file is the label of a tool step in the workflow, and that
+    it is allowed to fail with "any" error code or with a list of error codes. Raises an exception otherwise.
+
+    :param allowed_errors_dict: content from yaml file with definition of steps can fail.
+    :param wf_from_json:
+    :return:
+    """
+    if not isinstance(allowed_errors_dict, Mapping):
+        raise ValueError("Allowed errors should map step labels to lists of error codes or 'any'.")
+    tool_labels = {step_content['label'] for step_content in wf_from_json['steps'].values()
+                   if step_content['label'] is not None and step_content['tool_id'] is not None}
+    for label, error_codes in allowed_errors_dict.items():
+        if label not in tool_labels:
+            raise ValueError("Allowed errors step label '{}' is not the label of a tool step in the workflow "
+                             "definition".format(label))
+        if not isinstance(error_codes, list) or \
+                not all(code == 'any' or isinstance(code, int) for code in error_codes):
+            raise ValueError("Allowed errors for step '{}' should be a list of error codes or 'any'".format(label))
+
+
 def process_allowed_errors(allowed_errors_dict, wf_from_json):
     """
     Reads the input from allowed errors file and translates the workflow steps into tool identifiers that will be
@@ -483,71 +650,85 @@ def process_allowed_errors(allowed_errors_dict, wf_from_json):
 
     return allowed_errors_state
 
-def produce_versions_file(gi, workflow_from_json, table_path, tools_dict=[]):
+
+def _tool_steps(workflow_from_json, tool_ids):
+    """
+    Lists (tool_id, tool_version, label) for each distinct tool and version of the workflow, in the order used for
+    the versions file, going into sub-workflows recursively.
     """
-    Produces a tool versions file for the workflow run.
+    steps = []
+    for key, step in sorted(workflow_from_json['steps'].items(), reverse=True):
+        # parse sub-workflows recursively
+        if "subworkflow" in step.keys():
+            steps.extend(_tool_steps(step['subworkflow'], tool_ids))
+            # subworkflows don't have meaningful tool ids
+            continue
+        # Input steps won't have tool ids, and we only need each version of a tool once.
+        if step['tool_id'] is not None and (step['tool_id'], step.get('tool_version')) not in tool_ids:
+            steps.append((step['tool_id'], step.get('tool_version'), step['label']))
+            tool_ids.append((step['tool_id'], step.get('tool_version')))
+    return steps
+
+
+def _show_tool(gi, tool_id, tool_version=None):
+    """
+    Retrieves a tool as gi.tools.show_tool does, in the version given if any, which show_tool can't ask for.
+    """
+    from bioblend import ConnectionError
+
+    if tool_version is None:
+        return gi.tools.show_tool(tool_id)
+    r = gi.make_get_request("{}/tools/{}".format(gi.url, tool_id), params={'tool_version': tool_version})
+    if r.status_code != 200:
+        raise ConnectionError("Unexpected HTTP status code: {}".format(r.status_code),
+                              body=r.text, status_code=r.status_code)
+    return r.json()
+
+
+def produce_versions_file(gi, workflow_from_json, table_path, tools_dict=None, tool_cache=None, workers=8):
+    """
+    Produces a tool versions file for the workflow run. Tools are retrieved concurrently, and from the
+    tool cache if one is given.
 
     :param gi:
     :param workflow_from_json:
     :param table_path: path where to save the versions file
-    :param tools_dict: list of tools used in the workflow
+    :param tools_dict: list of (tool_id, tool_version) already written to the versions file, which will be
+     appended to.
+    :param tool_cache: optional ToolMetadataCache
+    :param workers: number of tools to retrieve concurrently
     :return:
     """
-    # remove file if exists already; but not in recursive case
-    if os.path.exists(table_path) and not tools_dict:
-        os.remove(table_path)
-
-    with open(file=table_path, mode="a") as f:
-        # write header only if file is empty
-        if os.stat(table_path).st_size == 0:
-            f.write("\t".join(["Analysis", "Software", "Version", "Citation"])+"\n")
-
-        for key, step in sorted(workflow_from_json['steps'].items(), reverse=True):
-            # parse sub-workflows recursively
-            if "subworkflow" in step.keys():
-                subworkflow = step['subworkflow']
-                produce_versions_file(gi, subworkflow, table_path, tools_dict)
-                # subworkflows don't have meaningful tool ids
-                continue
-            # Input steps won't have tool ids, and we only need each tool once.
-            if step['tool_id'] is not None and step['tool_id'] not in tools_dict:
-                tool = gi.tools.show_tool(step['tool_id'])
-                label = step['label'] if step['label'] is not None else tool['name']
-                url = ""
-                if 'tool_shed_repository' in tool and tool['tool_shed_repository'] is not None:
-                    ts_meta = tool['tool_shed_repository']
-                    url = "https://{}/view/{}/{}/{}".format(ts_meta['tool_shed'], ts_meta['owner'], ts_meta['name'],
-                                                            ts_meta['changeset_revision'])
-                f.write("\t".join([label, tool['name'], tool['version'], url])+"\n")
-                tools_dict.append(step['tool_id'])
-
-
-class ExecutionState(object):
-
-    wf_from_file = None
-    datamap = None
-    params = None
-    results = None
-    input_history = None
-
-    def __init__(self, path):
-        self.path = path
-
-    @staticmethod
-    def start(path):
-        if os.path.isfile(path):
-            try:
-                with open(path, mode='rb') as d:
-                    es = pickle.load(d)
-                    if type(es) is ExecutionState:
-                        return es
-                    else:
-                        logging.warning("The provided file {} does not have an ExecutionState object serialised".format(path))
-            except Exception:
-                logging.warning("Could not read serialized file {}.".format(path))
-        return ExecutionState(path)
-
-    def save_state(self):
-        with open(self.path, mode='wb') as d:
-            pickle.dump(self, d)
-            
+    from concurrent.futures import ThreadPoolExecutor
+
+    from .cache import ToolMetadataCache
+
+    append = bool(tools_dict)
+    if tools_dict is None:
+        tools_dict = []
+    steps = _tool_steps(workflow_from_json, tools_dict)
+
+    keys = [ToolMetadataCache.key(tool_id, tool_version) for tool_id, tool_version, label in steps]
+    tools = tool_cache.get_many(gi, keys) if tool_cache is not None else {}
+    missing = {key: (tool_id, tool_version) for key, (tool_id, tool_version, label) in zip(keys, steps)
+               if key not in tools}
+    if missing:
+        with ThreadPoolExecutor(max_workers=max(1, min(workers, len(missing)))) as executor:
+            fetched = dict(zip(missing, executor.map(lambda tool: _show_tool(gi, *tool), missing.values())))
+        tools.update(fetched)
+        if tool_cache is not None:
+            tool_cache.put_many(gi, fetched)
+
+    lines = [] if append else ["\t".join(["Analysis", "Software", "Version", "Citation"])]
+    for key, (tool_id, tool_version, step_label) in zip(keys, steps):
+        tool = tools[key]
+        label = step_label if step_label is not None else tool['name']
+        url = ""
+        if 'tool_shed_repository' in tool and tool['tool_shed_repository'] is not None:
+            ts_meta = tool['tool_shed_repository']
+            url = "https://{}/view/{}/{}/{}".format(ts_meta['tool_shed'], ts_meta['owner'], ts_meta['name'],
+                                                    ts_meta['changeset_revision'])
+        lines.append("\t".join([label, tool['name'], tool['version'], url]))
+
+    with open(file=table_path, mode="a" if append else "w") as f:
+        f.write("".join(line + "\n" for line in lines))
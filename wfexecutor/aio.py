@@ -0,0 +1,51 @@
+import asyncio
+
+from concurrent.futures import ThreadPoolExecutor
+
+
+async def call(func, *args, **kwargs):
+    """
+    Runs a blocking call, like any bioblend request, in a worker thread so that the event loop can go on with
+    other work meanwhile.
+
+    :param func: callable to run
+    :return: the result of the call
+    """
+    return await asyncio.to_thread(func, *args, **kwargs)
+
+
+async def map_in_threads(func, items, workers):
+    """
+    Applies a blocking callable to each item using at most `workers` threads, returning the results in the
+    order of the items. If any call fails, calls not yet started are cancelled and the first error is raised.
+
+    :param func: callable receiving a single item
+    :param items: iterable of items
+    :param workers: maximum number of concurrent calls
+    :return: list of results
+    """
+    items = list(items)
+    if not items:
+        return []
+    loop = asyncio.get_running_loop()
+    executor = ThreadPoolExecutor(max_workers=max(1, min(workers, len(items))))
+    futures = [loop.run_in_executor(executor, func, item) for item in items]
+    try:
+        return await asyncio.gather(*futures)
+    except BaseException:
+        for future in futures:
+            future.cancel()
+        raise
+    finally:
+        executor.shutdown(wait=False)
+
+
+def run(coroutine):
+    """
+    Runs a coroutine of the asynchronous core to completion from synchronous code. It can't be used while an
+    event loop is already running in the same thread, where the coroutine should be awaited instead.
+
+    :param coroutine: coroutine object
+    :return: the result of the coroutine
+    """
+    return asyncio.run(coroutine)
@@ -0,0 +1,373 @@
+import asyncio
+import logging
+import os
+import shutil
+import time
+
+from collections.abc import Mapping
+
+from bioblend import ConnectionError
+
+from . import (
+    aio,
+    completion_state_async,
+    download_results_async,
+    get_workflow_from_file,
+    get_workflow_id,
+    load_input_files_async,
+    process_allowed_errors,
+    produce_versions_file,
+    read_json_file,
+    read_yaml_file,
+    set_params,
+    validate_allowed_errors,
+    validate_file_exists,
+    validate_input_labels,
+    validate_labels,
+)
+from .cache import MetadataCache
+from .polling import PollingPolicy
+from .progress import InvocationProgress
+from .state import ExecutionState
+
+STATE_FILE_NAME = 'exec_state.journal'
+SUMMARY_FILE_NAME = 'batch_summary.tsv'
+VERSIONS_FILE_NAME = 'software_versions_galaxy.txt'
+HISTORIES_TO_CHECK_NAME = 'histories_to_check.txt'
+MANIFEST_KEYS = ('history', 'inputs', 'parameters', 'output_dir')
+
+
+class BatchRun(object):
+    """
+    A single run within a batch: the inputs, parameters and history name it uses, the directory where its
+    results and execution state are kept, and how it ended. Exit statuses are those of run_galaxy_workflow.py.
+    """
+
+    def __init__(self, history_name, inputs, params, output_dir):
+        self.history_name = history_name
+        self.inputs = inputs
+        self.params = params
+        self.output_dir = output_dir
+        self.state_path = os.path.join(output_dir, STATE_FILE_NAME)
+        self.state = None
+        self.allowed_error_states = None
+        self.invocation_scheduled = False
+        self.progress = None
+        self.checked_errors = set()
+        self.cache = MetadataCache()
+        self.finished = None
+        self.exit_code = None
+        self.message = ''
+        self.elapsed = 0.0
+
+
+def read_batch_manifest(manifest_path, output_dir):
+    """
+    Reads the YAML manifest of a batch, which is a list of runs, each with the name of the history to create
+    and the inputs YAML to use, and optionally a parameters file (YAML if named .yaml or .yml, JSON otherwise)
+    and an output directory, by default a directory named after the history within output_dir:
+
+    - history: sample_1
+      inputs: sample_1/inputs.yaml
+      parameters: sample_1/parameters.json
+      output_dir: results/sample_1
+
+    Results of batch runs are always downloaded, so exporting them to a data library is not supported.
+
+    :param manifest_path: path to the manifest YAML file
+    :param output_dir: directory under which runs without output_dir get their own directory
+    :return: list of BatchRun objects
+    """
+    entries = read_yaml_file(manifest_path)
+    if not isinstance(entries, list) or not entries:
+        raise ValueError("Batch manifest {} should be a non empty list of runs".format(manifest_path))
+    runs = []
+    output_dirs = set()
+    for number, entry in enumerate(entries, start=1):
+        if not isinstance(entry, Mapping) or 'history' not in entry or 'inputs' not in entry:
+            raise ValueError("Run {} in batch manifest {} needs at least history and inputs"
+                             .format(number, manifest_path))
+        unknown = sorted(set(entry) - set(MANIFEST_KEYS))
+        if unknown:
+            raise ValueError("Run {} in batch manifest {} has unsupported keys {}, runs accept {} (results are "
+                             "downloaded, there is no export to a data library in batches)"
+                             .format(number, manifest_path, ', '.join(unknown), ', '.join(MANIFEST_KEYS)))
+        params = {}
+        if entry.get('parameters'):
+            params = read_yaml_file(entry['parameters']) \
+                if entry['parameters'].endswith(('.yaml', '.yml')) else read_json_file(entry['parameters'])
+        run_output_dir = entry.get('output_dir') or os.path.join(output_dir, entry['history'])
+        if os.path.abspath(run_output_dir) in output_dirs:
+            raise ValueError("Run {} in batch manifest {} uses the same output directory {} as another run"
+                             .format(number, manifest_path, run_output_dir))
+        output_dirs.add(os.path.abspath(run_output_dir))
+        runs.append(BatchRun(entry['history'], read_yaml_file(entry['inputs']), params or {}, run_output_dir))
+    return runs
+
+
+class BatchRunner(object):
+    """
+    Executes many runs of the same workflow with a single connection to the Galaxy instance. The workflow is
+    imported once, at most max_concurrent_runs runs are in progress at any time, and the invocations of all
+    of them are polled from a single scheduler loop, so that the number of requests doesn't grow with the
+    time each run is waiting. Each run keeps its own output directory, execution state and exit status, so
+    that an interrupted batch can be executed again to resume the runs that didn't finish.
+    """
+
+    def __init__(self, gi, workflow_file, runs, output_dir, allowed_errors=None, max_concurrent_runs=4,
+                 upload_workers=4, download_workers=4, retrieval_mode='http', collection_archives=False,
+                 polling=None, keep_histories=False, keep_workflow=False, reuse_workflow=False, workflow_index=None,
+                 upload_cache=None, tool_cache=None, resumable_uploads=False):
+        self.gi = gi
+        self.workflow_file = workflow_file
+        self.runs = runs
+        self.output_dir = output_dir
+        self.allowed_errors = allowed_errors
+        self.max_concurrent_runs = max(1, max_concurrent_runs)
+        self.upload_workers = upload_workers
+        self.download_workers = download_workers
+        self.retrieval_mode = retrieval_mode
+        self.collection_archives = collection_archives
+        self.polling = polling if polling is not None else PollingPolicy()
+        self.keep_histories = keep_histories
+        self.keep_workflow = keep_workflow
+        self.reuse_workflow = reuse_workflow
+        self.workflow_index = workflow_index
+        self.upload_cache = upload_cache
+        self.tool_cache = tool_cache
+        self.resumable_uploads = resumable_uploads
+        self.wf_from_json = read_json_file(workflow_file)
+        self.workflow_id = None
+        self.show_wf = None
+        self.active = []
+
+    def validate(self):
+        """
+        Checks the allowed errors, and the inputs and parameters of every run, against the workflow before
+        talking to Galaxy, moving simple parameters to the inputs as done for single runs.
+        """
+        if self.allowed_errors is not None:
+            validate_allowed_errors(self.allowed_errors, self.wf_from_json)
+        for run in self.runs:
+            for pk in [pk for pk, pv in run.params.items() if not isinstance(pv, Mapping)]:
+                run.inputs[pk] = run.params.pop(pk)
+            try:
+                validate_labels(self.wf_from_json, run.params)
+                if validate_input_labels(wf_json=self.wf_from_json, inputs=run.inputs) > 0:
+                    validate_file_exists(run.inputs)
+            except ValueError as e:
+                raise ValueError("Run for history {}: {}".format(run.history_name, e))
+
+    async def run(self):
+        """
+        Executes all the runs of the batch.
+
+        :return: list of runs, with their exit_code set.
+        """
+        self.validate()
+        os.makedirs(self.output_dir, exist_ok=True)
+        workflow = await aio.call(get_workflow_from_file, self.gi, workflow_file=self.workflow_file,
+                                  reuse=self.reuse_workflow, index_path=self.workflow_index)
+        self.workflow_id = get_workflow_id(wf=workflow)
+        self.show_wf = await aio.call(self.gi.workflows.show_workflow, self.workflow_id)
+        await aio.call(produce_versions_file, gi=self.gi, workflow_from_json=self.wf_from_json,
+                       table_path=os.path.join(self.output_dir, VERSIONS_FILE_NAME), tool_cache=self.tool_cache)
+
+        slots = asyncio.Semaphore(self.max_concurrent_runs)
+        all_runs = asyncio.ensure_future(asyncio.gather(*[self._execute(run, slots) for run in self.runs]))
+        while not all_runs.done():
+            await self.polling.wait_async(until=all_runs)
+            if self.active:
+                observed = await asyncio.gather(*[self._check(run) for run in list(self.active)])
+                self.polling.observe(observed)
+        await all_runs
+        self.polling.log_summary()
+
+        # runs that only failed to delete their histories don't need the workflow to finish their clean up
+        if all(run.exit_code in (0, 3) for run in self.runs) and not self.keep_workflow and not self.reuse_workflow:
+            logging.info('Deleting workflow...')
+            try:
+                await aio.call(self.gi.workflows.delete_workflow, workflow_id=self.workflow_id)
+            except ConnectionError:
+                logging.error('Connection was interrupted while trying to delete the workflow, '
+                              'although this probably succeeded at the server... ignoring.')
+        self.write_summary()
+        return self.runs
+
+    async def _execute(self, run, slots):
+        async with slots:
+            start = time.monotonic()
+            try:
+                run.exit_code = await self._execute_run(run)
+            except Exception as e:
+                logging.error("Run for history {} failed due to {}".format(run.history_name, str(e)))
+                run.exit_code = 1
+                run.message = str(e)
+            finally:
+                if run in self.active:
+                    self.active.remove(run)
+            run.elapsed = time.monotonic() - start
+            logging.info("Run for history {} finished with exit status {}".format(run.history_name, run.exit_code))
+
+    async def _execute_run(self, run):
+        gi = self.gi
+        os.makedirs(run.output_dir, exist_ok=True)
+        run.state = state = ExecutionState.start(path=run.state_path)
+        run.allowed_error_states = process_allowed_errors(self.allowed_errors, self.wf_from_json) \
+            if self.allowed_errors is not None else {'tools': {}, 'datasets': set()}
+        num_inputs = validate_input_labels(wf_json=self.wf_from_json, inputs=run.inputs)
+
+        if state.input_history is None and num_inputs > 0:
+            logging.info('Create new history {} to run workflow ...'.format(run.history_name))
+            state.input_history = await aio.call(gi.histories.create_history, name=run.history_name)
+            state.save_state()
+        if state.datamap is None:
+            logging.info('Uploading datasets to history {} ...'.format(run.history_name))
+            datamap = {}
+            if num_inputs > 0:
+                datamap = await load_input_files_async(gi, inputs=run.inputs, workflow=self.show_wf,
+                                                       history=state.input_history,
+                                                       upload_cache=self.upload_cache,
+                                                       workers=self.upload_workers, state=state,
+                                                       resumable=self.resumable_uploads)
+            state.datamap = datamap
+            state.params = set_params(self.wf_from_json, run.params)
+            state.save_state()
+        if state.results is None:
+            logging.info('Running workflow {} for history {}...'.format(self.show_wf['name'], run.history_name))
+            state.results = await aio.call(gi.workflows.invoke_workflow,
+                                           workflow_id=self.workflow_id,
+                                           inputs=state.datamap,
+                                           params=state.params,
+                                           history_name=(run.history_name + '_results'))
+            state.save_state()
+        else:
+            logging.info("Invocation result present in state of {}, resuming that invocation"
+                         .format(run.history_name))
+        shutil.copyfile(os.path.join(self.output_dir, VERSIONS_FILE_NAME),
+                        os.path.join(run.output_dir, VERSIONS_FILE_NAME))
+
+        if not state.is_done('results_retrieved'):
+            run.finished = asyncio.get_running_loop().create_future()
+            self.active.append(run)
+            self.polling.reset()
+            exit_code = await run.finished
+            if exit_code != 0:
+                return exit_code
+            logging.info('Downloading results of {} ...'.format(run.history_name))
+            await download_results_async(gi, history_id=state.results['history_id'], output_dir=run.output_dir,
+                                         allowed_error_states=run.allowed_error_states, use_names=True,
+                                         workers=self.download_workers, state=state,
+                                         retrieval_mode=self.retrieval_mode,
+                                         collection_archives=self.collection_archives)
+            run.cache.log_stats()
+            state.record_action('results_retrieved')
+
+        if not self.keep_histories:
+            try:
+                if not state.is_done('delete_results_history'):
+                    await aio.call(gi.histories.delete_history, state.results['history_id'], purge=True)
+                    state.record_action('delete_results_history')
+                if num_inputs > 0 and not state.is_done('delete_input_history'):
+                    await aio.call(gi.histories.delete_history, state.input_history['id'], purge=True)
+                    state.record_action('delete_input_history')
+            except ConnectionError:
+                # as for single runs, results were retrieved and the histories were probably deleted by the
+                # server anyway, and the state file is kept so that running the batch again retries the clean up
+                hist_to_check_path = os.path.join(run.output_dir, HISTORIES_TO_CHECK_NAME)
+                logging.error('Connection was interrupted while trying to delete the histories of {}, adding them '
+                              'to {} to be checked.'.format(run.history_name, hist_to_check_path))
+                with open(hist_to_check_path, mode='w') as f:
+                    for history_id in [state.results['history_id']] + \
+                            ([state.input_history['id']] if num_inputs > 0 else []):
+                        f.write(str(history_id) + "\n")
+                run.message = "Histories could not be deleted, see {}".format(hist_to_check_path)
+                return 3
+        os.unlink(run.state_path)
+        return 0
+
+    def _finish(self, run, exit_code, message=''):
+        run.message = message
+        if run in self.active:
+            self.active.remove(run)
+        if not run.finished.done():
+            run.finished.set_result(exit_code)
+
+    async def _check(self, run):
+        """
+        Polls the invocation of a run and, once it is scheduled, its progress (see InvocationProgress), finishing
+        the run when it reaches a terminal state.
+
+        :return: representation of the state seen, for the polling policy.
+        """
+        results = run.state.results
+        try:
+            if not run.invocation_scheduled:
+                invocation = await aio.call(self.gi.workflows.show_invocation, workflow_id=results['workflow_id'],
+                                            invocation_id=results['id'])
+                if invocation['state'] == 'cancelled':
+                    self._finish(run, 4, "Invocation {} was cancelled".format(results['id']))
+                elif invocation['state'] == 'failed':
+                    self._finish(run, 5, "Invocation {} failed".format(results['id']))
+                if invocation['state'] != 'scheduled':
+                    return invocation['state'], len(invocation.get('steps', []))
+                run.invocation_scheduled = True
+            if run.progress is None:
+                run.progress = InvocationProgress(self.gi, invocation_id=results['id'],
+                                                  history_id=results['history_id'])
+            results_hid = await aio.call(run.progress.poll)
+            error_state, finalized_state = await completion_state_async(self.gi, results_hid,
+                                                                        run.allowed_error_states,
+                                                                        checked_errors=run.checked_errors,
+                                                                        cache=run.cache)
+        except Exception as e:
+            if run.finished is not None and not run.finished.done():
+                if run in self.active:
+                    self.active.remove(run)
+                run.finished.set_exception(e)
+            return None
+        if error_state:
+            self._finish(run, 1, "Execution failed, see {}/histories/view?id={}"
+                         .format(self.gi.base_url, results_hid['id']))
+        elif finalized_state:
+            self._finish(run, 0)
+        return run.progress.observed()
+
+    def write_summary(self):
+        """
+        Logs the outcome of each run and writes it to a tab separated file in the output directory.
+        """
+        lines = ["\t".join(["History", "Exit status", "Seconds", "Output directory", "Message"])]
+        for run in self.runs:
+            lines.append("\t".join([run.history_name, str(run.exit_code), "{:.0f}".format(run.elapsed),
+                                    run.output_dir, run.message]))
+        with open(os.path.join(self.output_dir, SUMMARY_FILE_NAME), mode='w') as f:
+            f.write("".join(line + "\n" for line in lines))
+        succeeded = len([run for run in self.runs if run.exit_code == 0])
+        logging.info("Batch finished, {} of {} runs succeeded:".format(succeeded, len(self.runs)))
+        for line in lines:
+            logging.info(line)
+
+
+def batch_exit_code(runs):
+    """
+    Exit status of a batch: 0 if all runs succeeded, 3 if the others only failed to delete their histories after
+    retrieving results, and 1 otherwise.
+
+    :param runs: runs of the batch, with their exit_code set.
+    :return: exit status
+    """
+    if all(run.exit_code == 0 for run in runs):
+        return 0
+    if all(run.exit_code in (0, 3) for run in runs):
+        return 3
+    return 1
+
+
+def run_batch(*args, **kwargs):
+    """
+    Synchronous version of BatchRunner.run, taking the same arguments as BatchRunner.
+
+    :return: list of runs, with their exit_code set.
+    """
+    return aio.run(BatchRunner(*args, **kwargs).run())
@@ -0,0 +1,236 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+from bioblend import ConnectionError
+
+from .metrics import record_bytes
+
+# States after which datasets, jobs and histories don't change any more for our purposes. Errored datasets, and
+# the histories holding them, go back to running when their job is resubmitted, and deferred datasets are
+# materialised later, so those states are not cached.
+DATASET_TERMINAL_STATES = {'ok', 'failed_metadata', 'discarded'}
+JOB_TERMINAL_STATES = {'ok', 'error', 'failed', 'deleted', 'stopped', 'skipped'}
+HISTORY_TERMINAL_STATES = {'ok', 'failed_metadata'}
+
+
+class MetadataCache(object):
+    """
+    Run scoped cache of dataset, job and history metadata retrieved from Galaxy. Objects in a terminal
+    state are considered immutable and kept, objects in any other state are never served from the cache,
+    so that callers always see their progress. Safe to share among threads.
+    """
+
+    def __init__(self):
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def _get(self, kind, object_id, fetch, terminal_states, refresh):
+        key = (kind, object_id)
+        with self.lock:
+            if not refresh and key in self.entries:
+                self.hits += 1
+                return self.entries[key]
+            self.misses += 1
+        obj = fetch(object_id)
+        with self.lock:
+            if isinstance(obj, dict) and obj.get('state') in terminal_states:
+                self.entries[key] = obj
+            else:
+                self.entries.pop(key, None)
+        return obj
+
+    def show_dataset(self, gi, dataset_id, refresh=False):
+        """
+        Returns the dataset as given by gi.datasets.show_dataset.
+
+        :param gi: galaxy instance object
+        :param dataset_id: identifier of the history dataset.
+        :param refresh: retrieve the dataset from Galaxy even if it is cached.
+        :return: dataset dictionary
+        """
+        return self._get('dataset', dataset_id, gi.datasets.show_dataset, DATASET_TERMINAL_STATES, refresh)
+
+    def show_job(self, gi, job_id, refresh=False):
+        return self._get('job', job_id, gi.jobs.show_job, JOB_TERMINAL_STATES, refresh)
+
+    def show_history(self, gi, history_id, refresh=False):
+        return self._get('history', history_id, gi.histories.show_history, HISTORY_TERMINAL_STATES, refresh)
+
+    def log_stats(self):
+        logging.info("Metadata cache: {} hits, {} misses, {} entries."
+                     .format(self.hits, self.misses, len(self.entries)))
+
+
+class JsonFileIndex(object):
+    """
+    Small persistent key-value store kept as a JSON file, with one section per Galaxy instance. Every write
+    re-reads the file and replaces it atomically, so that concurrent executors sharing the file don't corrupt
+    it; at worst one of them loses an entry and needs to compute it again.
+    """
+
+    def __init__(self, path):
+        self.path = os.path.expanduser(path)
+
+    def _read(self):
+        if not os.path.isfile(self.path):
+            return {}
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except ValueError:
+            logging.warning("Index file {} could not be parsed, starting a new one.".format(self.path))
+            return {}
+
+    def _write(self, data):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = "{}.{}.{}.tmp".format(self.path, os.getpid(), threading.get_ident())
+        with open(tmp_path, mode='w') as f:
+            json.dump(data, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+    def section(self, section):
+        return self._read().get(section, {})
+
+    def get(self, section, key):
+        return self.section(section).get(key)
+
+    def put(self, section, key, value):
+        self.put_many(section, {key: value})
+
+    def put_many(self, section, values):
+        data = self._read()
+        data.setdefault(section, {}).update(values)
+        self._write(data)
+
+    def remove(self, section, key):
+        data = self._read()
+        if key in data.get(section, {}):
+            del data[section][key]
+            self._write(data)
+
+
+def file_digest(path, chunk_size=1024 * 1024):
+    """
+    Computes the SHA-256 digest of a file reading it in chunks, so that memory use doesn't depend on its size.
+
+    :param path: path to the local file
+    :param chunk_size: number of bytes to read at a time
+    :return: hexadecimal digest
+    """
+    sha = hashlib.sha256()
+    with open(path, mode='rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+class UploadCache(object):
+    """
+    Avoids uploading again local files that were already uploaded to the Galaxy instance. Files are uploaded
+    to a dedicated history that is never deleted by the executor, and an index maps the digest of each file
+    content and its datatype to the resulting dataset. A dataset is only reused if it still exists and is in
+    'ok' state.
+    """
+
+    def __init__(self, index_path, history_name='wfexecutor_upload_cache'):
+        self.index = JsonFileIndex(index_path)
+        self.history_name = history_name
+        self.history_id = None
+        self.lock = threading.Lock()
+
+    def _cache_history_id(self, gi):
+        with self.lock:
+            if self.history_id is None:
+                histories = gi.histories.get_histories(name=self.history_name)
+                if histories:
+                    self.history_id = histories[0]['id']
+                else:
+                    self.history_id = gi.histories.create_history(name=self.history_name)['id']
+            return self.history_id
+
+    def _reusable(self, gi, dataset_id):
+        try:
+            dataset = gi.datasets.show_dataset(dataset_id)
+        except ConnectionError:
+            return False
+        return (dataset.get('state') == 'ok' and not dataset.get('deleted', False)
+                and not dataset.get('purged', False))
+
+    def upload(self, gi, path, file_name, file_type):
+        """
+        Returns the id of a dataset with the content of the local file given, uploading it only if there is
+        no usable copy on the instance already.
+
+        :param gi: galaxy instance object
+        :param path: path to the local file
+        :param file_name: name for the dataset, if it needs to be uploaded
+        :param file_type: Galaxy datatype for the dataset
+        :return: dataset id
+        """
+        key = "{}:{}".format(file_digest(path), file_type)
+        dataset_id = self.index.get(gi.base_url, key)
+        if dataset_id is not None:
+            if self._reusable(gi, dataset_id):
+                logging.info("Reusing dataset {} already uploaded for {}".format(dataset_id, path))
+                return dataset_id
+            logging.info("Dataset {} cached for {} is not available any more".format(dataset_id, path))
+            self.index.remove(gi.base_url, key)
+        upload_res = gi.tools.upload_file(path=path, history_id=self._cache_history_id(gi),
+                                          file_name=file_name, file_type=file_type)
+        record_bytes(gi, 'upload', os.path.getsize(path))
+        dataset_id = upload_res['outputs'][0]['id']
+        self.index.put(gi.base_url, key, dataset_id)
+        return dataset_id
+
+
+class ToolMetadataCache(object):
+    """
+    Keeps the tool metadata needed for the software versions file on disk, per Galaxy instance and tool id and
+    version, so that runs of the same workflows don't need to ask the instance about every tool each time.
+    Entries older than ttl seconds are retrieved again.
+    """
+
+    def __init__(self, path, ttl=7 * 24 * 3600):
+        self.index = JsonFileIndex(path)
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(tool_id, tool_version=None):
+        return "{}/{}".format(tool_id, tool_version) if tool_version else tool_id
+
+    def get_many(self, gi, keys):
+        """
+        Returns the cached tools that haven't expired.
+
+        :param gi: galaxy instance object
+        :param keys: keys produced by ToolMetadataCache.key
+        :return: dictionary from key to tool metadata
+        """
+        section = self.index.section(gi.base_url)
+        now = time.time()
+        found = {}
+        for key in keys:
+            entry = section.get(key)
+            if entry is not None and now - entry['fetched'] < self.ttl:
+                found[key] = entry['tool']
+        self.hits += len(found)
+        self.misses += len(set(keys)) - len(found)
+        return found
+
+    def put_many(self, gi, tools):
+        now = time.time()
+        self.index.put_many(gi.base_url, {key: {'fetched': now,
+                                                'tool': {field: tool.get(field)
+                                                         for field in ('id', 'name', 'version',
+                                                                       'tool_shed_repository')}}
+                                          for key, tool in tools.items()})
@@ -0,0 +1,58 @@
+"""
+Fakes shared by the test modules. The Galaxy fakes of the modules derive from FakeGalaxy and only add the
+clients and requests their scenario needs.
+"""
+import json
+
+import pytest
+
+
+class FakeGalaxy(object):
+    """
+    GalaxyInstance attributes read by the package, for a Galaxy server at http://galaxy.test.
+    """
+    base_url = 'http://galaxy.test'
+    url = 'http://galaxy.test/api'
+    key = 'key'
+    json_headers = {'x-api-key': 'key'}
+    timeout = None
+    verify = True
+
+
+class FakeResponse(object):
+    """
+    Response to a make_*_request call, with the given JSON content.
+    """
+    text = ''
+
+    def __init__(self, items=None, status_code=200, headers=None):
+        self.items = items
+        self.status_code = status_code
+        self.headers = headers or {}
+
+    @property
+    def content(self):
+        return json.dumps(self.items).encode()
+
+    def json(self):
+        return self.items
+
+
+class FakeClock(object):
+    """
+    Clock which only moves forward when slept on or when a test moves it.
+    """
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
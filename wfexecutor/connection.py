@@ -0,0 +1,94 @@
+import json
+
+import requests
+from bioblend import ConnectionError
+from bioblend.galaxy import GalaxyInstance
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+DEFAULT_CONNECT_TIMEOUT = 10
+DEFAULT_READ_TIMEOUT = 300
+DEFAULT_RETRIES = 3
+DEFAULT_RETRY_BACKOFF = 0.5
+
+
+def pooled_session(pool_size, retries=DEFAULT_RETRIES, backoff=DEFAULT_RETRY_BACKOFF):
+    """
+    Creates an HTTP session that keeps up to pool_size connections alive per host, so that concurrent
+    requests reuse established (TLS) connections instead of opening new ones. Idempotent requests that fail
+    to connect or to be read are retried with an exponential backoff, jittered with urllib3 2.0 or later.
+    Responses with an error status are left to the caller, see RateLimiter, which takes over these retries
+    when installed.
+
+    :param pool_size: maximum number of connections kept per host
+    :param retries: number of times an idempotent request is retried
+    :param backoff: base of the backoff, in seconds
+    :return: requests.Session
+    """
+    options = dict(total=retries, connect=retries, read=retries, status=0, redirect=False,
+                   allowed_methods=Retry.DEFAULT_ALLOWED_METHODS, backoff_factor=backoff, raise_on_status=False)
+    try:
+        retry = Retry(backoff_jitter=backoff, **options)
+    except TypeError:
+        # urllib3 before 2.0 has no jitter
+        retry = Retry(**options)
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(1, pool_size), max_retries=retry,
+                          pool_block=False)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def _decoded(r):
+    # Same handling of responses as bioblend for POST, PUT and PATCH requests.
+    if r.status_code == 200:
+        try:
+            return r.json()
+        except Exception as e:
+            raise ConnectionError(
+                "Request was successful, but cannot decode the response content: {}".format(e),
+                body=r.content,
+                status_code=r.status_code,
+            )
+    raise ConnectionError(
+        "Unexpected HTTP status code: {}".format(r.status_code),
+        body=r.text,
+        status_code=r.status_code,
+    )
+
+
+class PooledGalaxyInstance(GalaxyInstance):
+    """
+    GalaxyInstance that sends its requests through a shared pooled session instead of opening a new connection
+    for each of them. Requests with attached files, which bioblend encodes as multipart, are left to bioblend.
+    """
+
+    def __init__(self, url, key, session, timeout=None, verify=True):
+        super().__init__(url, key=key, verify=verify)
+        self.session = session
+        self.timeout = timeout
+
+    def make_get_request(self, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        kwargs.setdefault("verify", self.verify)
+        return self.session.get(url, headers=self.json_headers, **kwargs)
+
+    def _send(self, method, url, payload, params):
+        data = json.dumps(payload) if payload is not None else None
+        return self.session.request(method, url, params=params, data=data, headers=self.json_headers,
+                                    timeout=self.timeout, allow_redirects=False, verify=self.verify)
+
+    def make_post_request(self, url, payload=None, params=None, files_attached=False):
+        if files_attached:
+            return super().make_post_request(url, payload=payload, params=params, files_attached=files_attached)
+        return _decoded(self._send('POST', url, payload, params))
+
+    def make_put_request(self, url, payload=None, params=None):
+        return _decoded(self._send('PUT', url, payload, params))
+
+    def make_patch_request(self, url, payload=None, params=None):
+        return _decoded(self._send('PATCH', url, payload, params))
+
+    def make_delete_request(self, url, payload=None, params=None):
+        return self._send('DELETE', url, payload, params)
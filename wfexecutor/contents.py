@@ -0,0 +1,58 @@
+from bioblend import ConnectionError
+
+PAGE_SIZE = 500
+
+
+def _collection_elements(gi, collection_id):
+    # Generator, so that the collection is only retrieved when its elements are iterated.
+    yield from gi.dataset_collections.show_dataset_collection(collection_id)['elements']
+
+
+def iter_history_contents(gi, history_id, visible=True, page_size=PAGE_SIZE, filters=None, keys=None):
+    """
+    Walks the contents of a history page by page, instead of retrieving all of them, with every nested
+    collection element, in a single response. Items are dataset and collection summaries, with 'type' set to
+    'file' or 'collection' as in show_history(contents=True). The 'elements' of a collection are an iterator
+    that retrieves them only when iterated, one collection at a time. Dataset details, like file_name, have to
+    be retrieved separately when needed.
+
+    :param gi: galaxy instance object
+    :param history_id: ID of the history
+    :param visible: whether to list only visible (True) or hidden (False) contents, or all of them (None).
+    :param page_size: number of items requested at a time
+    :param filters: additional (attribute-operator, value) filters, like ('update_time-ge', '2024-05-01T10:00:00').
+    :param keys: comma separated attributes to retrieve for each item, instead of the default summary.
+    :return: generator of history items, in hid order.
+    """
+    url = "{}/histories/{}/contents".format(gi.url, history_id)
+    offset = 0
+    first_id = None
+    while True:
+        params = {'v': 'dev', 'limit': page_size, 'offset': offset, 'order': 'hid-asc', 'q': [], 'qv': []}
+        if visible is not None:
+            params.update({'q': ['visible'], 'qv': ['true' if visible else 'false'], 'visible': visible})
+        for attribute, value in filters or []:
+            params['q'].append(attribute)
+            params['qv'].append(value)
+        if keys is not None:
+            params['keys'] = keys
+        r = gi.make_get_request(url, params=params)
+        if r.status_code != 200:
+            raise ConnectionError("Unexpected HTTP status code: {}".format(r.status_code),
+                                  body=r.text, status_code=r.status_code)
+        page = r.json()
+        if offset > 0 and page and page[0]['id'] == first_id:
+            # the server ignored the offset, so the first page already had everything
+            return
+        for item in page:
+            if 'type' not in item:
+                item['type'] = 'file' if item.get('history_content_type') == 'dataset' else 'collection'
+            if item['type'] == 'collection' and 'elements' not in item:
+                item['elements'] = _collection_elements(gi, item['id'])
+            yield item
+        if len(page) != page_size:
+            # a short page is the last one, and a longer one means that the server doesn't paginate
+            return
+        if offset == 0:
+            first_id = page[0]['id']
+        offset += page_size
@@ -0,0 +1,727 @@
+import hashlib
+import json
+import logging
+import os
+import shlex
+import shutil
+import tarfile
+import tempfile
+import threading
+import time
+import zipfile
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import requests
+from bioblend import ConnectionError
+from bioblend.galaxy.datasets import DatasetStateException
+
+from . import aio
+from .contents import iter_history_contents
+from .metrics import record_bytes
+from .throttle import DOWNLOAD, limited
+
+
+class DownloadCancelled(Exception):
+    """
+    Raised in a download that was stopped because the run is failing.
+    """
+    pass
+
+
+def _is_allowed_failure(dataset, allowed_error_states):
+    return dataset['state'] == 'error' and dataset['id'] in allowed_error_states['datasets']
+
+
+def plan_downloads(datasets, output_dir, allowed_error_states, use_names=False, used_names=None, select=None):
+    """
+    Produces the ordered list of downloads needed for the history contents given. Target file names are
+    decided here, sequentially, so that name collision handling does not depend on the order in which
+    the downloads finish later.
+
+    :param datasets: iterable of history contents, as given by iter_history_contents.
+    :param output_dir: path to where result files should be written.
+    :param allowed_error_states: dictionary with elements known to be allowed to fail.
+    :param use_names: whether to trust or not the internal Galaxy name for the final file name
+    :param used_names: set of file names already taken, updated in place.
+    :param select: optional callable that receives each dataset object and returns whether it should be considered.
+    :return: list of download dictionaries with keys id, name, file_path and use_default_filename, and for
+     collection elements also collection_id, element_identifier, hid, and file_size and hashes as listed in
+     the collection, to check elements extracted from collection archives.
+    """
+    if used_names is None:
+        used_names = set()
+    downloads = []
+    for dataset in datasets:
+        if dataset['type'] == 'file':
+            elements = [(None, None, dataset)]
+        elif dataset['type'] == 'collection':
+            elements = [(dataset['id'], ds_in_coll.get('element_identifier'), ds_in_coll['object'])
+                        for ds_in_coll in dataset['elements']]
+        else:
+            continue
+        for collection_id, element_identifier, obj in elements:
+            if select is not None and not select(obj):
+                continue
+            if _is_allowed_failure(obj, allowed_error_states):
+                logging.info('Skipping download of failed {} as it is an allowed failure.'
+                             .format(obj['name']))
+                continue
+            if use_names and obj['name'] is not None and obj['name'] not in used_names:
+                download = {'id': obj['id'], 'name': obj['name'],
+                            'file_path': os.path.join(output_dir, obj['name']),
+                            'use_default_filename': False}
+                used_names.add(obj['name'])
+            else:
+                download = {'id': obj['id'], 'name': obj['name'],
+                            'file_path': output_dir,
+                            'use_default_filename': True}
+            if collection_id is not None:
+                download.update({'collection_id': collection_id, 'element_identifier': element_identifier,
+                                 'hid': obj.get('hid'), 'file_size': obj.get('file_size'),
+                                 'hashes': obj.get('hashes')})
+            downloads.append(download)
+    return downloads
+
+
+MANIFEST_NAME = '.wfexecutor_manifest.jsonl'
+# Manifest written by previous versions as a single JSON object, migrated when found.
+OLD_MANIFEST_NAME = '.wfexecutor_manifest.json'
+CHECKSUMS_NAME = '.wfexecutor_checksums.sha256'
+CHUNK_SIZE = 1024 * 1024
+
+
+class DownloadManifest(object):
+    """
+    Record of the downloads into an output directory, kept in a file within it. For each dataset id it holds
+    the target file name, the size expected from Galaxy and, once the download is complete, the SHA-256 of
+    the file. On a new attempt, complete files that still have the expected size are skipped and partial
+    ones are resumed. As the execution state, the file is a journal with one JSON record per line that
+    updates are appended to, compacted when opened, so that each update costs the same however many
+    datasets there are. Safe to share among threads.
+    """
+
+    def __init__(self, output_dir):
+        self.path = os.path.join(output_dir, MANIFEST_NAME)
+        self.lock = threading.Lock()
+        self.entries = {}
+        old_path = os.path.join(output_dir, OLD_MANIFEST_NAME)
+        if os.path.isfile(self.path):
+            self._replay()
+        elif os.path.isfile(old_path):
+            try:
+                with open(old_path) as f:
+                    self.entries = json.load(f)
+            except ValueError:
+                logging.warning("Download manifest {} could not be read, starting a new one.".format(old_path))
+        if self.entries:
+            self._rewrite()
+        if os.path.isfile(old_path):
+            os.remove(old_path)
+
+    def _replay(self):
+        with open(self.path) as f:
+            for line_number, line in enumerate(f, start=1):
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    logging.warning("Ignoring incomplete record in line {} of {}".format(line_number, self.path))
+                    continue
+                self.entries.setdefault(record.pop('id'), {}).update(record)
+
+    def _rewrite(self):
+        tmp_path = "{}.tmp".format(self.path)
+        with open(tmp_path, mode='w') as f:
+            for dataset_id, entry in sorted(self.entries.items()):
+                f.write(json.dumps(dict(entry, id=dataset_id), sort_keys=True) + "\n")
+        os.replace(tmp_path, self.path)
+
+    def get(self, dataset_id):
+        with self.lock:
+            return dict(self.entries.get(dataset_id, {}))
+
+    def write_checksums(self):
+        """
+        Writes the SHA-256 of every complete download into a sidecar file of the output directory, in the
+        format used by sha256sum, with paths relative to the output directory.
+        """
+        directory = os.path.dirname(self.path)
+        with self.lock:
+            lines = ["{}  {}\n".format(entry['sha256'], os.path.relpath(entry['file_path'], directory))
+                     for dataset_id, entry in sorted(self.entries.items(), key=lambda item: item[1]['file_path'])
+                     if entry.get('complete') and entry.get('sha256')]
+        with open(os.path.join(directory, CHECKSUMS_NAME), mode='w') as f:
+            f.write("".join(lines))
+
+    def update(self, dataset_id, **values):
+        record = json.dumps(dict(values, id=dataset_id), sort_keys=True) + "\n"
+        with self.lock:
+            self.entries.setdefault(dataset_id, {}).update(values)
+            with open(self.path, mode='a') as f:
+                f.write(record)
+
+
+def _filename_from_headers(headers, default):
+    # We expect tokens 'filename' '=' to be followed by the quoted filename, as bioblend does.
+    if 'content-disposition' in headers:
+        tokens = list(shlex.shlex(headers['content-disposition'], posix=True))
+        try:
+            return os.path.basename(tokens[tokens.index('filename') + 2])
+        except (ValueError, IndexError):
+            pass
+    return default
+
+
+def _local_size(path):
+    return os.path.getsize(path) if path is not None and os.path.isfile(path) else 0
+
+
+# Names used by Galaxy for dataset hashes, and their hashlib equivalents.
+GALAXY_HASH_FUNCTIONS = {'MD5': 'md5', 'SHA-1': 'sha1', 'SHA-256': 'sha256', 'SHA-512': 'sha512'}
+
+
+def _expected_hashes(dataset):
+    expected = {}
+    for dataset_hash in dataset.get('hashes') or []:
+        name = GALAXY_HASH_FUNCTIONS.get(dataset_hash.get('hash_function'))
+        if name is not None and dataset_hash.get('hash_value'):
+            expected[name] = dataset_hash['hash_value'].lower()
+    return expected
+
+
+def _verify(dataset, local_path, digests):
+    """
+    Compares a downloaded file against the hashes Galaxy holds for the dataset, or against its size when
+    Galaxy has no hashes for it.
+
+    :return: description of the mismatch, or None if the file is fine.
+    """
+    expected = _expected_hashes(dataset)
+    for name, value in expected.items():
+        if digests[name] != value:
+            return "{} is {} but Galaxy has {}".format(name, digests[name], value)
+    if not expected and dataset.get('file_size') is not None and _local_size(local_path) != dataset['file_size']:
+        return "size is {} but Galaxy has {}".format(_local_size(local_path), dataset['file_size'])
+    return None
+
+
+def _file_ext(dataset):
+    file_ext = dataset.get('file_ext')
+    # Resort to 'data' when Galaxy returns an empty or temporary extension
+    if not file_ext or file_ext == 'auto' or file_ext == '_sniff_':
+        file_ext = 'data'
+    return file_ext
+
+
+# Characters Galaxy keeps in the file names it gives to downloads, others are replaced by '_'.
+FILENAME_VALID_CHARS = '.,^_-()[]0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ '
+
+
+def _safe_name(name):
+    return ''.join(c if c in FILENAME_VALID_CHARS else '_' for c in name)[0:150]
+
+
+def _default_filename(dataset):
+    """
+    File name that Galaxy gives to a dataset downloaded through its display endpoint.
+    """
+    return "Galaxy{}-[{}].{}".format(dataset['hid'], _safe_name(dataset['name']), _file_ext(dataset))
+
+
+def _copy_file(source, target):
+    """
+    Copies a file within the kernel with copy_file_range, which shares the data blocks (reflink) on file systems
+    that support it, falling back to a regular copy.
+    """
+    try:
+        with open(source, mode='rb') as fsrc, open(target, mode='wb') as fdst:
+            remaining = os.fstat(fsrc.fileno()).st_size
+            while remaining > 0:
+                copied = os.copy_file_range(fsrc.fileno(), fdst.fileno(), remaining)
+                if copied == 0:
+                    break
+                remaining -= copied
+    except (AttributeError, OSError):
+        shutil.copyfile(source, target)
+
+
+def _link_file(source, target):
+    try:
+        os.link(source, target)
+    except OSError:
+        # hard links can't cross file systems, or might not be allowed. The file is copied then, as a symbolic link
+        # would point at a dataset that is purged along with the results history.
+        _copy_file(source, target)
+
+
+def retrieve_from_filesystem(dataset, download, manifest, mode):
+    """
+    Puts a dataset in the output directory straight from the Galaxy object store, when its server side path
+    is visible from here, by linking it (mode 'link', a hard link, or a copy across file systems) or
+    copying it in the kernel (mode 'copy'). Files are named as they would be when downloaded.
+
+    :param dataset: dataset object, with file_name holding its server side path.
+    :param download: download dictionary as produced by plan_downloads.
+    :param manifest: DownloadManifest for the output directory.
+    :param mode: 'link' or 'copy'
+    :return: the local path, or None if the dataset file is not visible and has to be downloaded instead.
+    """
+    source = dataset.get('file_name')
+    if not source or not os.path.isfile(source) or not os.access(source, os.R_OK):
+        return None
+    if dataset.get('file_size') is not None and os.path.getsize(source) != dataset['file_size']:
+        logging.warning('Server side file {} of {} does not have the size of the dataset, downloading it instead.'
+                        .format(source, download['name']))
+        return None
+    if download['use_default_filename']:
+        local_path = os.path.join(download['file_path'], _default_filename(dataset))
+    else:
+        local_path = download['file_path']
+    tmp_path = "{}.tmp".format(local_path)
+    if os.path.lexists(tmp_path):
+        os.remove(tmp_path)
+    if mode == 'link':
+        _link_file(source, tmp_path)
+    else:
+        _copy_file(source, tmp_path)
+    os.replace(tmp_path, local_path)
+    logging.info('{} {} from {}.'.format('Linked' if mode == 'link' else 'Copied', local_path, source))
+    manifest.update(download['id'], file_path=local_path, size=dataset.get('file_size'), complete=True)
+    return local_path
+
+
+def _transfer(gi, dataset, download, manifest, local_path, resume, cancelled=None):
+    """
+    Streams the dataset content to disk, computing its digests on the fly. The SHA-256 is always computed,
+    along with any other hash function Galaxy has a hash for. If the cancelled event is set, the transfer
+    stops at the next chunk, and the partial file is kept to be resumed later.
+
+    :return: tuple with the local path, the number of bytes transferred, a dictionary of hex digests and the
+     mismatch found by _verify, None if the file matches the dataset.
+    """
+    file_ext = _file_ext(dataset)
+    url = "{}{}?to_ext={}".format(gi.base_url, dataset['download_url'], file_ext)
+    headers = dict(gi.json_headers)
+    local_size = _local_size(local_path)
+    if resume:
+        headers['Range'] = 'bytes={}-'.format(local_size)
+    # use the pooled session of the instance if it has one, to reuse its connections
+    http = getattr(gi, 'session', requests)
+    hashers = {name: hashlib.new(name) for name in set(_expected_hashes(dataset)) | {'sha256'}}
+
+    def receive(r):
+        r.raise_for_status()
+        path = local_path
+        if path is None:
+            path = os.path.join(download['file_path'],
+                                _filename_from_headers(r.headers, "{}.{}".format(dataset['name'], file_ext)))
+        manifest.update(download['id'], file_path=path, size=dataset.get('file_size'), complete=False)
+        if resume and r.status_code == 206:
+            logging.info('Resuming download of {} at byte {}.'.format(download['name'], local_size))
+            mode = 'ab'
+            with open(path, mode='rb') as f:
+                for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                    for hasher in hashers.values():
+                        hasher.update(chunk)
+        else:
+            mode = 'wb'
+        transferred = 0
+        with open(path, mode=mode) as f:
+            for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
+                if cancelled is not None and cancelled.is_set():
+                    raise DownloadCancelled("Download of {} cancelled".format(download['name']))
+                if chunk:
+                    f.write(chunk)
+                    for hasher in hashers.values():
+                        hasher.update(chunk)
+                    transferred += len(chunk)
+        digests = {name: hasher.hexdigest() for name, hasher in hashers.items()}
+        return path, transferred, digests, _verify(dataset, path, digests)
+
+    # the body is read and checked within the request, so that it counts as in flight until it is done
+    return limited(gi, DOWNLOAD, lambda: http.get(url, headers=headers, stream=True, timeout=gi.timeout,
+                                                  verify=gi.verify),
+                   description="GET {}".format(url), consume=receive)
+
+
+def stream_dataset(gi, download, manifest, retries=1, retrieval_mode='http', cancelled=None):
+    """
+    Downloads a dataset to disk, skipping it if the manifest shows that it was already completely downloaded,
+    and resuming a previous partial download with an HTTP Range request when possible. Checksums are computed
+    while the content is written and compared against the hashes Galaxy holds for the dataset, or against its
+    size if there are none. Files that don't match are downloaded again from the start.
+
+    :param gi: galaxy instance object
+    :param download: download dictionary as produced by plan_downloads.
+    :param manifest: DownloadManifest for the output directory.
+    :param retries: number of times a file that fails verification is downloaded again.
+    :param retrieval_mode: 'http' to always download the dataset, 'link' or 'copy' to take it from the
+     server side path when visible, see retrieve_from_filesystem.
+    :param cancelled: optional threading.Event, set to stop the download, see _transfer.
+    :return: tuple with the local path and the number of bytes transferred.
+    """
+    dataset = gi.datasets.wait_for_dataset(download['id'], check=False)
+    if dataset['state'] != 'ok':
+        raise DatasetStateException("Dataset state is not 'ok'. Dataset id: {}, current state: {}"
+                                    .format(download['id'], dataset['state']))
+    expected_size = dataset.get('file_size')
+    entry = manifest.get(download['id'])
+    local_path = entry.get('file_path')
+    if not download['use_default_filename']:
+        local_path = download['file_path']
+
+    local_size = _local_size(local_path)
+    if entry.get('complete') and local_size == entry.get('size') and local_size == expected_size:
+        logging.info('Skipping {}, already downloaded to {}.'.format(download['name'], local_path))
+        return local_path, 0
+
+    if retrieval_mode != 'http':
+        retrieved_path = retrieve_from_filesystem(dataset, download, manifest, retrieval_mode)
+        if retrieved_path is not None:
+            return retrieved_path, 0
+
+    resume = entry.get('size') == expected_size and 0 < local_size < (expected_size or 0)
+    transferred = 0
+    for attempt in range(retries + 1):
+        local_path, attempt_transferred, digests, mismatch = _transfer(gi, dataset, download, manifest, local_path,
+                                                                       resume, cancelled)
+        transferred += attempt_transferred
+        if mismatch is None:
+            manifest.update(download['id'], size=_local_size(local_path), sha256=digests['sha256'], complete=True)
+            return local_path, transferred
+        logging.warning('Verification of {} failed on attempt {}: {}.'.format(local_path, attempt + 1, mismatch))
+        resume = False
+    raise ValueError("Downloaded file {} for dataset {} does not match the dataset in Galaxy: {}"
+                     .format(local_path, download['id'], mismatch))
+
+
+def _archive_element_identifier(member_name):
+    # Members are named <collection name>/<element identifier>.<extension>
+    path = member_name.split('/', 1)[1] if '/' in member_name else member_name
+    return path, os.path.splitext(path)[0]
+
+
+def _extract_member(source, local_path, download):
+    hashers = {name: hashlib.new(name) for name in set(_expected_hashes(download)) | {'sha256'}}
+    size = 0
+    tmp_path = "{}.tmp".format(local_path)
+    with open(tmp_path, mode='wb') as f:
+        for chunk in iter(lambda: source.read(CHUNK_SIZE), b''):
+            f.write(chunk)
+            for hasher in hashers.values():
+                hasher.update(chunk)
+            size += len(chunk)
+    os.replace(tmp_path, local_path)
+    return size, {name: hasher.hexdigest() for name, hasher in hashers.items()}
+
+
+def _archive_members(r, target_dir):
+    """
+    Iterates over the files of a collection archive as it arrives, yielding their names and file objects.
+    Tar archives are unpacked while they stream in. Zip archives can only be read once their central directory,
+    at the end, has arrived, so they are spooled to a temporary file in the target directory first.
+    """
+    is_zip = 'zip' in r.headers.get('content-type', '') or \
+        _filename_from_headers(r.headers, '').endswith('.zip')
+    if not is_zip:
+        r.raw.decode_content = True
+        with tarfile.open(fileobj=r.raw, mode='r|*') as archive:
+            for member in archive:
+                if member.isfile():
+                    yield member.name, archive.extractfile(member)
+        return
+    with tempfile.TemporaryFile(dir=target_dir) as spool:
+        for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
+            spool.write(chunk)
+        spool.seek(0)
+        with zipfile.ZipFile(spool) as archive:
+            for member in archive.infolist():
+                if not member.is_dir():
+                    with archive.open(member) as source:
+                        yield member.filename, source
+
+
+def download_collection_archive(gi, collection_id, downloads, manifest, state=None):
+    """
+    Downloads the elements of a collection with a single request for an archive of the whole collection,
+    writing each planned element to its target path as the archive is unpacked. Archive members for elements
+    that are not planned, like allowed failures, are ignored. Elements are checked as downloads are, against
+    the hashes or size listed for them in the collection, and those that don't match are left to be downloaded
+    one by one.
+
+    :param gi: galaxy instance object
+    :param collection_id: id of the history dataset collection
+    :param downloads: downloads planned for elements of the collection, as produced by plan_downloads.
+    :param manifest: DownloadManifest for the output directory.
+    :param state: optional ExecutionState, where extracted elements are recorded as downloaded.
+    :return: tuple with the number of bytes extracted and the list of planned downloads that were not found
+     in the archive, to be downloaded one by one.
+    """
+    by_identifier = {download['element_identifier']: download for download in downloads}
+    url = "{}/dataset_collections/{}/download".format(gi.url, collection_id)
+    http = getattr(gi, 'session', requests)
+    start = time.monotonic()
+    extracted = set()
+
+    def extract(r):
+        r.raise_for_status()
+        total_bytes = 0
+        for member_name, source in _archive_members(r, _target_dir(downloads[0])):
+            path, identifier = _archive_element_identifier(member_name)
+            download = by_identifier.get(path) or by_identifier.get(identifier)
+            if download is None or download['id'] in extracted:
+                continue
+            if download['use_default_filename']:
+                default_name = os.path.basename(member_name)
+                if download.get('hid') is not None:
+                    default_name = "Galaxy{}-[{}]{}".format(download['hid'], _safe_name(download['name']),
+                                                            os.path.splitext(member_name)[1])
+                local_path = os.path.join(download['file_path'], default_name)
+            else:
+                local_path = download['file_path']
+            size, digests = _extract_member(source, local_path, download)
+            total_bytes += size
+            mismatch = _verify(download, local_path, digests)
+            if mismatch is not None:
+                logging.warning('Element {} of collection {} in the archive is corrupted ({}), it will be downloaded '
+                                'on its own.'.format(download['name'], collection_id, mismatch))
+                os.remove(local_path)
+                continue
+            manifest.update(download['id'], file_path=local_path, size=size, sha256=digests['sha256'], complete=True)
+            if state is not None:
+                state.record_download(download['id'], local_path)
+            extracted.add(download['id'])
+        return total_bytes
+
+    # the archive is unpacked within the request, so that it counts as in flight until it is done
+    total_bytes = limited(gi, DOWNLOAD, lambda: http.get(url, headers=gi.json_headers, stream=True,
+                                                         timeout=gi.timeout, verify=gi.verify),
+                          description="GET {}".format(url), consume=extract)
+    elapsed = time.monotonic() - start
+    record_bytes(gi, 'download', total_bytes)
+    logging.info('Downloaded {} elements of collection {} in one archive ({} bytes) in {:.1f} s, {:.2f} MB/s.'
+                 .format(len(extracted), collection_id, total_bytes, elapsed, _mb_per_sec(total_bytes, elapsed)))
+    return total_bytes, [download for download in downloads if download['id'] not in extracted]
+
+
+def _download_collections(gi, downloads, manifests, state):
+    """
+    Downloads the planned elements of each collection as an archive, falling back to downloading them one by
+    one if the archive can't be retrieved.
+
+    :return: tuple with the number of bytes downloaded and the list of downloads still pending.
+    """
+    collections = {}
+    pending = []
+    for download in downloads:
+        manifest = manifests[_target_dir(download)]
+        if download.get('collection_id') is None or manifest.get(download['id']).get('complete'):
+            pending.append(download)
+        else:
+            collections.setdefault(download['collection_id'], []).append(download)
+    total_bytes = 0
+    for collection_id, elements in collections.items():
+        if len(elements) < 2:
+            pending.extend(elements)
+            continue
+        try:
+            size, missing = download_collection_archive(gi, collection_id, elements,
+                                                        manifests[_target_dir(elements[0])], state=state)
+        except (requests.exceptions.RequestException, ConnectionError, tarfile.TarError, zipfile.BadZipFile) as e:
+            logging.warning('Could not download collection {} as an archive, downloading its elements one by one: '
+                            '{}'.format(collection_id, e))
+            size, missing = 0, elements
+        total_bytes += size
+        pending.extend(missing)
+    return total_bytes, pending
+
+
+def _target_dir(download):
+    return download['file_path'] if download['use_default_filename'] else os.path.dirname(download['file_path'])
+
+
+def _download_one(gi, download, state, manifest, retrieval_mode='http', cancelled=None):
+    start = time.monotonic()
+    local_path, size = stream_dataset(gi, download, manifest, retrieval_mode=retrieval_mode, cancelled=cancelled)
+    elapsed = time.monotonic() - start
+    record_bytes(gi, 'download', size)
+    logging.info('Downloaded {} ({} bytes) in {:.1f} s, {:.2f} MB/s.'
+                 .format(download['name'], size, elapsed, _mb_per_sec(size, elapsed)))
+    if state is not None:
+        state.record_download(download['id'], local_path)
+    return size
+
+
+def _mb_per_sec(size, elapsed):
+    return size / (1024 * 1024) / elapsed if elapsed > 0 else 0.0
+
+
+def _skip_downloaded(downloads, state):
+    if state is None:
+        return downloads
+    pending = [download for download in downloads if not state.is_downloaded(download['id'])]
+    if len(pending) < len(downloads):
+        logging.info('Skipping {} datasets already downloaded in a previous attempt.'
+                     .format(len(downloads) - len(pending)))
+    return pending
+
+
+async def run_downloads_async(gi, downloads, workers=1, state=None, manifest=None, retrieval_mode='http',
+                              collection_archives=False):
+    """
+    Executes the downloads given using at most `workers` threads. If any download fails, downloads not yet
+    started are cancelled and the first error is raised. Once all are done, the SHA-256 of the downloaded
+    files is written to a checksums file in each output directory.
+
+    :param gi: galaxy instance object
+    :param downloads: list of downloads as produced by plan_downloads.
+    :param workers: maximum number of concurrent downloads.
+    :param state: optional ExecutionState, to skip datasets already downloaded and record new downloads.
+    :param manifest: DownloadManifest of the output directory, by default the one where each file goes.
+    :param retrieval_mode: one of RETRIEVAL_MODES, see stream_dataset.
+    :param collection_archives: whether to download the elements of each collection with a single request.
+    :return: total number of bytes downloaded.
+    """
+    downloads = _skip_downloaded(downloads, state)
+    manifests = {}
+    for download in downloads:
+        if _target_dir(download) not in manifests:
+            manifests[_target_dir(download)] = manifest or DownloadManifest(_target_dir(download))
+    start = time.monotonic()
+    pending = downloads
+    total_bytes = 0
+    if collection_archives and retrieval_mode == 'http':
+        total_bytes, pending = await aio.call(_download_collections, gi, downloads, manifests, state)
+    sizes = await aio.map_in_threads(
+        lambda download: _download_one(gi, download, state, manifests[_target_dir(download)], retrieval_mode),
+        pending, workers)
+    total_bytes += sum(sizes)
+    for directory_manifest in set(manifests.values()):
+        directory_manifest.write_checksums()
+    elapsed = time.monotonic() - start
+    logging.info('Downloaded {} files ({} bytes) in {:.1f} s with {} workers, {:.2f} MB/s overall.'
+                 .format(len(downloads), total_bytes, elapsed, workers, _mb_per_sec(total_bytes, elapsed)))
+    return total_bytes
+
+
+def run_downloads(gi, downloads, workers=1, state=None, manifest=None, retrieval_mode='http',
+                  collection_archives=False):
+    """
+    Synchronous version of run_downloads_async.
+
+    :return: total number of bytes downloaded.
+    """
+    return aio.run(run_downloads_async(gi, downloads, workers=workers, state=state, manifest=manifest,
+                                       retrieval_mode=retrieval_mode, collection_archives=collection_archives))
+
+
+class IncrementalDownloader(object):
+    """
+    Downloads datasets of a history in the background as they reach the 'ok' state, while the rest of the
+    workflow is still running. Names are assigned in the order datasets become ready, so when use_names is
+    set, collisions might be resolved differently than in a single download_results call at the end. With
+    collection_archives, elements of collections are held back until finish, and then downloaded with a single
+    request per collection.
+    """
+
+    def __init__(self, gi, history_id, output_dir, allowed_error_states, use_names=False, workers=1, state=None,
+                 retrieval_mode='http', collection_archives=False):
+        self.gi = gi
+        self.state = state
+        self.retrieval_mode = retrieval_mode
+        self.collection_archives = collection_archives and retrieval_mode == 'http'
+        self.history_id = history_id
+        self.output_dir = output_dir
+        self.allowed_error_states = allowed_error_states
+        self.use_names = use_names
+        self.workers = max(1, workers)
+        self.used_names = set()
+        self.submitted = set()
+        self.futures = []
+        self.collection_elements = []
+        self.archive_bytes = 0
+        self.cancelled = threading.Event()
+        self.last_ok_count = 0
+        self.start = time.monotonic()
+        self.manifest = DownloadManifest(output_dir)
+        self.executor = ThreadPoolExecutor(max_workers=self.workers)
+
+    def _download(self, download):
+        if self.cancelled.is_set():
+            return 0
+        return _download_one(self.gi, download, self.state, self.manifest, self.retrieval_mode,
+                             cancelled=self.cancelled)
+
+    def _submit(self, select, final=False):
+        downloads = plan_downloads(iter_history_contents(self.gi, self.history_id), self.output_dir,
+                                   self.allowed_error_states, use_names=self.use_names, used_names=self.used_names, select=select)
+        for download in downloads:
+            self.submitted.add(download['id'])
+        downloads = _skip_downloaded(downloads, self.state)
+        if self.collection_archives:
+            self.collection_elements.extend(download for download in downloads
+                                            if download.get('collection_id') is not None)
+            downloads = [download for download in downloads if download.get('collection_id') is None]
+            if final:
+                manifests = {_target_dir(download): self.manifest for download in self.collection_elements}
+                self.archive_bytes, missing = _download_collections(self.gi, self.collection_elements, manifests,
+                                                                    self.state)
+                downloads.extend(missing)
+        for download in downloads:
+            self.futures.append(self.executor.submit(self._download, download))
+        return len(downloads)
+
+    def _raise_failures(self):
+        for future in self.futures:
+            if future.done() and future.exception() is not None:
+                raise future.exception()
+
+    def poll(self, history):
+        """
+        Queues downloads for datasets that reached the 'ok' state since the last poll. History contents
+        are only retrieved when the count of 'ok' datasets in the history has changed.
+
+        :param history: history object as given by show_history, used for its state counts.
+        :return: number of downloads queued.
+        """
+        self._raise_failures()
+        ok_count = history['state_details'].get('ok', 0)
+        if ok_count == self.last_ok_count:
+            return 0
+        self.last_ok_count = ok_count
+        queued = self._submit(lambda obj: obj['state'] == 'ok' and obj['id'] not in self.submitted)
+        if queued > 0:
+            logging.info('Queued {} finished datasets for download while the workflow runs.'.format(queued))
+        return queued
+
+    def finish(self):
+        """
+        Queues every remaining dataset and waits for all downloads to finish.
+
+        :return: total number of bytes downloaded.
+        """
+        queued = self._submit(lambda obj: obj['id'] not in self.submitted, final=True)
+        logging.info('Downloading {} remaining datasets, {} were queued while the workflow ran.'
+                     .format(queued, len(self.submitted) - queued))
+        total_bytes = self.archive_bytes
+        try:
+            for future in as_completed(self.futures):
+                total_bytes += future.result()
+        finally:
+            self.close()
+        self.manifest.write_checksums()
+        elapsed = time.monotonic() - self.start
+        logging.info('Downloaded {} files ({} bytes) in {:.1f} s with {} workers, {:.2f} MB/s overall.'
+                     .format(len(self.futures), total_bytes, elapsed, self.workers, _mb_per_sec(total_bytes, elapsed)))
+        return total_bytes
+
+    def close(self):
+        self.executor.shutdown(wait=True, cancel_futures=True)
+
+    def cancel(self):
+        """
+        Stops the downloads when the run fails: queued downloads are dropped, and those in progress stop at their
+        next chunk, leaving partial files that a later run resumes.
+        """
+        self.cancelled.set()
+        self.executor.shutdown(wait=False, cancel_futures=True)
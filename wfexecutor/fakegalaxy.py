@@ -0,0 +1,650 @@
+"""
+In-process stand-in for a Galaxy server, implementing the parts of the API that the executor uses: histories and
+their contents, uploads (also through tus), workflows and their invocations, jobs, dataset downloads and data libraries. Jobs of an
+invocation go through the queued, running and ok (or error) states as time passes, every request can be given a
+latency, and dataset content is generated while it is sent, so that large datasets don't take memory. Meant for
+tests and benchmarks that can't reach a real Galaxy.
+
+    with FakeGalaxyServer(datasets=100, dataset_size=10 ** 6, job_seconds=1) as server:
+        gi = get_galaxy_instance({'url': server.url, 'key': 'fake'})
+"""
+import datetime
+import itertools
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from .metrics import endpoint_name
+
+CONTENT_CHUNK = b'ACGT' * 16384
+FILE_FIELD = b'name="files_0|file_data"'
+TUS_PATH = '/api/upload/resumable_upload'
+
+
+def _timestamp(seconds):
+    return datetime.datetime.fromtimestamp(seconds, datetime.timezone.utc).replace(tzinfo=None).isoformat(
+        timespec='microseconds')
+
+
+def _parse_time(value):
+    return datetime.datetime.fromisoformat(value.rstrip('Z'))
+
+
+class NotFound(Exception):
+    pass
+
+
+class FakeGalaxyServer(object):
+    """
+    Galaxy API served over HTTP on a local port, from a thread of the current process.
+
+    :param latency: seconds waited before answering each request.
+    :param datasets: number of datasets produced by each workflow invocation.
+    :param collection_elements: number of elements of a collection also produced by each invocation, if any.
+    :param dataset_size: size in bytes of each dataset produced.
+    :param scheduling_seconds: seconds until an invocation is scheduled and its jobs start running.
+    :param job_seconds: seconds that each job runs.
+    :param failed_datasets: number of datasets of each invocation whose job ends in error.
+    :param version: Galaxy version reported, 21.09 by default so that uploads aren't chunked. From 22.01 on, large
+     files are uploaded through the tus endpoint.
+    """
+
+    def __init__(self, latency=0.0, datasets=10, collection_elements=0, dataset_size=1024, scheduling_seconds=0.1,
+                 job_seconds=0.2, failed_datasets=0, version='21.09', clock=time.time):
+        self.latency = latency
+        self.datasets = datasets
+        self.collection_elements = collection_elements
+        self.dataset_size = dataset_size
+        self.scheduling_seconds = scheduling_seconds
+        self.job_seconds = job_seconds
+        self.failed_datasets = failed_datasets
+        self.version = version
+        self.clock = clock
+        self.lock = threading.RLock()
+        self.ids = itertools.count(1)
+        self.histories = {}
+        self.hdas = {}
+        self.collections = {}
+        self.jobs = {}
+        self.workflows = {}
+        self.invocations = {}
+        self.libraries = {}
+        self.library_items = {}
+        self.tus_uploads = {}
+        self.requests = {}
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.httpd = None
+        self.thread = None
+
+    # Server lifecycle
+
+    def start(self):
+        server = self
+
+        class Handler(FakeGalaxyHandler):
+            galaxy = server
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.httpd.daemon_threads = True
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        if self.httpd is not None:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+            self.httpd = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{}".format(self.httpd.server_address[1])
+
+    @property
+    def request_count(self):
+        with self.lock:
+            return sum(self.requests.values())
+
+    def reset_counts(self):
+        with self.lock:
+            self.requests = {}
+            self.bytes_sent = 0
+            self.bytes_received = 0
+
+    # Model
+
+    def _new_id(self):
+        return '{:016x}'.format(0xf000000000000000 + next(self.ids))
+
+    def create_history(self, name):
+        with self.lock:
+            history = {'id': self._new_id(), 'name': name, 'contents': [], 'deleted': False}
+            self.histories[history['id']] = history
+            return history
+
+    def add_dataset(self, history_id, name, size=None, job=None, extension='txt', visible=True):
+        """
+        Adds a dataset to a history, ok from the start unless created by a job.
+
+        :return: dataset dictionary
+        """
+        with self.lock:
+            return self._add_dataset(history_id, name, size, job, extension, visible)
+
+    def _add_dataset(self, history_id, name, size, job, extension, visible):
+        history = self.histories[history_id]
+        hda = {'id': self._new_id(), 'name': name, 'history_id': history_id, 'hid': len(history['contents']) + 1,
+               'file_size': self.dataset_size if size is None else size, 'extension': extension,
+               'visible': visible, 'deleted': False, 'created': self.clock(), 'job': job}
+        if job is None:
+            job = {'id': self._new_id(), 'tool_id': 'upload1', 'start': hda['created'], 'seconds': 0,
+                   'fails': False}
+            hda['job'] = job
+        self.jobs[job['id']] = job
+        self.hdas[hda['id']] = hda
+        history['contents'].append(('dataset', hda['id']))
+        return hda
+
+    def add_history(self, name, datasets=0, collection_elements=0, size=None):
+        """
+        Creates a history whose datasets are already ok, as left by a finished invocation.
+
+        :return: history id
+        """
+        history = self.create_history(name)
+        with self.lock:
+            for number in range(datasets):
+                self._add_dataset(history['id'], 'output_{}.txt'.format(number), size, None, 'txt', True)
+            if collection_elements:
+                self._add_collection(history['id'], 'elements', collection_elements, size, None)
+        return history['id']
+
+    def _add_collection(self, history_id, name, elements, size, job):
+        history = self.histories[history_id]
+        hdca = {'id': self._new_id(), 'name': name, 'hid': len(history['contents']) + 1, 'elements': []}
+        history['contents'].append(('dataset_collection', hdca['id']))
+        for number in range(elements):
+            hda = self._add_dataset(history_id, 'element_{}.txt'.format(number), size, job, 'txt', False)
+            hdca['elements'].append(('element_{}'.format(number), hda['id']))
+        self.collections[hdca['id']] = hdca
+        return hdca
+
+    def _job_state(self, job, now):
+        elapsed = now - job['start']
+        if elapsed < 0:
+            return 'queued', job['start'] - self.scheduling_seconds
+        if elapsed < job['seconds']:
+            return 'running', job['start']
+        return ('error' if job['fails'] else 'ok'), job['start'] + job['seconds']
+
+    def _dataset_state(self, hda, now):
+        state, since = self._job_state(hda['job'], now)
+        return state, _timestamp(max(since, hda['created']))
+
+    def _summary(self, hda, now):
+        state, update_time = self._dataset_state(hda, now)
+        return {'id': hda['id'], 'name': hda['name'], 'hid': hda['hid'], 'history_id': hda['history_id'],
+                'history_content_type': 'dataset', 'type': 'file', 'type_id': 'dataset-' + hda['id'],
+                'state': state, 'extension': hda['extension'], 'visible': hda['visible'],
+                'deleted': hda['deleted'], 'purged': hda['deleted'], 'update_time': update_time,
+                'url': '/api/datasets/' + hda['id']}
+
+    def _dataset(self, hda, now):
+        dataset = self._summary(hda, now)
+        dataset.update({'file_size': hda['file_size'], 'file_ext': hda['extension'], 'hashes': [],
+                        'download_url': '/api/datasets/{}/display'.format(hda['id']),
+                        'file_name': '/galaxy/objects/{}.dat'.format(hda['id']),
+                        'creating_job': hda['job']['id'], 'resubmitted': False, 'model_class': 'HistoryDatasetAssociation'})
+        return dataset
+
+    def _collection(self, hdca, now):
+        return {'id': hdca['id'], 'name': hdca['name'], 'hid': hdca['hid'], 'history_content_type': 'dataset_collection',
+                'type': 'collection', 'type_id': 'dataset_collection-' + hdca['id'], 'collection_type': 'list',
+                'populated_state': 'ok', 'element_count': len(hdca['elements']), 'visible': True, 'deleted': False,
+                'update_time': _timestamp(now), 'url': '/api/dataset_collections/' + hdca['id']}
+
+    def _history(self, history, now):
+        states = ('new', 'upload', 'queued', 'running', 'ok', 'empty', 'error', 'paused', 'setting_metadata',
+                  'failed_metadata', 'deferred', 'discarded')
+        state_details = dict.fromkeys(states, 0)
+        state_ids = {state: [] for state in states}
+        for kind, item_id in history['contents']:
+            if kind == 'dataset' and not self.hdas[item_id]['deleted']:
+                state = self._dataset_state(self.hdas[item_id], now)[0]
+                state_details[state] += 1
+                state_ids[state].append(item_id)
+        if state_details['queued'] or state_details['running'] or state_details['new']:
+            state = 'running'
+        else:
+            state = 'error' if state_details['error'] else 'ok'
+        return {'id': history['id'], 'name': history['name'], 'state': state, 'deleted': history['deleted'],
+                'state_details': state_details, 'state_ids': state_ids, 'update_time': _timestamp(now)}
+
+    def _contents(self, history, params, now):
+        filters = list(zip(params.get('q', []), params.get('qv', [])))
+        if 'visible' in params and not any(attribute == 'visible' for attribute, value in filters):
+            filters.append(('visible', params['visible'][0]))
+        items = []
+        for kind, item_id in history['contents']:
+            if kind == 'dataset':
+                item = self._summary(self.hdas[item_id], now)
+            else:
+                item = self._collection(self.collections[item_id], now)
+            if all(self._matches(item, attribute, value) for attribute, value in filters):
+                items.append(item)
+        if 'offset' in params or 'limit' in params:
+            offset = int(params.get('offset', ['0'])[0])
+            limit = int(params.get('limit', [str(len(items))])[0])
+            items = items[offset:offset + limit]
+        if 'keys' in params:
+            keys = params['keys'][0].split(',')
+            items = [{key: item[key] for key in keys if key in item} for item in items]
+        return items
+
+    @staticmethod
+    def _matches(item, attribute, value):
+        if attribute in ('visible', 'deleted'):
+            return item[attribute] == (value.lower() in ('true', '1'))
+        if attribute in ('history_content_type', 'history_content_type-eq'):
+            return item['history_content_type'] == value
+        if attribute == 'update_time-ge':
+            return _parse_time(item['update_time']) >= _parse_time(value)
+        if attribute == 'update_time-gt':
+            return _parse_time(item['update_time']) > _parse_time(value)
+        raise ValueError("Filter {} is not supported".format(attribute))
+
+    def _show_workflow(self, workflow):
+        inputs = {}
+        for step_id, step in workflow['steps'].items():
+            if step.get('type') in ('data_input', 'data_collection_input', 'parameter_input'):
+                inputs[step_id] = {'label': step.get('label'), 'value': '', 'uuid': step.get('uuid')}
+        return {'id': workflow['id'], 'name': workflow['name'], 'inputs': inputs, 'deleted': workflow['deleted'],
+                'steps': workflow['steps']}
+
+    def _invoke(self, workflow, payload):
+        history_name = payload.get('history', 'Unnamed history')
+        history = self.histories[history_name[len('hist_id='):]] if history_name.startswith('hist_id=') \
+            else self.create_history(history_name)
+        now = self.clock()
+        invocation = {'id': self._new_id(), 'workflow_id': workflow['id'], 'history_id': history['id'],
+                      'created': now, 'steps': {}}
+        tool_steps = [step_id for step_id, step in sorted(workflow['steps'].items(), key=lambda item: int(item[0]))
+                      if step.get('type') == 'tool'] or ['0']
+        with self.lock:
+            outputs = self.datasets + self.collection_elements
+            jobs = []
+            for number in range(outputs):
+                step_id = tool_steps[number % len(tool_steps)]
+                tool_id = workflow['steps'].get(step_id, {}).get('tool_id') or 'tool'
+                job = {'id': self._new_id(), 'tool_id': tool_id, 'start': now + self.scheduling_seconds,
+                       'seconds': self.job_seconds, 'fails': number >= outputs - self.failed_datasets}
+                invocation['steps'].setdefault(step_id, []).append(job)
+                jobs.append(job)
+                if number < self.datasets:
+                    self._add_dataset(history['id'], 'output_{}.txt'.format(number), None, job, 'txt', True)
+            if self.collection_elements:
+                hdca = self._add_collection(history['id'], 'elements', 0, None, None)
+                for number, job in enumerate(jobs[self.datasets:]):
+                    hda = self._add_dataset(history['id'], 'element_{}.txt'.format(number), None, job, 'txt', False)
+                    hdca['elements'].append(('element_{}'.format(number), hda['id']))
+            self.invocations[invocation['id']] = invocation
+        return self._show_invocation(invocation, now)
+
+    def _show_invocation(self, invocation, now):
+        scheduled = now - invocation['created'] >= self.scheduling_seconds
+        steps = [{'id': step_id, 'order_index': int(step_id), 'state': 'scheduled' if scheduled else 'new',
+                  'job_id': jobs[0]['id']} for step_id, jobs in sorted(invocation['steps'].items())]
+        return {'id': invocation['id'], 'workflow_id': invocation['workflow_id'],
+                'history_id': invocation['history_id'], 'state': 'scheduled' if scheduled else 'new',
+                'steps': steps if scheduled else [], 'update_time': _timestamp(now)}
+
+    def _step_jobs_summary(self, invocation, now):
+        summary = []
+        for step_id, jobs in sorted(invocation['steps'].items()):
+            states = {}
+            for job in jobs:
+                state = self._job_state(job, now)[0]
+                states[state] = states.get(state, 0) + 1
+            summary.append({'id': step_id, 'model': 'WorkflowInvocationStep', 'populated_state': 'ok',
+                            'states': states})
+        return summary
+
+    def _library_contents(self, library):
+        return [{'id': item['id'], 'name': path, 'type': item['type']}
+                for path, item in sorted(library['items'].items())]
+
+    # Routing
+
+    def handle(self, method, path, params, payload, now):
+        """
+        Answers an API request.
+
+        :return: JSON serialisable response, or a tuple with the dataset to send the content of.
+        """
+        parts = path.strip('/').split('/')[1:]
+        route = (method,) + tuple(parts)
+        with self.lock:
+            if route == ('GET', 'version'):
+                return {'version_major': self.version, 'version_minor': ''}
+            if route == ('POST', 'histories'):
+                history = {'id': self._new_id(), 'name': payload.get('name', 'Unnamed history'), 'contents': [],
+                           'deleted': False}
+                self.histories[history['id']] = history
+                return self._history(history, now)
+            if parts[0] == 'histories' and len(parts) >= 2:
+                history = self._get(self.histories, parts[1])
+                if len(parts) == 2 and method == 'GET':
+                    return self._history(history, now)
+                if len(parts) == 2 and method == 'DELETE':
+                    history['deleted'] = True
+                    return self._history(history, now)
+                if len(parts) == 3 and parts[2] == 'contents' and method == 'GET':
+                    return self._contents(history, params, now)
+            if parts[0] == 'datasets' and len(parts) >= 2 and method == 'GET':
+                hda = self._get(self.hdas, parts[1])
+                if len(parts) == 2:
+                    return self._dataset(hda, now)
+                if parts[2] == 'display':
+                    return (hda,)
+            if route[:2] == ('GET', 'dataset_collections') and len(parts) == 2:
+                hdca = self._get(self.collections, parts[1])
+                collection = self._collection(hdca, now)
+                collection['elements'] = [{'element_identifier': identifier, 'element_type': 'hda',
+                                           'object': self._summary(self.hdas[hda_id], now)}
+                                          for identifier, hda_id in hdca['elements']]
+                return collection
+            if route[:2] == ('GET', 'jobs') and len(parts) == 2:
+                job = self._get(self.jobs, parts[1])
+                return {'id': job['id'], 'tool_id': job['tool_id'], 'state': self._job_state(job, now)[0]}
+            if route == ('POST', 'tools', 'fetch'):
+                return self._fetch(payload, now)
+            if route[:2] == ('GET', 'tools') and len(parts) == 2:
+                return {'id': parts[1], 'name': parts[1].rsplit('/', 1)[-1],
+                        'version': params.get('tool_version', ['1.0'])[0]}
+            if route == ('POST', 'workflows', 'upload'):
+                workflow = dict(payload['workflow'], id=self._new_id(), deleted=False)
+                workflow.setdefault('name', 'Unnamed workflow')
+                workflow.setdefault('steps', {})
+                self.workflows[workflow['id']] = workflow
+                return {'id': workflow['id'], 'name': workflow['name']}
+            if parts[0] == 'workflows' and len(parts) >= 2:
+                workflow = self._get(self.workflows, parts[1])
+                if route[0] == 'GET' and len(parts) == 2:
+                    return self._show_workflow(workflow)
+                if route[0] == 'DELETE' and len(parts) == 2:
+                    workflow['deleted'] = True
+                    return {}
+                if route[0] == 'POST' and len(parts) == 3 and parts[2] == 'invocations':
+                    return self._invoke(workflow, payload)
+                if route[0] == 'GET' and len(parts) == 4 and parts[2] == 'invocations':
+                    return self._show_invocation(self._get(self.invocations, parts[3]), now)
+            if route[:2] == ('GET', 'invocations') and len(parts) == 3 and parts[2] == 'step_jobs_summary':
+                return self._step_jobs_summary(self._get(self.invocations, parts[1]), now)
+            if route[:2] == ('GET', 'invocations') and len(parts) == 3 and parts[2] == 'jobs_summary':
+                states = {}
+                for step in self._step_jobs_summary(self._get(self.invocations, parts[1]), now):
+                    for state, count in step['states'].items():
+                        states[state] = states.get(state, 0) + count
+                return {'id': parts[1], 'model': 'WorkflowInvocation', 'populated_state': 'ok', 'states': states}
+            if route == ('GET', 'libraries'):
+                return [{'id': library['id'], 'name': library['name'], 'root_folder_id': library['root_folder_id']}
+                        for library in self.libraries.values()]
+            if route == ('POST', 'libraries'):
+                library = {'id': self._new_id(), 'name': payload['name'], 'root_folder_id': 'F' + self._new_id(),
+                           'items': {}}
+                self.libraries[library['id']] = library
+                return {'id': library['id'], 'name': library['name'], 'root_folder_id': library['root_folder_id']}
+            if route[:2] == ('PATCH', 'libraries') and len(parts) == 3 and parts[1] == 'datasets':
+                item = self._get(self.library_items, parts[2])
+                item['name'] = payload.get('name', item['name'])
+                return {'id': item['id'], 'name': item['name']}
+            if parts[0] == 'libraries' and len(parts) >= 2:
+                library = self._get(self.libraries, parts[1])
+                if len(parts) == 2 and method == 'GET':
+                    return {'id': library['id'], 'name': library['name'], 'root_folder_id': library['root_folder_id']}
+                if len(parts) == 3 and method == 'GET':
+                    return self._library_contents(library)
+                if len(parts) == 4 and method == 'GET':
+                    item = self._get(self.library_items, parts[3])
+                    return {'id': item['id'], 'name': item['name'], 'state': 'ok', 'file_size': item['file_size']}
+                if len(parts) == 3 and method == 'POST':
+                    return self._library_upload(library, payload)
+        raise NotFound("{} {} is not part of the fake Galaxy API".format(method, path))
+
+    def _library_upload(self, library, payload):
+        folders = {item['id']: path for path, item in library['items'].items() if item['type'] == 'folder'}
+        folders[library['root_folder_id']] = ''
+        parent = folders[payload['folder_id']]
+        created = []
+        if payload['create_type'] == 'folder':
+            names = [payload['name']]
+        else:
+            names = [path for path in payload['filesystem_paths'].split("\n") if path]
+        for name in names:
+            item = {'id': self._new_id(), 'type': payload['create_type'], 'name': name.rsplit('/', 1)[-1]}
+            if item['type'] == 'file':
+                hda_id = name.rsplit('/', 1)[-1].split('.', 1)[0]
+                item['file_size'] = self._get(self.hdas, hda_id)['file_size']
+            library['items']["{}/{}".format(parent, item['name'])] = item
+            self.library_items[item['id']] = item
+            created.append({'id': item['id'], 'name': item['name']})
+        return created
+
+    def upload(self, fields, size, now):
+        """
+        Creates the dataset of an upload through the upload1 tool.
+        """
+        inputs = json.loads(fields.get('inputs', '{}'))
+        with self.lock:
+            history = self._get(self.histories, fields['history_id'].strip('"'))
+            hda = self._add_dataset(history['id'], inputs.get('files_0|NAME', 'upload'), size, None,
+                                    inputs.get('file_type', 'auto'), True)
+            return {'outputs': [self._dataset(hda, now)], 'jobs': [{'id': hda['job']['id'], 'tool_id': 'upload1'}]}
+
+    def tus_create(self, length):
+        """
+        Starts a tus upload of the given length.
+
+        :return: session id
+        """
+        with self.lock:
+            session_id = self._new_id()
+            self.tus_uploads[session_id] = {'length': length, 'offset': 0}
+            return session_id
+
+    def tus_upload(self, session_id):
+        with self.lock:
+            return dict(self._get(self.tus_uploads, session_id))
+
+    def tus_patch(self, session_id, offset, size):
+        """
+        Stores a chunk of a tus upload, which must start where the previous one ended.
+
+        :return: offset after the chunk
+        """
+        with self.lock:
+            upload = self._get(self.tus_uploads, session_id)
+            if offset != upload['offset']:
+                raise ValueError("Chunk at offset {} while the upload is at {}".format(offset, upload['offset']))
+            upload['offset'] = min(upload['length'], offset + size)
+            return upload['offset']
+
+    def _fetch(self, payload, now):
+        upload = self._get(self.tus_uploads, payload['files_0|file_data']['session_id'])
+        element = payload['targets'][0]['elements'][0]
+        hda = self._add_dataset(self._get(self.histories, payload['history_id'])['id'], element['name'],
+                                upload['offset'], None, element.get('ext', 'auto'), True)
+        return {'outputs': [self._dataset(hda, now)], 'jobs': [{'id': hda['job']['id'], 'tool_id': '__DATA_FETCH__'}]}
+
+    @staticmethod
+    def _get(items, item_id):
+        if item_id not in items:
+            raise NotFound("Object {} does not exist".format(item_id))
+        return items[item_id]
+
+
+class FakeGalaxyHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    galaxy = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _count(self, method, path):
+        with self.galaxy.lock:
+            endpoint = endpoint_name(method, path)
+            self.galaxy.requests[endpoint] = self.galaxy.requests.get(endpoint, 0) + 1
+
+    def _send_json(self, status, content):
+        body = json.dumps(content).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        with self.galaxy.lock:
+            self.galaxy.bytes_sent += len(body)
+
+    def _send_content(self, hda):
+        size = hda['file_size']
+        start = 0
+        match = re.match(r'bytes=(\d+)-$', self.headers.get('Range', ''))
+        if match and int(match.group(1)) < size:
+            start = int(match.group(1))
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, size - 1, size))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(size - start))
+        self.send_header('Content-Disposition', 'attachment; filename="{}"'.format(hda['name']))
+        self.end_headers()
+        position = start
+        while position < size:
+            chunk = CONTENT_CHUNK[:size - position]
+            self.wfile.write(chunk)
+            position += len(chunk)
+        with self.galaxy.lock:
+            self.galaxy.bytes_sent += size - start
+
+    def _read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        content_type = self.headers.get('Content-Type', '')
+        with self.galaxy.lock:
+            self.galaxy.bytes_received += length
+        if not content_type.startswith('multipart/form-data'):
+            body = self.rfile.read(length) if length else b''
+            return (json.loads(body) if body else {}), None
+        # Uploads are read in chunks, keeping only the beginning and the end of the body, where the other
+        # fields are, and the size of the file.
+        boundary = b'\r\n--' + re.search(r'boundary=(\S+)', content_type).group(1).strip('"').encode()
+        head = tail = b''
+        read = 0
+        while read < length:
+            chunk = self.rfile.read(min(length - read, 1 << 16))
+            if not chunk:
+                break
+            read += len(chunk)
+            if len(head) < 1 << 16:
+                head += chunk
+            tail = (tail + chunk)[-(1 << 16):]
+        tail_start = read - len(tail)
+        file_start = head.find(b'\r\n\r\n', head.find(FILE_FIELD)) + 4
+        file_end = tail_start + tail.find(boundary, max(0, file_start - tail_start))
+        fields = {}
+        for part in (b'\r\n' + head[:file_start]).split(boundary)[1:] + tail[file_end - tail_start:].split(boundary)[1:]:
+            headers, _, content = part.partition(b'\r\n\r\n')
+            name = re.search(rb'name="([^"]+)"', headers)
+            if name is not None and FILE_FIELD not in headers:
+                fields[name.group(1).decode()] = content.decode()
+        return fields, file_end - file_start
+
+    def _send_tus(self, status, headers):
+        self.send_response(status)
+        self.send_header('Tus-Resumable', '1.0.0')
+        self.send_header('Content-Length', '0')
+        for name, value in headers.items():
+            self.send_header(name, str(value))
+        self.end_headers()
+
+    def _handle_tus(self, method, path):
+        session_id = path[len(TUS_PATH):].strip('/')
+        if method == 'POST' and not session_id:
+            session_id = self.galaxy.tus_create(int(self.headers['Upload-Length']))
+            self._send_tus(201, {'Location': "{}/{}".format(TUS_PATH, session_id)})
+        elif method == 'HEAD' and session_id:
+            upload = self.galaxy.tus_upload(session_id)
+            self._send_tus(200, {'Upload-Offset': upload['offset'], 'Upload-Length': upload['length']})
+        elif method == 'PATCH' and session_id:
+            length = int(self.headers.get('Content-Length') or 0)
+            read = 0
+            while read < length:
+                chunk = self.rfile.read(min(length - read, 1 << 16))
+                if not chunk:
+                    break
+                read += len(chunk)
+            with self.galaxy.lock:
+                self.galaxy.bytes_received += read
+            offset = self.galaxy.tus_patch(session_id, int(self.headers['Upload-Offset']), read)
+            self._send_tus(204, {'Upload-Offset': offset})
+        else:
+            raise NotFound("{} {} is not part of the fake tus endpoint".format(method, path))
+
+    def _handle(self, method):
+        time.sleep(self.galaxy.latency)
+        url = urlsplit(self.path)
+        params = parse_qs(url.query, keep_blank_values=True)
+        self._count(method, url.path)
+        now = self.galaxy.clock()
+        if url.path.startswith(TUS_PATH):
+            try:
+                self._handle_tus(method, url.path)
+            except NotFound as e:
+                self._send_json(404, {'err_msg': str(e)})
+            except ValueError as e:
+                self._send_json(409, {'err_msg': str(e)})
+            return
+        try:
+            payload, file_size = self._read_body() if method in ('POST', 'PUT', 'PATCH', 'DELETE') else ({}, None)
+            if file_size is not None:
+                content = self.galaxy.upload(payload, file_size, now)
+            else:
+                content = self.galaxy.handle(method, url.path, params, payload, now)
+        except NotFound as e:
+            self._send_json(404, {'err_msg': str(e)})
+            return
+        except (KeyError, ValueError) as e:
+            self._send_json(400, {'err_msg': "Bad request: {}".format(e)})
+            return
+        if isinstance(content, tuple):
+            self._send_content(content[0])
+        else:
+            self._send_json(200, content)
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_HEAD(self):
+        self._handle('HEAD')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def do_PUT(self):
+        self._handle('PUT')
+
+    def do_PATCH(self):
+        self._handle('PATCH')
+
+    def do_DELETE(self):
+        self._handle('DELETE')
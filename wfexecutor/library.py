@@ -0,0 +1,134 @@
+import logging
+import os
+
+from . import aio
+from .cache import MetadataCache
+from .contents import iter_history_contents
+
+
+class LibraryFolders(object):
+    """
+    Resolves library folders by path, creating them when missing. Each folder is looked up only once.
+    """
+
+    def __init__(self, gi, lib_id):
+        self.gi = gi
+        self.lib_id = lib_id
+        self.folder_ids = {}
+
+    def folder_id(self, *names):
+        """
+        Returns the id of the folder with the path given by names, from the library root.
+
+        :param names: folder names, from the outermost to the innermost.
+        :return: folder id
+        """
+        path = '/' + '/'.join(names)
+        if path not in self.folder_ids:
+            folder = self.gi.libraries.get_folders(library_id=self.lib_id, name=path)
+            if folder == []:
+                base_folder_id = self.folder_id(*names[:-1]) if len(names) > 1 else None
+                folder = self.gi.libraries.create_folder(library_id=self.lib_id, folder_name=names[-1],
+                                                         base_folder_id=base_folder_id)
+            self.folder_ids[path] = folder[0]['id']
+        return self.folder_ids[path]
+
+
+def _is_allowed_failure(dataset, allowed_error_states):
+    return dataset['state'] == 'error' and dataset['id'] in allowed_error_states['datasets']
+
+
+def _match_uploaded(uploaded, batch):
+    """
+    Pairs library datasets created by a multi-path upload with the history datasets they come from. Library
+    datasets are named after the file name in the Galaxy filesystem, which is used when unambiguous, falling
+    back to the order of the paths.
+    """
+    by_file_name = {}
+    for file_path, name in batch:
+        by_file_name.setdefault(os.path.basename(file_path), []).append(name)
+    if len(uploaded) == len(batch) and all(len(names) == 1 for names in by_file_name.values()) \
+            and all(ld.get('name') in by_file_name for ld in uploaded):
+        return [(ld, by_file_name[ld['name']][0]) for ld in uploaded]
+    return list(zip(uploaded, [name for file_path, name in batch]))
+
+
+async def export_results_to_data_library_async(gi, history_id, lib_id, allowed_error_states, cache=None,
+                                               batch_size=50, workers=4):
+    """
+    Exports results from a given Galaxy history to a data library, in a folder named after the history, with
+    collections in sub folders named after them. History contents are listed page by page, the paths of the
+    files are resolved concurrently, files are imported from the Galaxy filesystem in batches and their
+    completion is waited for concurrently.
+
+    :param gi: galaxy instance object
+    :param history_id: ID of the history from where results should be retrieved.
+    :param lib_id: ID of the data library where results should be stored.
+    :param allowed_error_states: dictionary with elements known to be allowed to fail.
+    :param cache: MetadataCache to avoid retrieving the same datasets and history again.
+    :param batch_size: maximum number of files imported to the library on each request.
+    :param workers: number of concurrent requests used to resolve datasets and wait for library imports.
+    :return:
+    """
+    if cache is None:
+        cache = MetadataCache()
+    folders = LibraryFolders(gi, lib_id)
+    base_folder_name = (await aio.call(cache.show_history, gi, history_id))['name']
+
+    def plan():
+        # Destination folder of each dataset, in history order. History contents are retrieved page by page.
+        to_export = []
+        for dataset in iter_history_contents(gi, history_id):
+            if dataset['type'] == 'file':
+                if _is_allowed_failure(dataset, allowed_error_states):
+                    logging.info('Skipping upload of failed {} as it is an allowed failure.'
+                                 .format(dataset['name']))
+                    continue
+                if dataset['name'] is not None:
+                    to_export.append((folders.folder_id(base_folder_name), dataset['id']))
+            elif dataset['type'] == 'collection':
+                folder_id = folders.folder_id(base_folder_name, dataset['name'])
+                for ds_in_coll in dataset['elements']:
+                    if _is_allowed_failure(ds_in_coll['object'], allowed_error_states):
+                        logging.info('Skipping upload of failed {} as it is an allowed failure.'
+                                     .format(ds_in_coll['object']['name']))
+                        continue
+                    if ds_in_coll['object']['name'] is not None:
+                        to_export.append((folder_id, ds_in_coll['object']['id']))
+        return to_export
+
+    dataset_ids = await aio.call(plan)
+    # Get dataset objects, which hold the paths in the Galaxy filesystem, and group them by folder.
+    details = await aio.map_in_threads(lambda item: cache.show_dataset(gi, item[1]), dataset_ids, workers)
+    to_export = {}
+    for (folder_id, dataset_id), dataset in zip(dataset_ids, details):
+        to_export.setdefault(folder_id, []).append((dataset['file_name'], dataset['name']))
+
+    uploads = []
+    for folder_id, files in to_export.items():
+        for start in range(0, len(files), batch_size):
+            batch = files[start:start + batch_size]
+            uploaded = await aio.call(gi.libraries.upload_from_galaxy_filesystem, lib_id,
+                                      "\n".join(file_path for file_path, name in batch),
+                                      folder_id=folder_id,
+                                      link_data_only="copy_files",
+                                      tag_using_filenames=True)
+            uploads.extend(_match_uploaded(uploaded, batch))
+    logging.info('Submitted {} files to the library, waiting for them to be ready.'.format(len(uploads)))
+
+    def wait_and_rename(upload):
+        uploaded_dataset, name = upload
+        gi.libraries.wait_for_dataset(library_id=lib_id, dataset_id=uploaded_dataset['id'])
+        gi.libraries.update_library_dataset(dataset_id=uploaded_dataset['id'], name=name)
+        logging.info('data uploaded updating name to {}.'.format(name))
+
+    await aio.map_in_threads(wait_and_rename, uploads, workers)
+
+
+def export_results_to_data_library(gi, history_id, lib_id, allowed_error_states, cache=None, batch_size=50,
+                                   workers=4):
+    """
+    Synchronous version of export_results_to_data_library_async.
+    """
+    aio.run(export_results_to_data_library_async(gi, history_id, lib_id, allowed_error_states, cache=cache,
+                                                 batch_size=batch_size, workers=workers))
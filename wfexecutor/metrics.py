@@ -0,0 +1,210 @@
+import json
+import logging
+import os
+import re
+import threading
+import time
+
+# Upper bounds, in seconds, of the buckets of the API call latency histograms.
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+_ID_SEGMENT = re.compile(r'^([0-9a-f]{16,}|[0-9a-f-]{36}|\d+)$')
+
+
+def endpoint_name(method, url):
+    """
+    Names the endpoint of a request to the Galaxy API, with the method and the path from /api on, and
+    identifiers replaced by {id}, so that requests to the same endpoint are counted together.
+
+    :param method: HTTP method
+    :param url: request URL
+    :return: name like 'GET /api/histories/{id}/contents'
+    """
+    path = url.split('?', 1)[0].rstrip('/')
+    if '/api/' in path:
+        path = path[path.index('/api/'):]
+    elif '://' in path:
+        path = '/' + path.split('://', 1)[1].partition('/')[2]
+    segments = ['{id}' if _ID_SEGMENT.match(segment) else segment for segment in path.split('/')]
+    return "{} {}".format(method, '/'.join(segments))
+
+
+class Metrics(object):
+    """
+    Records where a run spends its time: wall clock spans of each phase, count, errors and latency histogram
+    of the requests to each Galaxy API endpoint, and bytes uploaded and downloaded. Phases follow each other,
+    so starting one ends the previous one. Safe to share among threads.
+    """
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.started = clock()
+        self.started_at = time.time()
+        self.lock = threading.Lock()
+        self.phases = []
+        self.current = None
+        self.calls = {}
+        self.bytes = {'upload': 0, 'download': 0}
+        self.exit_status = None
+
+    def start_phase(self, name):
+        """
+        Ends the current phase, if any, and starts a new one.
+
+        :param name: name of the phase, like 'upload' or 'download'.
+        """
+        self.end_phase()
+        self.current = (name, self.clock())
+
+    def end_phase(self):
+        if self.current is not None:
+            name, start = self.current
+            self.phases.append({'name': name, 'start': start - self.started, 'seconds': self.clock() - start})
+            self.current = None
+
+    def record_call(self, endpoint, seconds, error=False):
+        with self.lock:
+            call = self.calls.setdefault(endpoint, {'count': 0, 'errors': 0, 'seconds': 0.0, 'max_seconds': 0.0,
+                                                    'buckets': [0] * (len(LATENCY_BUCKETS) + 1)})
+            call['count'] += 1
+            call['errors'] += 1 if error else 0
+            call['seconds'] += seconds
+            call['max_seconds'] = max(call['max_seconds'], seconds)
+            call['buckets'][len([bound for bound in LATENCY_BUCKETS if seconds > bound])] += 1
+
+    def add_bytes(self, direction, size):
+        with self.lock:
+            self.bytes[direction] = self.bytes.get(direction, 0) + size
+
+    def timed(self, description, send):
+        """
+        Sends a request, recording its latency under the endpoint given by description.
+
+        :param description: method and URL of the request, separated by a space.
+        :param send: callable making the request, returning a response or raising an error.
+        :return: whatever send returns.
+        """
+        # imported here, as metrics are recorded from the start of a run, before anything needs bioblend
+        from bioblend import ConnectionError
+
+        endpoint = endpoint_name(*description.split(' ', 1))
+        start = self.clock()
+        try:
+            response = send()
+        except (ConnectionError, IOError):
+            self.record_call(endpoint, self.clock() - start, error=True)
+            raise
+        status = getattr(response, 'status_code', 200)
+        self.record_call(endpoint, self.clock() - start, error=status >= 400)
+        return response
+
+    def install(self, gi):
+        """
+        Records every request that bioblend makes through the given galaxy instance object, and makes this
+        object available to other requests to the same instance as gi.metrics. Install it before a RateLimiter,
+        so that time waiting for request budget isn't counted as latency.
+
+        :param gi: galaxy instance object
+        :return: the same galaxy instance object
+        """
+        for method in ('get', 'post', 'put', 'patch', 'delete'):
+            make_request = getattr(gi, 'make_{}_request'.format(method))
+            setattr(gi, 'make_{}_request'.format(method), self._wrap(method.upper(), make_request))
+        gi.metrics = self
+        return gi
+
+    def _wrap(self, method, make_request):
+        def timed_request(url, *args, **kwargs):
+            return self.timed("{} {}".format(method, url), lambda: make_request(url, *args, **kwargs))
+        return timed_request
+
+    def report(self):
+        """
+        :return: dictionary with the phases, API calls and bytes transferred recorded so far.
+        """
+        with self.lock:
+            calls = {endpoint: dict(call, buckets=dict(zip([str(bound) for bound in LATENCY_BUCKETS] + ['+Inf'],
+                                                            call['buckets'])))
+                     for endpoint, call in sorted(self.calls.items())}
+            phase_totals = {}
+            for phase in self.phases:
+                phase_totals[phase['name']] = phase_totals.get(phase['name'], 0.0) + phase['seconds']
+            return {'started': self.started_at,
+                    'seconds': self.clock() - self.started,
+                    'exit_status': self.exit_status,
+                    'phases': list(self.phases),
+                    'phase_totals': phase_totals,
+                    'api_calls': calls,
+                    'api_calls_total': sum(call['count'] for call in self.calls.values()),
+                    'bytes': dict(self.bytes)}
+
+    def prometheus(self):
+        """
+        :return: the report in the Prometheus text exposition format.
+        """
+        report = self.report()
+        lines = ["# TYPE wfexecutor_run_seconds gauge",
+                 "wfexecutor_run_seconds {:.3f}".format(report['seconds']),
+                 "# TYPE wfexecutor_phase_seconds gauge"]
+        lines += ['wfexecutor_phase_seconds{{phase="{}"}} {:.3f}'.format(name, seconds)
+                  for name, seconds in sorted(report['phase_totals'].items())]
+        lines.append("# TYPE wfexecutor_api_request_duration_seconds histogram")
+        for endpoint, call in report['api_calls'].items():
+            cumulative = 0
+            for bound, count in call['buckets'].items():
+                cumulative += count
+                lines.append('wfexecutor_api_request_duration_seconds_bucket{{endpoint="{}",le="{}"}} {}'
+                             .format(endpoint, bound, cumulative))
+            lines.append('wfexecutor_api_request_duration_seconds_sum{{endpoint="{}"}} {:.3f}'
+                         .format(endpoint, call['seconds']))
+            lines.append('wfexecutor_api_request_duration_seconds_count{{endpoint="{}"}} {}'
+                         .format(endpoint, call['count']))
+        lines.append("# TYPE wfexecutor_api_request_errors_total counter")
+        lines += ['wfexecutor_api_request_errors_total{{endpoint="{}"}} {}'.format(endpoint, call['errors'])
+                  for endpoint, call in report['api_calls'].items()]
+        lines.append("# TYPE wfexecutor_transferred_bytes_total counter")
+        lines += ['wfexecutor_transferred_bytes_total{{direction="{}"}} {}'.format(direction, size)
+                  for direction, size in sorted(report['bytes'].items())]
+        if report['exit_status'] is not None:
+            lines += ["# TYPE wfexecutor_exit_status gauge", "wfexecutor_exit_status {}".format(report['exit_status'])]
+        return "".join(line + "\n" for line in lines)
+
+    def write(self, report_path, prometheus=False):
+        """
+        Writes the JSON report, and optionally the Prometheus textfile next to it, with the same name and the .prom
+        extension. Files are replaced atomically, so that collectors never read them half written.
+
+        :param report_path: path of the JSON report.
+        :param prometheus: whether to write the Prometheus textfile too.
+        :return: path of the JSON report.
+        """
+        self.end_phase()
+        if os.path.dirname(report_path):
+            os.makedirs(os.path.dirname(report_path), exist_ok=True)
+        files = [(report_path, json.dumps(self.report(), indent=2))]
+        if prometheus:
+            files.append((os.path.splitext(report_path)[0] + '.prom', self.prometheus()))
+        for path, content in files:
+            with open(path + '.tmp', mode='w') as f:
+                f.write(content)
+            os.replace(path + '.tmp', path)
+        logging.info("Run metrics written to {}".format(report_path))
+        return report_path
+
+    def log_summary(self):
+        report = self.report()
+        logging.info("Time per phase: {}".format(", ".join("{} {:.1f} s".format(name, seconds)
+                                                           for name, seconds in report['phase_totals'].items())))
+        logging.info("{} API calls, {} bytes uploaded and {} bytes downloaded.".format(
+            report['api_calls_total'], report['bytes']['upload'], report['bytes']['download']))
+
+
+def record_bytes(gi, direction, size):
+    """
+    Adds bytes transferred to the metrics installed on the galaxy instance object, if any.
+
+    :param direction: 'upload' or 'download'
+    """
+    metrics = getattr(gi, 'metrics', None)
+    if metrics is not None and size:
+        metrics.add_bytes(direction, size)
@@ -0,0 +1,98 @@
+import asyncio
+import logging
+import random
+import time
+
+
+class PollingPolicy(object):
+    """
+    Decides how long to wait between polls to the Galaxy instance. The first check happens after a short
+    delay, following waits grow exponentially from min_interval up to max_interval, and the interval goes
+    back to min_interval whenever the observed state changes. A random jitter, expressed as a fraction of
+    the interval, avoids many executors polling the same server in lockstep.
+    """
+
+    def __init__(self, first_check=5, min_interval=10, max_interval=120, backoff=1.5, jitter=0.1,
+                 sleep=time.sleep):
+        if min_interval > max_interval:
+            raise ValueError("Minimum polling interval {} is larger than the maximum {}."
+                             .format(min_interval, max_interval))
+        self.first_check = first_check
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.jitter = jitter
+        self.sleep = sleep
+        self.interval = None
+        self.last_observed = None
+        self.waited = 0.0
+        self.polls = 0
+        self.started = time.monotonic()
+
+    def reset(self):
+        """
+        Goes back to short intervals, the next wait will be of min_interval.
+        """
+        self.interval = self.min_interval if self.interval is not None else None
+
+    def observe(self, observed):
+        """
+        Registers the state seen on the last poll. If it differs from the previous one, the policy goes back
+        to short intervals, as changes tend to come together.
+
+        :param observed: any comparable representation of the polled state, like state counts.
+        :return: whether the state changed since the last observation.
+        """
+        changed = self.last_observed is not None and observed != self.last_observed
+        self.last_observed = observed
+        self.polls += 1
+        if changed:
+            self.reset()
+        return changed
+
+    def next_interval(self):
+        if self.interval is None:
+            interval = self.first_check
+            self.interval = self.min_interval
+        else:
+            interval = self.interval
+            self.interval = min(self.max_interval, self.interval * self.backoff)
+        if self.jitter > 0:
+            interval *= 1 + random.uniform(-self.jitter, self.jitter)
+        return max(0.0, interval)
+
+    def wait(self):
+        """
+        Sleeps for the next interval.
+
+        :return: the number of seconds waited.
+        """
+        interval = self.next_interval()
+        logging.debug("Waiting {:.1f} s before polling again".format(interval))
+        self.sleep(interval)
+        self.waited += interval
+        return interval
+
+    async def wait_async(self, until=None):
+        """
+        Asynchronous version of wait, which can return before the interval is over if the awaitable given
+        completes first.
+
+        :param until: optional future or task that ends the wait when done.
+        :return: the number of seconds waited.
+        """
+        interval = self.next_interval()
+        logging.debug("Waiting {:.1f} s before polling again".format(interval))
+        start = time.monotonic()
+        if until is None:
+            await asyncio.sleep(interval)
+        else:
+            await asyncio.wait([until], timeout=interval)
+        waited = time.monotonic() - start
+        self.waited += waited
+        return waited
+
+    def log_summary(self):
+        elapsed = time.monotonic() - self.started
+        logging.info("Polled {} times, {:.0f} s of {:.0f} s were spent waiting and {:.0f} s working."
+                     .format(self.polls, self.waited, elapsed, max(0.0, elapsed - self.waited)))
@@ -0,0 +1,115 @@
+import datetime
+import logging
+
+from bioblend import ConnectionError
+
+from .contents import PAGE_SIZE, iter_history_contents
+
+# Dataset states, as counted in the state_details of a history.
+DATASET_STATES = ('new', 'upload', 'queued', 'running', 'ok', 'empty', 'error', 'paused', 'setting_metadata',
+                  'failed_metadata', 'deferred', 'discarded')
+DATASET_KEYS = 'id,state,deleted,purged,update_time'
+# Datasets are retrieved again when updated up to this many seconds before the latest update seen, as updates
+# committed by different Galaxy processes are not seen in the order of their update times.
+UPDATE_OVERLAP = 60
+
+
+def _parse_time(value):
+    return datetime.datetime.fromisoformat(value.rstrip('Z'))
+
+
+class InvocationProgress(object):
+    """
+    Follows the progress of a workflow invocation without retrieving the whole results history on every poll.
+    Each poll retrieves the job summaries of the invocation steps and, from the results history, only the
+    datasets updated since the previous poll, with just their state, to keep the count of datasets per state.
+    Polls return a dictionary with the id, state, state_details and state_ids (for error and paused datasets)
+    of show_history, so that it can be given to completion_state as the history. When the server can't filter
+    history contents by update time, each poll retrieves the history instead.
+    """
+
+    def __init__(self, gi, invocation_id, history_id, page_size=PAGE_SIZE):
+        self.gi = gi
+        self.invocation_id = invocation_id
+        self.history_id = history_id
+        self.page_size = page_size
+        self.incremental = True
+        self.states = {}
+        self.latest_update = None
+        self.jobs = {}
+        self.retrieved = 0
+
+    def _update_datasets(self):
+        filters = [('history_content_type', 'dataset')]
+        if self.latest_update is not None:
+            since = _parse_time(self.latest_update) - datetime.timedelta(seconds=UPDATE_OVERLAP)
+            filters.append(('update_time-ge', since.isoformat()))
+        changed = list(iter_history_contents(self.gi, self.history_id, visible=None, page_size=self.page_size,
+                                             filters=filters, keys=DATASET_KEYS))
+        if any('update_time' not in dataset for dataset in changed):
+            raise ValueError("history contents were returned without their update time")
+        for dataset in changed:
+            if dataset.get('deleted') or dataset.get('purged'):
+                self.states.pop(dataset['id'], None)
+            else:
+                self.states[dataset['id']] = dataset['state']
+            if self.latest_update is None or _parse_time(dataset['update_time']) > \
+                    _parse_time(self.latest_update):
+                self.latest_update = dataset['update_time']
+        self.retrieved += len(changed)
+
+    def _update_jobs(self):
+        steps = self.gi.invocations.get_invocation_step_jobs_summary(self.invocation_id)
+        jobs = {}
+        for step in steps:
+            for state, count in step.get('states', {}).items():
+                jobs[state] = jobs.get(state, 0) + count
+        if jobs != self.jobs:
+            logging.info("Invocation {} has {} jobs over {} steps: {}".format(
+                self.invocation_id, sum(jobs.values()), len(steps),
+                ", ".join("{} {}".format(count, state) for state, count in sorted(jobs.items()))))
+        self.jobs = jobs
+
+    def _history(self):
+        state_details = dict.fromkeys(DATASET_STATES, 0)
+        state_ids = {state: [] for state in DATASET_STATES}
+        for dataset_id, state in self.states.items():
+            state_details[state] = state_details.get(state, 0) + 1
+            state_ids.setdefault(state, []).append(dataset_id)
+        if any(count for state, count in state_details.items()
+               if state not in ('ok', 'error', 'paused', 'failed_metadata', 'empty', 'discarded', 'deferred')):
+            state = 'running'
+        elif state_details['error'] or state_details['failed_metadata']:
+            state = 'error'
+        else:
+            state = 'ok' if self.states else 'new'
+        return {'id': self.history_id, 'state': state, 'state_details': state_details, 'state_ids': state_ids}
+
+    def poll(self):
+        """
+        Retrieves what changed in the invocation since the last poll.
+
+        :return: history dictionary with id, state, state_details and state_ids.
+        """
+        recorder = getattr(self.gi, 'recorder', None)
+        if recorder is not None:
+            recorder.mark_poll()
+        self._update_jobs()
+        if self.incremental:
+            try:
+                self._update_datasets()
+            except (ConnectionError, ValueError) as e:
+                if isinstance(e, ConnectionError) and e.status_code not in (400, 422):
+                    raise
+                logging.info("Galaxy can't filter history contents by update time ({}), the whole history will "
+                             "be retrieved on each poll.".format(e))
+                self.incremental = False
+        if not self.incremental:
+            return self.gi.histories.show_history(self.history_id)
+        return self._history()
+
+    def observed(self):
+        """
+        :return: representation of the progress seen in the last poll, for the polling policy.
+        """
+        return sorted(self.jobs.items()), sorted(self._history()['state_details'].items())
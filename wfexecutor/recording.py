@@ -0,0 +1,315 @@
+import io
+import json
+import logging
+import os
+import threading
+import time
+
+import requests
+from bioblend import ConnectionError
+from bioblend.galaxy import GalaxyInstance
+
+from .metrics import endpoint_name
+
+STREAM_CHUNK = 1024 * 1024
+RECORDED_HEADERS = ('Content-Type', 'Content-Length', 'Content-Disposition', 'Content-Range')
+
+
+class ReplayError(Exception):
+    """
+    Raised when a request made while replaying wasn't in the recording.
+    """
+    pass
+
+
+def _payload_size(payload):
+    if payload is None:
+        return 0
+    size = 0
+    for value in (payload.values() if isinstance(payload, dict) else [payload]):
+        if hasattr(value, 'fileno'):
+            size += os.fstat(value.fileno()).st_size
+        else:
+            size += len(json.dumps(value, default=str))
+    return size
+
+
+def _recordable(payload):
+    # Attached files are recorded by their size only.
+    if not isinstance(payload, dict):
+        return payload
+    return {key: "<file of {} bytes>".format(os.fstat(value.fileno()).st_size) if hasattr(value, 'fileno') else value
+            for key, value in payload.items()}
+
+
+def _key(method, url, params, payload):
+    return "{} {} {} {}".format(method, url.split('?', 1)[0], json.dumps(params, sort_keys=True, default=str),
+                                json.dumps(payload, sort_keys=True, default=str))
+
+
+class TrafficRecorder(object):
+    """
+    Records every request made to a Galaxy instance: method, URL, parameters and payload, response and its
+    size, latency, the phase of the run (when Metrics are installed too) and the poll of the invocation
+    progress during which it was made. Recordings can be saved as JSON lines, replayed offline with
+    ReplayGalaxyInstance, and summarised with summarize_traffic. Safe to share among threads.
+    """
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.started = clock()
+        self.lock = threading.Lock()
+        self.entries = []
+        self.polls = 0
+
+    def mark_poll(self):
+        """
+        Signals the start of a new poll of the invocation progress; requests up to the next one belong to it.
+        """
+        with self.lock:
+            self.polls += 1
+
+    def record(self, gi, method, url, send, params=None, payload=None, stream=False):
+        """
+        Sends a request, recording it and its response.
+
+        :param gi: galaxy instance object, from which the current phase is taken.
+        :param send: callable making the request
+        :param stream: whether the response body is streamed, in which case only its size is recorded.
+        :return: whatever send returns.
+        """
+        metrics = getattr(gi, 'metrics', None)
+        with self.lock:
+            entry = {'seq': len(self.entries), 'start': self.clock() - self.started,
+                     'phase': metrics.current[0] if metrics is not None and metrics.current else None,
+                     'poll': self.polls or None, 'method': method, 'url': url.split('?', 1)[0],
+                     'endpoint': endpoint_name(method, url), 'params': params, 'payload': _recordable(payload),
+                     'request_bytes': _payload_size(payload), 'stream': stream}
+            self.entries.append(entry)
+        start = self.clock()
+        try:
+            response = send()
+        except ConnectionError as e:
+            entry.update(status=e.status_code, response=str(e.body), response_bytes=len(str(e.body)),
+                         error=str(e))
+            raise
+        except requests.exceptions.RequestException as e:
+            entry.update(status=None, response=None, response_bytes=0, error=str(e))
+            raise
+        finally:
+            entry['seconds'] = self.clock() - start
+        if isinstance(response, requests.Response):
+            entry.update(status=response.status_code,
+                         headers={name: response.headers[name] for name in RECORDED_HEADERS
+                                  if name in response.headers})
+            if stream:
+                entry.update(response=None, response_bytes=0)
+                response.iter_content = self._counted(entry, response.iter_content)
+            else:
+                try:
+                    entry['response'] = response.json()
+                except ValueError:
+                    entry['response'] = response.text
+                entry['response_bytes'] = len(response.content)
+        else:
+            entry.update(status=200, response=response, response_bytes=len(json.dumps(response, default=str)))
+        return response
+
+    @staticmethod
+    def _counted(entry, iter_content):
+        def counted_iter_content(*args, **kwargs):
+            for chunk in iter_content(*args, **kwargs):
+                entry['response_bytes'] += len(chunk)
+                yield chunk
+        return counted_iter_content
+
+    def install(self, gi):
+        """
+        Records every request that bioblend makes through the given galaxy instance object, and makes this
+        object available to other requests to the same instance, like streamed downloads, as gi.recorder.
+        Install it before Metrics and RateLimiter, so that each attempt is recorded as sent.
+
+        :param gi: galaxy instance object
+        :return: the same galaxy instance object
+        """
+        for method in ('get', 'post', 'put', 'patch', 'delete'):
+            make_request = getattr(gi, 'make_{}_request'.format(method))
+            setattr(gi, 'make_{}_request'.format(method), self._wrap(gi, method.upper(), make_request))
+        gi.recorder = self
+        return gi
+
+    def _wrap(self, gi, method, make_request):
+        def recorded_request(url, *args, **kwargs):
+            payload = kwargs.get('payload', args[0] if args else None)
+            return self.record(gi, method, url, lambda: make_request(url, *args, **kwargs),
+                               params=kwargs.get('params'), payload=payload)
+        return recorded_request
+
+    def save(self, path):
+        """
+        Writes the recording as JSON lines, one request per line, in the order they were sent.
+        """
+        with self.lock:
+            entries = list(self.entries)
+        with open(path, mode='w') as f:
+            for entry in entries:
+                f.write(json.dumps(entry, default=str) + "\n")
+        logging.info("Recorded {} requests to {}".format(len(entries), path))
+
+
+def read_traffic(path):
+    """
+    :return: list of the requests of a recording saved by TrafficRecorder.
+    """
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def summarize_traffic(entries):
+    """
+    Counts the requests of a recording, to check them against API call budgets: in total, per phase, per
+    endpoint, in the first poll of the invocation progress and in each of the following (steady state) polls.
+
+    :param entries: requests of a recording, as given by read_traffic or TrafficRecorder.entries
+    :return: dictionary with total, by_phase, by_endpoint, first_poll, steady_polls, steady_poll_max,
+     steady_poll_mean, download and bytes_received.
+    """
+    by_phase = {}
+    by_endpoint = {}
+    polls = {}
+    for entry in entries:
+        by_phase[entry['phase']] = by_phase.get(entry['phase'], 0) + 1
+        by_endpoint[entry['endpoint']] = by_endpoint.get(entry['endpoint'], 0) + 1
+        if entry['poll'] is not None and entry['phase'] in (None, 'execution'):
+            polls[entry['poll']] = polls.get(entry['poll'], 0) + 1
+    steady_polls = [count for poll, count in sorted(polls.items()) if poll > 1]
+    return {'total': len(entries),
+            'by_phase': by_phase,
+            'by_endpoint': by_endpoint,
+            'first_poll': polls.get(1, 0),
+            'steady_polls': len(steady_polls),
+            'steady_poll_max': max(steady_polls) if steady_polls else 0,
+            'steady_poll_mean': sum(steady_polls) / len(steady_polls) if steady_polls else 0.0,
+            'download': by_phase.get('download', 0),
+            'bytes_received': sum(entry.get('response_bytes') or 0 for entry in entries)}
+
+
+class _ReplayResponse(object):
+
+    def __init__(self, entry):
+        self.status_code = entry['status']
+        self.headers = requests.structures.CaseInsensitiveDict(entry.get('headers') or {})
+        self.body = entry.get('response')
+        self.size = entry.get('response_bytes') or 0
+        self.text = self.body if isinstance(self.body, str) else json.dumps(self.body)
+        self.content = self.text.encode()
+        # collection archives are not recorded, so they can't be unpacked
+        self.raw = io.BytesIO(b'')
+
+    def json(self):
+        if isinstance(self.body, str):
+            raise ValueError("Response is not JSON")
+        return self.body
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.exceptions.HTTPError("{} error".format(self.status_code), response=self)
+
+    def iter_content(self, chunk_size=STREAM_CHUNK):
+        sent = 0
+        while sent < self.size:
+            chunk = b'\0' * min(chunk_size, self.size - sent)
+            sent += len(chunk)
+            yield chunk
+
+    def close(self):
+        pass
+
+
+class _ReplaySession(object):
+
+    def __init__(self, gi):
+        self.gi = gi
+
+    def get(self, url, **kwargs):
+        return _ReplayResponse(self.gi.replay('GET', url, kwargs.get('params'), None))
+
+
+class ReplayGalaxyInstance(GalaxyInstance):
+    """
+    Galaxy instance object that answers requests with the responses of a recording instead of contacting the
+    server. Each request gets the next unused response recorded for the same method, URL, parameters and
+    payload, or failing that for the same method and URL. Once those are used up, the last one is repeated,
+    as happens with polls. Downloaded files are replayed with the recorded size, filled with zeros, and
+    dataset hashes are left out so that they aren't checked against that content.
+    """
+
+    def __init__(self, entries, speed=0.0):
+        base_url = entries[0]['url'].split('/api/', 1)[0] if entries else 'http://replay'
+        super().__init__(base_url, key='replay')
+        self.entries = entries
+        self.speed = speed
+        self.lock = threading.Lock()
+        self.used = set()
+        self.by_url = {}
+        for entry in entries:
+            self.by_url.setdefault((entry['method'], entry['url']), []).append(entry)
+        self.session = _ReplaySession(self)
+        self.timeout = None
+        self.replayed = 0
+
+    @classmethod
+    def load(cls, path, speed=0.0):
+        """
+        :param path: recording saved by TrafficRecorder.
+        :param speed: fraction of the recorded latency to wait before each response, 0 to answer at once.
+        """
+        return cls(read_traffic(path), speed=speed)
+
+    def replay(self, method, url, params, payload):
+        """
+        :return: the recorded request answering the one given.
+        """
+        candidates = self.by_url.get((method, url.split('?', 1)[0]), [])
+        key = _key(method, url, params, _recordable(payload))
+        with self.lock:
+            matching = [entry for entry in candidates
+                        if _key(entry['method'], entry['url'], entry['params'], entry['payload']) == key]
+            entry = next((entry for entry in matching + candidates if entry['seq'] not in self.used), None)
+            if entry is None and (matching or candidates):
+                entry = (matching or candidates)[-1]
+            if entry is None:
+                raise ReplayError("{} {} was not recorded".format(method, url))
+            self.used.add(entry['seq'])
+            self.replayed += 1
+        if self.speed and entry.get('seconds'):
+            time.sleep(entry['seconds'] * self.speed)
+        return entry
+
+    def _body(self, entry):
+        body = entry.get('response')
+        if isinstance(body, dict) and body.get('hashes'):
+            body = dict(body, hashes=[])
+        return dict(entry, response=body)
+
+    def make_get_request(self, url, **kwargs):
+        return _ReplayResponse(self._body(self.replay('GET', url, kwargs.get('params'), None)))
+
+    def make_delete_request(self, url, payload=None, params=None):
+        return _ReplayResponse(self.replay('DELETE', url, params, payload))
+
+    def _decoded(self, method, url, payload, params):
+        entry = self.replay(method, url, params, payload)
+        if entry['status'] != 200:
+            raise ConnectionError("Unexpected HTTP status code: {}".format(entry['status']),
+                                  body=entry.get('response'), status_code=entry['status'])
+        return entry['response']
+
+    def make_post_request(self, url, payload=None, params=None, files_attached=False):
+        return self._decoded('POST', url, payload, params)
+
+    def make_put_request(self, url, payload=None, params=None):
+        return self._decoded('PUT', url, payload, params)
+
+    def make_patch_request(self, url, payload=None, params=None):
+        return self._decoded('PATCH', url, payload, params)
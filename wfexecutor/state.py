@@ -0,0 +1,169 @@
+import json
+import logging
+import os
+import pickle
+import threading
+
+_state_lock = threading.Lock()
+
+
+class ExecutionState(object):
+    """
+    Progress of an execution, kept in a journal file so that an interrupted run can be resumed. The journal
+    has one JSON record per line and is only ever appended to, each record being flushed and synced to disk
+    before going on, so a crash can at most lose a partially written last line, which is ignored on reading.
+    Besides the coarse phases (history, workflow, datamap, parameters and invocation), the journal records
+    the progress of each input upload, each downloaded output and each clean up action. Files written by
+    previous versions as a pickled ExecutionState are migrated when started.
+    """
+
+    fields = ('wf_from_file', 'datamap', 'params', 'results', 'input_history')
+
+    def __init__(self, path):
+        self.path = path
+        self.wf_from_file = None
+        self.datamap = None
+        self.params = None
+        self.results = None
+        self.input_history = None
+        self.uploads = {}
+        self.downloads = {}
+        self.actions = set()
+        self._saved = {}
+
+    @staticmethod
+    def start(path):
+        es = ExecutionState(path)
+        if os.path.isfile(path):
+            try:
+                with open(path, mode='rb') as d:
+                    is_pickle = d.read(1) == b'\x80'
+                if is_pickle:
+                    es._migrate_pickle()
+                else:
+                    es._replay()
+                # compact the journal, so that it doesn't grow over restarts
+                es._rewrite()
+            except Exception:
+                logging.warning("Could not read execution state file {}.".format(path))
+                es = ExecutionState(path)
+        return es
+
+    def _migrate_pickle(self):
+        with open(self.path, mode='rb') as d:
+            old = pickle.load(d)
+        if not isinstance(old, ExecutionState):
+            raise ValueError("The provided file {} does not have an ExecutionState object serialised"
+                             .format(self.path))
+        logging.info("Migrating pickled execution state {} to a journal".format(self.path))
+        for field in self.fields:
+            setattr(self, field, old.__dict__.get(field))
+        self.uploads = old.__dict__.get('uploads') or {}
+
+    def _replay(self):
+        with open(self.path) as d:
+            for line_number, line in enumerate(d, start=1):
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    logging.warning("Ignoring incomplete record in line {} of {}".format(line_number, self.path))
+                    continue
+                self._apply(record)
+
+    def _apply(self, record):
+        if record['type'] == 'set' and record['key'] in self.fields:
+            setattr(self, record['key'], record['value'])
+            self._saved[record['key']] = json.dumps(record['value'], sort_keys=True)
+        elif record['type'] == 'upload':
+            self.uploads.setdefault(record['label'], {}).update(record['progress'])
+        elif record['type'] == 'download':
+            self.downloads[record['id']] = record['path']
+        elif record['type'] == 'action':
+            self.actions.add(record['action'])
+
+    def _records(self):
+        for field in self.fields:
+            if getattr(self, field) is not None:
+                yield {'type': 'set', 'key': field, 'value': getattr(self, field)}
+        for label, progress in self.uploads.items():
+            yield {'type': 'upload', 'label': label, 'progress': progress}
+        for dataset_id, path in self.downloads.items():
+            yield {'type': 'download', 'id': dataset_id, 'path': path}
+        for action in sorted(self.actions):
+            yield {'type': 'action', 'action': action}
+
+    def _rewrite(self):
+        tmp_path = "{}.tmp".format(self.path)
+        with open(tmp_path, mode='w') as d:
+            for record in self._records():
+                d.write(json.dumps(record) + "\n")
+            d.flush()
+            os.fsync(d.fileno())
+        os.replace(tmp_path, self.path)
+        self._saved = {field: json.dumps(getattr(self, field), sort_keys=True)
+                       for field in self.fields if getattr(self, field) is not None}
+
+    def _append(self, records):
+        with open(self.path, mode='a') as d:
+            d.write("".join(json.dumps(record) + "\n" for record in records))
+            d.flush()
+            os.fsync(d.fileno())
+
+    def save_state(self):
+        """
+        Appends to the journal the coarse phase fields that changed since the last save.
+        """
+        with _state_lock:
+            records = []
+            for field in self.fields:
+                value = getattr(self, field)
+                serialised = json.dumps(value, sort_keys=True)
+                if self._saved.get(field, 'null') != serialised:
+                    records.append({'type': 'set', 'key': field, 'value': value})
+                    self._saved[field] = serialised
+            if records:
+                self._append(records)
+
+    def upload_progress(self, label):
+        with _state_lock:
+            return dict(self.uploads.get(label, {}))
+
+    def update_upload(self, label, **progress):
+        """
+        Records progress of the upload of an input, like its tus url and offset or the resulting dataset id.
+        Safe to call from concurrent uploads.
+
+        :param label: input label
+        :param progress: values to record for the upload
+        :return:
+        """
+        with _state_lock:
+            self.uploads.setdefault(label, {}).update(progress)
+            self._append([{'type': 'upload', 'label': label, 'progress': progress}])
+
+    def is_downloaded(self, dataset_id):
+        with _state_lock:
+            return dataset_id in self.downloads
+
+    def record_download(self, dataset_id, path):
+        """
+        Records that a dataset was fully downloaded to the local path given. Safe to call from concurrent
+        downloads.
+        """
+        with _state_lock:
+            self.downloads[dataset_id] = path
+            self._append([{'type': 'download', 'id': dataset_id, 'path': path}])
+
+    def is_done(self, action):
+        with _state_lock:
+            return action in self.actions
+
+    def record_action(self, action):
+        """
+        Records that a clean up or export action, like deleting a history, has been done.
+
+        :param action: name of the action
+        """
+        with _state_lock:
+            self.actions.add(action)
+            self._append([{'type': 'action', 'action': action}])
@@ -0,0 +1,160 @@
+import json
+import os
+
+import pytest
+import yaml
+from bioblend import ConnectionError
+
+from wfexecutor import PollingPolicy
+from wfexecutor.batch import batch_exit_code, read_batch_manifest, run_batch
+from wfexecutor.conftest import FakeGalaxy as BaseGalaxy, FakeResponse
+
+workflow_json = {'name': 'wf', 'steps': {
+    '0': {'label': 'matrix', 'type': 'data_input', 'tool_id': None},
+    '1': {'label': 'filter', 'type': 'tool', 'tool_id': 'filter_tool', 'tool_version': '1.0'},
+}}
+
+
+class FakeGalaxy(BaseGalaxy):
+    """
+    Galaxy where the workflow invocation for history 'bad' fails at a tool, and every other one finishes
+    after being polled twice. Histories in undeletable can't be deleted.
+    """
+
+    def __init__(self):
+        self.workflows = self
+        self.invocations = self
+        self.histories = self
+        self.tools = self
+        self.datasets = self
+        self.imported = 0
+        self.deleted_workflows = []
+        self.deleted_histories = []
+        self.undeletable = set()
+        self.invoked = {}
+        self.polls = {}
+        self.running = 0
+        self.max_running = 0
+
+    def import_workflow_from_local_path(self, file_local_path):
+        self.imported += 1
+        return {'id': 'wf1'}
+
+    def show_workflow(self, workflow_id):
+        return {'id': workflow_id, 'name': 'wf', 'inputs': {'0': {'label': 'matrix'}}}
+
+    def delete_workflow(self, workflow_id):
+        self.deleted_workflows.append(workflow_id)
+
+    def show_tool(self, tool_id):
+        return {'name': 'Filter', 'version': '1.0'}
+
+    def create_history(self, name):
+        return {'id': 'in_' + name}
+
+    def invoke_workflow(self, workflow_id, inputs, params, history_name):
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        invocation = {'id': 'inv_' + history_name, 'workflow_id': workflow_id, 'history_id': history_name}
+        self.invoked[invocation['id']] = invocation
+        return invocation
+
+    def show_invocation(self, workflow_id, invocation_id):
+        return {'id': invocation_id, 'state': 'scheduled'}
+
+    def get_invocation_step_jobs_summary(self, invocation_id):
+        return [{'id': 'step1', 'states': {'ok': 1}}]
+
+    def make_get_request(self, url, params):
+        if '/tools/' in url:
+            return FakeResponse(self.show_tool(url.rsplit('/', 1)[1]))
+        history_id = url.split('/')[-2]
+        if 'history_content_type' not in params['q']:
+            # contents listed to download the results
+            return FakeResponse([])
+        self.polls[history_id] = self.polls.get(history_id, 0) + 1
+        done = self.polls[history_id] >= 2
+        if done:
+            self.running -= 1 if self.polls[history_id] == 2 else 0
+        state = 'ok' if done else 'running'
+        if history_id == 'bad_results' and done:
+            state = 'error'
+        return FakeResponse([{'id': 'e', 'state': state, 'deleted': False, 'purged': False,
+                              'update_time': '2024-05-01T10:00:0{}'.format(self.polls[history_id])}])
+
+    def delete_history(self, history_id, purge=False):
+        if history_id in self.undeletable:
+            raise ConnectionError("Connection aborted")
+        self.deleted_histories.append(history_id)
+
+
+def _batch_files(tmp_path, names, **entry):
+    """
+    Writes the workflow and a batch manifest with a run for each history name.
+
+    :return: tuple with the workflow path, the manifest path and the output directory.
+    """
+    wf_path = tmp_path / 'wf.json'
+    wf_path.write_text(json.dumps(workflow_json))
+    entries = []
+    for name in names:
+        inputs_path = tmp_path / '{}_inputs.yaml'.format(name)
+        inputs_path.write_text(yaml.safe_dump({'matrix': {'dataset_id': 'ds_' + name}}))
+        entries.append(dict(entry, history=name, inputs=str(inputs_path)))
+    manifest_path = tmp_path / 'batch.yaml'
+    manifest_path.write_text(yaml.safe_dump(entries))
+    return str(wf_path), str(manifest_path), str(tmp_path / 'out')
+
+
+polling = PollingPolicy(first_check=0, min_interval=0.01, max_interval=0.02, jitter=0)
+
+
+def test_batch_imports_once_and_reports_each_run(tmp_path):
+    wf_path, manifest_path, output_dir = _batch_files(tmp_path, ['s1', 'bad', 's2', 's3'])
+    gi = FakeGalaxy()
+    runs = read_batch_manifest(manifest_path, output_dir)
+    runs = run_batch(gi, wf_path, runs, output_dir, max_concurrent_runs=2, polling=polling)
+
+    assert gi.imported == 1
+    assert gi.max_running <= 2
+    assert [run.exit_code for run in runs] == [0, 1, 0, 0]
+    # failed runs keep their state and histories, and the workflow is kept to resume them
+    assert os.path.isfile(os.path.join(output_dir, 'bad', 'exec_state.journal'))
+    assert not os.path.isfile(os.path.join(output_dir, 's1', 'exec_state.journal'))
+    assert 'bad_results' not in gi.deleted_histories
+    assert {'s1_results', 'in_s1', 's3_results'} <= set(gi.deleted_histories)
+    assert gi.deleted_workflows == []
+    assert os.path.isfile(os.path.join(output_dir, 's2', 'software_versions_galaxy.txt'))
+    with open(os.path.join(output_dir, 'batch_summary.tsv')) as f:
+        summary = [line.split("\t") for line in f.read().splitlines()]
+    assert [(row[0], row[1]) for row in summary[1:]] == [('s1', '0'), ('bad', '1'), ('s2', '0'), ('s3', '0')]
+    assert batch_exit_code(runs) == 1
+
+
+def test_batch_run_whose_histories_cant_be_deleted(tmp_path):
+    wf_path, manifest_path, output_dir = _batch_files(tmp_path, ['s1', 's2'])
+    gi = FakeGalaxy()
+    gi.undeletable = {'s2_results'}
+    runs = run_batch(gi, wf_path, read_batch_manifest(manifest_path, output_dir), output_dir, polling=polling)
+    # as for single runs, results were retrieved, and the state is kept to retry the clean up
+    assert [run.exit_code for run in runs] == [0, 3]
+    assert batch_exit_code(runs) == 3
+    assert os.path.isfile(os.path.join(output_dir, 's2', 'exec_state.journal'))
+    with open(os.path.join(output_dir, 's2', 'histories_to_check.txt')) as f:
+        assert f.read().splitlines() == ['s2_results', 'in_s2']
+    assert gi.deleted_workflows == ['wf1']
+
+
+def test_batch_manifest_rejects_library_export(tmp_path):
+    wf_path, manifest_path, output_dir = _batch_files(tmp_path, ['s1'], library_name='results')
+    with pytest.raises(ValueError, match='library_name'):
+        read_batch_manifest(manifest_path, output_dir)
+
+
+def test_batch_rejects_allowed_errors_of_unknown_steps(tmp_path):
+    wf_path, manifest_path, output_dir = _batch_files(tmp_path, ['s1'])
+    gi = FakeGalaxy()
+    runs = read_batch_manifest(manifest_path, output_dir)
+    with pytest.raises(ValueError):
+        run_batch(gi, wf_path, runs, output_dir, allowed_errors={'missing_step': ['any']})
+    assert gi.imported == 0
@@ -0,0 +1,57 @@
+import hashlib
+
+from wfexecutor import UploadCache, file_digest
+from wfexecutor.conftest import FakeGalaxy as BaseGalaxy
+
+
+class FakeHistories(object):
+
+    def __init__(self):
+        self.histories = []
+
+    def get_histories(self, name=None):
+        return [h for h in self.histories if h['name'] == name]
+
+    def create_history(self, name):
+        history = {'id': 'h{}'.format(len(self.histories)), 'name': name}
+        self.histories.append(history)
+        return history
+
+
+class FakeGalaxy(BaseGalaxy):
+
+    def __init__(self):
+        self.histories = FakeHistories()
+        self.datasets = self
+        self.tools = self
+        self.uploaded = {}
+
+    def upload_file(self, path, history_id, file_name, file_type):
+        dataset_id = 'd{}'.format(len(self.uploaded))
+        self.uploaded[dataset_id] = {'id': dataset_id, 'state': 'ok', 'history_id': history_id}
+        return {'outputs': [{'id': dataset_id}]}
+
+    def show_dataset(self, dataset_id):
+        return self.uploaded[dataset_id]
+
+
+def test_file_digest(tmp_path):
+    path = tmp_path / 'matrix.mtx'
+    path.write_bytes(b'x' * 3000)
+    assert file_digest(str(path), chunk_size=1024) == hashlib.sha256(b'x' * 3000).hexdigest()
+
+
+def test_upload_cache_reuses_ok_datasets(tmp_path):
+    path = tmp_path / 'genes.gtf'
+    path.write_text('gene\n')
+    gi = FakeGalaxy()
+    cache = UploadCache(str(tmp_path / 'uploads.json'))
+    first = cache.upload(gi, str(path), 'gtf', 'gtf')
+    assert UploadCache(str(tmp_path / 'uploads.json')).upload(gi, str(path), 'gtf', 'gtf') == first
+    assert len(gi.uploaded) == 1
+    assert len(gi.histories.histories) == 1
+    # a different datatype is a different dataset
+    cache.upload(gi, str(path), 'gtf', 'txt')
+    assert len(gi.uploaded) == 2
+    gi.uploaded[first]['purged'] = True
+    assert cache.upload(gi, str(path), 'gtf', 'gtf') != first
@@ -0,0 +1,130 @@
+import asyncio
+
+import wfexecutor
+from wfexecutor import completion_state, completion_state_async
+from wfexecutor.conftest import FakeGalaxy as BaseGalaxy
+
+
+class FakeDatasets(object):
+
+    def __init__(self, datasets):
+        self.datasets = datasets
+        self.calls = 0
+
+    def show_dataset(self, dataset_id):
+        self.calls += 1
+        return self.datasets[dataset_id]
+
+
+class FakeJobs(object):
+
+    def __init__(self, jobs):
+        self.jobs = jobs
+
+    def show_job(self, job_id):
+        return self.jobs[job_id]
+
+
+class FakeGalaxy(BaseGalaxy):
+
+    def __init__(self, datasets, jobs):
+        self.datasets = FakeDatasets(datasets)
+        self.jobs = FakeJobs(jobs)
+
+
+def errored_history(error_ids, running=0):
+    return {'state_details': {'error': len(error_ids), 'ok': 3, 'running': running},
+            'state_ids': {'error': error_ids, 'paused': []}}
+
+
+async def no_sleep(seconds):
+    pass
+
+
+def test_errors_share_one_grace_period():
+    sleeps = []
+
+    async def record_sleep(seconds):
+        sleeps.append(seconds)
+
+    datasets = {'d{}'.format(i): {'id': 'd{}'.format(i), 'state': 'error', 'resubmitted': False,
+                                  'creating_job': 'j'} for i in range(5)}
+    gi = FakeGalaxy(datasets, {'j': {'tool_id': 'flaky_tool'}})
+    allowed_error_states = {'tools': {'flaky_tool': ['any']}, 'datasets': set()}
+    checked_errors = set()
+
+    error_state, completed = completion_state(gi, errored_history(list(datasets), running=1),
+                                              allowed_error_states, checked_errors=checked_errors, sleep=record_sleep)
+    assert not error_state
+    assert not completed
+    assert sleeps == [20]
+    assert allowed_error_states['datasets'] == set(datasets)
+
+    datasets['d5'] = {'id': 'd5', 'state': 'error', 'resubmitted': False, 'creating_job': 'k'}
+    gi.jobs.jobs['k'] = {'tool_id': 'strict_tool'}
+    error_state, completed = completion_state(gi, errored_history(list(datasets)),
+                                              allowed_error_states, checked_errors=checked_errors, sleep=record_sleep)
+    assert error_state
+    assert completed
+    assert sleeps == [20, 20]
+    assert 'd5' not in allowed_error_states['datasets']
+
+
+def test_resubmitted_dataset_is_not_an_error():
+    gi = FakeGalaxy({'d': {'id': 'd', 'state': 'queued', 'resubmitted': True, 'creating_job': 'j'}},
+                    {'j': {'tool_id': 'strict_tool'}})
+    allowed_error_states = {'tools': {'flaky_tool': ['any']}, 'datasets': set()}
+    error_state, completed = completion_state(gi, errored_history(['d'], running=1), allowed_error_states,
+                                              sleep=no_sleep)
+    assert not error_state
+    assert not completed
+
+
+def test_cache_serves_terminal_datasets_and_jobs():
+    gi = FakeGalaxy({'e': {'id': 'e', 'state': 'error', 'resubmitted': False, 'creating_job': 'j'}},
+                    {'j': {'tool_id': 'flaky_tool', 'state': 'error'}})
+    allowed_error_states = {'tools': {'flaky_tool': ['any']}, 'datasets': set()}
+    cache = wfexecutor.MetadataCache()
+    history = errored_history(['e'], running=1)
+    for _ in range(3):
+        completion_state(gi, history, allowed_error_states, checked_errors=set(), cache=cache, sleep=no_sleep)
+    assert gi.datasets.calls == 1
+    assert cache.hits == 0
+    allowed_error_states['datasets'].clear()
+    completion_state(gi, history, allowed_error_states, wait_for_resubmission=False, cache=cache)
+    # the errored dataset might still be resubmitted, so only its job is served from the cache
+    assert gi.datasets.calls == 2
+    assert cache.hits == 1
+
+
+def test_cache_sees_errored_dataset_recover():
+    gi = FakeGalaxy({'e': {'id': 'e', 'state': 'error', 'resubmitted': True, 'creating_job': 'j'}}, {})
+    cache = wfexecutor.MetadataCache()
+    assert cache.show_dataset(gi, 'e')['state'] == 'error'
+    # the job is resubmitted and succeeds
+    gi.datasets.datasets['e'] = dict(gi.datasets.datasets['e'], state='ok')
+    assert cache.show_dataset(gi, 'e')['state'] == 'ok'
+    assert cache.show_dataset(gi, 'e')['state'] == 'ok'
+    assert gi.datasets.calls == 2
+
+
+def test_grace_periods_of_concurrent_checks_overlap():
+    gi = FakeGalaxy({'d': {'id': 'd', 'state': 'queued', 'resubmitted': True, 'creating_job': 'j'}},
+                    {'j': {'tool_id': 'strict_tool'}})
+    waits = []
+
+    async def record_sleep(seconds):
+        waits.append(('start', seconds))
+        await asyncio.sleep(0)
+        waits.append(('end', seconds))
+
+    async def check_histories():
+        return await asyncio.gather(*[
+            completion_state_async(gi, errored_history(['d'], running=1),
+                                   {'tools': {'flaky_tool': ['any']}, 'datasets': set()},
+                                   resubmission_wait=0.3, sleep=record_sleep) for _ in range(4)])
+
+    results = asyncio.run(check_histories())
+    assert results == [(False, False)] * 4
+    # each check waits once, and all of them start waiting before any is done
+    assert waits == [('start', 0.3)] * 4 + [('end', 0.3)] * 4
@@ -0,0 +1,51 @@
+from urllib3.util.retry import Retry
+
+from wfexecutor import RateLimiter, connection, get_galaxy_instance
+from wfexecutor.conftest import FakeResponse
+
+
+class FakeSession(object):
+
+    def __init__(self):
+        self.requests = []
+
+    def request(self, method, url, **kwargs):
+        self.requests.append((method, url, kwargs))
+        return FakeResponse({'id': 'x'})
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+
+def test_instance_configured_from_credentials():
+    gi = get_galaxy_instance({'url': 'http://galaxy.test', 'key': 'k', 'connect_timeout': 5, 'retries': 2},
+                             workers=6)
+    adapter = gi.session.get_adapter('http://galaxy.test/api')
+    assert adapter._pool_maxsize == 8
+    assert adapter.max_retries.total == 2
+    assert 'POST' not in adapter.max_retries.allowed_methods
+    assert gi.timeout == (5, 300)
+
+    gi.session = FakeSession()
+    assert gi.histories.create_history(name='run') == {'id': 'x'}
+    assert gi.histories.show_history('h1')['id'] == 'x'
+    assert [method for method, url, kwargs in gi.session.requests] == ['POST', 'GET']
+    assert all(kwargs['timeout'] == (5, 300) for method, url, kwargs in gi.session.requests)
+
+
+def test_retries_without_jitter_on_older_urllib3(monkeypatch):
+    class OldRetry(Retry):
+        def __init__(self, **kwargs):
+            if 'backoff_jitter' in kwargs:
+                raise TypeError("unexpected keyword argument 'backoff_jitter'")
+            super().__init__(**kwargs)
+
+    monkeypatch.setattr(connection, 'Retry', OldRetry)
+    adapter = connection.pooled_session(pool_size=2, retries=4).get_adapter('http://galaxy.test/api')
+    assert adapter.max_retries.total == 4
+
+
+def test_rate_limiter_takes_over_retries():
+    gi = get_galaxy_instance({'url': 'http://galaxy.test', 'key': 'k'})
+    RateLimiter().install(gi)
+    assert gi.session.get_adapter('http://galaxy.test/api').max_retries.total == 0
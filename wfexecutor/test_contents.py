@@ -0,0 +1,52 @@
+from wfexecutor import iter_history_contents
+from wfexecutor.conftest import FakeGalaxy as BaseGalaxy, FakeResponse
+
+
+class FakeGalaxy(BaseGalaxy):
+
+    def __init__(self, contents, paginate=True):
+        self.dataset_collections = self
+        self.contents = contents
+        self.paginate = paginate
+        self.requests = []
+        self.collections = []
+
+    def make_get_request(self, url, params):
+        self.requests.append(params)
+        if not self.paginate:
+            return FakeResponse(self.contents)
+        return FakeResponse(self.contents[params['offset']:params['offset'] + params['limit']])
+
+    def show_dataset_collection(self, collection_id):
+        self.collections.append(collection_id)
+        return {'id': collection_id, 'elements': [{'element_identifier': 'x', 'object': {'id': 'x'}}]}
+
+
+def _contents(n):
+    return [{'id': str(i), 'hid': i, 'history_content_type': 'dataset_collection' if i == 3 else 'dataset'}
+            for i in range(1, n + 1)]
+
+
+def test_contents_are_retrieved_page_by_page():
+    gi = FakeGalaxy(_contents(5))
+    items = iter_history_contents(gi, 'h', page_size=2)
+    first = next(items)
+    assert first['type'] == 'file'
+    assert len(gi.requests) == 1
+    rest = list(items)
+    assert [item['id'] for item in rest] == ['2', '3', '4', '5']
+    assert [params['offset'] for params in gi.requests] == [0, 2, 4]
+    assert gi.requests[0]['q'] == ['visible'] and gi.requests[0]['qv'] == ['true']
+    # collection elements are only retrieved when iterated
+    assert rest[1]['type'] == 'collection'
+    assert gi.collections == []
+    assert [element['object']['id'] for element in rest[1]['elements']] == ['x']
+    assert gi.collections == ['3']
+
+
+def test_server_without_pagination():
+    gi = FakeGalaxy(_contents(4), paginate=False)
+    assert [item['id'] for item in iter_history_contents(gi, 'h', page_size=2)] == ['1', '2', '3', '4']
+    gi = FakeGalaxy(_contents(2), paginate=False)
+    assert [item['id'] for item in iter_history_contents(gi, 'h', page_size=2)] == ['1', '2']
+    assert len(gi.requests) == 2
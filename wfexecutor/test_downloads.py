@@ -0,0 +1,261 @@
+import hashlib
+import io
+import json
+import os
+import tarfile
+
+from wfexecutor import ExecutionState, downloads
+from wfexecutor.conftest import FakeGalaxy as BaseGalaxy
+from wfexecutor.downloads import plan_downloads
+
+history_contents = [
+    {'type': 'file', 'id': 'a', 'name': 'out.txt', 'state': 'ok'},
+    {'type': 'file', 'id': 'b', 'name': 'out.txt', 'state': 'ok'},
+    {'type': 'file', 'id': 'c', 'name': 'failed.txt', 'state': 'error'},
+    {'type': 'collection', 'id': 'd', 'elements': [
+        {'object': {'id': 'e', 'name': 'cell_1', 'state': 'ok'}},
+        {'object': {'id': 'f', 'name': 'out.txt', 'state': 'ok'}},
+    ]},
+]
+
+
+def test_plan_downloads_names_and_skips():
+    allowed_error_states = {'tools': {}, 'datasets': {'c'}}
+    planned = plan_downloads(history_contents, 'results', allowed_error_states, use_names=True)
+    assert [d['id'] for d in planned] == ['a', 'b', 'e', 'f']
+    assert planned[0]['file_path'] == 'results/out.txt'
+    assert not planned[0]['use_default_filename']
+    # name collisions fall back to Galaxy's default file name
+    assert planned[1]['file_path'] == 'results'
+    assert planned[1]['use_default_filename']
+    assert planned[2]['file_path'] == 'results/cell_1'
+    assert planned[3]['use_default_filename']
+
+
+content = b'0123456789' * 1000
+
+
+class DisplayResponse(object):
+
+    def __init__(self, headers):
+        start = 0
+        self.status_code = 200
+        self.headers = {'content-disposition': 'attachment; filename="Galaxy1-[out].txt"'}
+        if 'Range' in headers:
+            start = int(headers['Range'][len('bytes='):-1])
+            self.status_code = 206
+        self.body = content[start:]
+
+    def raise_for_status(self):
+        pass
+
+    def iter_content(self, chunk_size):
+        for i in range(0, len(self.body), chunk_size):
+            yield self.body[i:i + chunk_size]
+
+
+class FakeGalaxy(BaseGalaxy):
+
+    def __init__(self):
+        self.datasets = self
+
+    def wait_for_dataset(self, dataset_id, check=False):
+        return {'id': dataset_id, 'name': 'out', 'state': 'ok', 'file_size': len(content), 'file_ext': 'txt',
+                'download_url': '/api/datasets/{}/display'.format(dataset_id)}
+
+
+def test_resume_and_skip_with_manifest(tmp_path, monkeypatch):
+    requests_made = []
+
+    def fake_get(url, headers, **kwargs):
+        requests_made.append(dict(headers))
+        return DisplayResponse(headers)
+
+    monkeypatch.setattr(downloads.requests, 'get', fake_get)
+    output_dir = str(tmp_path)
+    manifest = downloads.DownloadManifest(output_dir)
+    partial = tmp_path / 'Galaxy1-[out].txt'
+    partial.write_bytes(content[:4000])
+    manifest.update('a', file_path=str(partial), size=len(content), complete=False)
+    download = {'id': 'a', 'name': 'out', 'file_path': output_dir, 'use_default_filename': True}
+
+    local_path, transferred = downloads.stream_dataset(FakeGalaxy(), download, manifest)
+    assert local_path == str(partial)
+    assert transferred == len(content) - 4000
+    assert requests_made[0]['Range'] == 'bytes=4000-'
+    assert partial.read_bytes() == content
+
+    reloaded = downloads.DownloadManifest(output_dir)
+    assert reloaded.get('a')['sha256'] == hashlib.sha256(content).hexdigest()
+    assert downloads.stream_dataset(FakeGalaxy(), download, reloaded) == (str(partial), 0)
+    assert len(requests_made) == 1
+
+
+def test_manifest_appends_updates_and_compacts(tmp_path):
+    (tmp_path / downloads.OLD_MANIFEST_NAME).write_text(json.dumps({'a': {'file_path': 'a.txt', 'size': 3}}))
+    manifest = downloads.DownloadManifest(str(tmp_path))
+    assert not (tmp_path / downloads.OLD_MANIFEST_NAME).exists()
+    manifest.update('a', sha256='x', complete=True)
+    manifest.update('b', file_path='b.txt', size=4, complete=False)
+    manifest_path = tmp_path / downloads.MANIFEST_NAME
+    assert len(manifest_path.read_text().splitlines()) == 3
+    with open(str(manifest_path), mode='a') as f:
+        f.write('{"id": "b", "comp')
+
+    reloaded = downloads.DownloadManifest(str(tmp_path))
+    assert reloaded.get('a') == {'file_path': 'a.txt', 'size': 3, 'sha256': 'x', 'complete': True}
+    assert reloaded.get('b') == {'file_path': 'b.txt', 'size': 4, 'complete': False}
+    assert len(manifest_path.read_text().splitlines()) == 2
+
+
+def test_corrupted_download_is_retried_and_checksummed(tmp_path, monkeypatch):
+    responses = [b'corrupted' + content[9:], content]
+
+    def fake_get(url, headers, **kwargs):
+        response = DisplayResponse({})
+        response.body = responses.pop(0)
+        return response
+
+    class HashedGalaxy(FakeGalaxy):
+        def wait_for_dataset(self, dataset_id, check=False):
+            dataset = FakeGalaxy.wait_for_dataset(self, dataset_id, check)
+            dataset['hashes'] = [{'hash_function': 'MD5', 'hash_value': hashlib.md5(content).hexdigest()}]
+            return dataset
+
+    monkeypatch.setattr(downloads.requests, 'get', fake_get)
+    output_dir = str(tmp_path)
+    download = {'id': 'a', 'name': 'out', 'file_path': output_dir, 'use_default_filename': True}
+    assert downloads.run_downloads(HashedGalaxy(), [download]) == 2 * len(content)
+    assert (tmp_path / 'Galaxy1-[out].txt').read_bytes() == content
+    checksums = (tmp_path / downloads.CHECKSUMS_NAME).read_text()
+    assert checksums == "{}  Galaxy1-[out].txt\n".format(hashlib.sha256(content).hexdigest())
+
+    responses.extend([b'corrupted', b'corrupted'])
+    download = {'id': 'b', 'name': 'out', 'file_path': str(tmp_path / 'b.txt'), 'use_default_filename': False}
+    try:
+        downloads.stream_dataset(HashedGalaxy(), download, downloads.DownloadManifest(output_dir))
+        assert False, "A corrupted download should fail"
+    except ValueError as e:
+        assert 'b.txt' in str(e)
+
+
+def test_retrieval_from_mounted_object_store(tmp_path, monkeypatch):
+    object_store = tmp_path / 'objects'
+    object_store.mkdir()
+    (object_store / 'dataset_1.dat').write_bytes(content)
+    output_dir = tmp_path / 'results'
+    output_dir.mkdir()
+
+    class MountedGalaxy(FakeGalaxy):
+        def wait_for_dataset(self, dataset_id, check=False):
+            dataset = FakeGalaxy.wait_for_dataset(self, dataset_id, check)
+            dataset.update({'hid': 1, 'name': 'out/1',
+                            'file_name': str(object_store / 'dataset_{}.dat'.format(dataset_id))})
+            return dataset
+
+    requested = []
+    monkeypatch.setattr(downloads.requests, 'get',
+                        lambda url, headers, **kwargs: requested.append(url) or DisplayResponse({}))
+    planned = [{'id': '1', 'name': 'out/1', 'file_path': str(output_dir), 'use_default_filename': True},
+               {'id': '2', 'name': 'named.txt', 'file_path': str(output_dir / 'named.txt'),
+                'use_default_filename': False}]
+    downloads.run_downloads(MountedGalaxy(), planned, retrieval_mode='link')
+    linked = output_dir / 'Galaxy1-[out_1].txt'
+    assert linked.read_bytes() == content
+    assert os.path.samefile(str(linked), str(object_store / 'dataset_1.dat'))
+    # dataset 2 is not visible in the object store, so it is downloaded
+    assert requested == ['http://galaxy.test/api/datasets/2/display?to_ext=txt']
+    assert (output_dir / 'named.txt').read_bytes() == content
+
+
+def test_link_across_file_systems_copies(tmp_path, monkeypatch):
+    source = tmp_path / 'dataset_1.dat'
+    source.write_bytes(content)
+
+    def cross_device_link(src, dst):
+        raise OSError(18, 'Invalid cross-device link')
+
+    monkeypatch.setattr(downloads.os, 'link', cross_device_link)
+    target = tmp_path / 'linked.txt'
+    downloads._link_file(str(source), str(target))
+    # a symbolic link would break once the dataset is purged
+    assert not target.is_symlink()
+    source.unlink()
+    assert target.read_bytes() == content
+
+
+class ArchiveResponse(object):
+    status_code = 200
+    headers = {'content-type': 'application/x-tar'}
+
+    def __init__(self, path):
+        self.raw = open(path, mode='rb')
+
+    def raise_for_status(self):
+        pass
+
+
+def _cells_archive(tmp_path):
+    archive_path = tmp_path / 'cells.tgz'
+    with tarfile.open(str(archive_path), mode='w:gz') as archive:
+        for identifier in ['cell_1', 'cell_2', 'failed_cell']:
+            data = identifier.encode() * 100
+            member = tarfile.TarInfo('cells/{}.tsv'.format(identifier))
+            member.size = len(data)
+            archive.addfile(member, io.BytesIO(data))
+    return str(archive_path)
+
+
+def test_collection_downloaded_as_one_archive(tmp_path, monkeypatch):
+    archive_path = _cells_archive(tmp_path)
+    requested = []
+
+    def fake_get(url, headers, **kwargs):
+        requested.append(url)
+        return ArchiveResponse(archive_path)
+
+    monkeypatch.setattr(downloads.requests, 'get', fake_get)
+    history = [{'type': 'collection', 'id': 'c', 'elements': [
+        {'element_identifier': 'cell_1', 'object': {'id': 'e1', 'name': 'cell_1', 'state': 'ok', 'hid': 3}},
+        {'element_identifier': 'cell_2', 'object': {'id': 'e2', 'name': 'out.txt', 'state': 'ok', 'hid': 4}},
+        {'element_identifier': 'failed_cell', 'object': {'id': 'e3', 'name': 'failed', 'state': 'error'}},
+    ]}]
+    output_dir = tmp_path / 'results'
+    output_dir.mkdir()
+    planned = plan_downloads(history, str(output_dir), {'tools': {}, 'datasets': {'e3'}}, use_names=True,
+                             used_names={'out.txt'})
+    state = ExecutionState.start(str(tmp_path / 'state'))
+    downloads.run_downloads(FakeGalaxy(), planned, state=state, collection_archives=True)
+
+    assert requested == ['http://galaxy.test/api/dataset_collections/c/download']
+    assert (output_dir / 'cell_1').read_bytes() == b'cell_1' * 100
+    # a name already taken falls back to the default file name
+    assert (output_dir / 'Galaxy4-[out.txt].tsv').read_bytes() == b'cell_2' * 100
+    assert not (output_dir / 'failed').exists()
+    assert state.is_downloaded('e1') and state.is_downloaded('e2')
+
+
+def test_corrupted_archive_element_downloaded_on_its_own(tmp_path, monkeypatch):
+    archive_path = _cells_archive(tmp_path)
+    requested = []
+
+    def fake_get(url, headers, **kwargs):
+        requested.append(url)
+        return ArchiveResponse(archive_path) if url.endswith('/download') else DisplayResponse(headers)
+
+    monkeypatch.setattr(downloads.requests, 'get', fake_get)
+    history = [{'type': 'collection', 'id': 'c', 'elements': [
+        {'element_identifier': 'cell_1', 'object': {'id': 'e1', 'name': 'cell_1', 'state': 'ok', 'file_size': 600}},
+        # the collection lists a size that the archive member doesn't have
+        {'element_identifier': 'cell_2', 'object': {'id': 'e2', 'name': 'cell_2', 'state': 'ok',
+                                                    'file_size': len(content)}},
+    ]}]
+    output_dir = tmp_path / 'results'
+    output_dir.mkdir()
+    planned = plan_downloads(history, str(output_dir), {'tools': {}, 'datasets': set()}, use_names=True)
+    downloads.run_downloads(FakeGalaxy(), planned, collection_archives=True)
+
+    assert requested == ['http://galaxy.test/api/dataset_collections/c/download',
+                         'http://galaxy.test/api/datasets/e2/display?to_ext=txt']
+    assert (output_dir / 'cell_1').read_bytes() == b'cell_1' * 100
+    assert (output_dir / 'cell_2').read_bytes() == content
@@ -1,4 +1,6 @@
+import json
 import os
+import pickle
 
 from wfexecutor import ExecutionState
 
@@ -16,3 +18,44 @@ def test_reload_es():
     es = ExecutionState.start(test_state)
     assert 'key' in es.datamap
     assert es.datamap['key'] == 'value'
+
+
+def test_upload_progress(tmp_path):
+    path = str(tmp_path / "uploads.bin")
+    es = ExecutionState.start(path)
+    assert es.upload_progress('matrix') == {}
+    es.update_upload('matrix', url='http://galaxy.test/api/upload/resumable_upload/abc', offset=100)
+    es.update_upload('matrix', offset=200)
+    es = ExecutionState.start(path)
+    assert es.upload_progress('matrix')['offset'] == 200
+    assert es.upload_progress('matrix')['url'].endswith('/abc')
+
+
+def test_journal_records_and_torn_line(tmp_path):
+    path = str(tmp_path / "journal")
+    es = ExecutionState.start(path)
+    es.results = {'history_id': 'h1', 'id': 'i1'}
+    es.save_state()
+    es.record_download('d1', '/out/a.txt')
+    es.record_action('delete_results_history')
+    with open(path, mode='a') as f:
+        f.write('{"type": "download", "id": "d2", "pa')
+    es = ExecutionState.start(path)
+    assert es.results['history_id'] == 'h1'
+    assert es.is_downloaded('d1')
+    assert not es.is_downloaded('d2')
+    assert es.is_done('delete_results_history')
+    assert not es.is_done('delete_workflow')
+
+
+def test_migrate_pickled_state(tmp_path):
+    path = str(tmp_path / "exec_state.pickle")
+    old = ExecutionState.__new__(ExecutionState)
+    old.__dict__ = {'path': path, 'datamap': {'0': {'id': 'x', 'src': 'hda'}}, 'params': {}}
+    with open(path, mode='wb') as f:
+        pickle.dump(old, f)
+    es = ExecutionState.start(path)
+    assert es.datamap['0']['id'] == 'x'
+    assert es.results is None
+    with open(path) as f:
+        assert json.loads(f.readline())['type'] == 'set'
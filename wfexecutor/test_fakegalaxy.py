@@ -0,0 +1,145 @@
+import os
+import time
+from concurrent.futures import wait
+
+from wfexecutor import (IncrementalDownloader, InvocationProgress, completion_state, download_results,
+                        export_results_to_data_library, get_galaxy_instance, load_input_files,
+                        supports_resumable_uploads, uploads)
+from wfexecutor.fakegalaxy import FakeGalaxyServer
+
+workflow_json = {'name': 'wf', 'steps': {
+    '0': {'label': 'matrix', 'type': 'data_input', 'tool_id': None},
+    '1': {'label': 'filter', 'type': 'tool', 'tool_id': 'filter_tool', 'tool_version': '1.0'},
+}}
+
+
+def test_workflow_run_against_fake_galaxy(tmp_path):
+    input_path = tmp_path / 'matrix.txt'
+    input_path.write_bytes(b'1\t2\n' * 1000)
+    with FakeGalaxyServer(datasets=3, collection_elements=2, dataset_size=5000, scheduling_seconds=0.05,
+                          job_seconds=0.1, failed_datasets=1) as server:
+        gi = get_galaxy_instance({'url': server.url, 'key': 'fake'})
+        history = gi.histories.create_history(name='inputs')
+        workflow = gi.workflows.show_workflow(gi.workflows.import_workflow_dict(workflow_json)['id'])
+        datamap = load_input_files(gi, {'matrix': {'path': str(input_path), 'type': 'tabular'}}, workflow, history)
+        assert server.hdas[datamap['0']['id']]['file_size'] == 4000
+
+        invocation = gi.workflows.invoke_workflow(workflow_id=workflow['id'], inputs=datamap, history_name='results')
+        progress = InvocationProgress(gi, invocation_id=invocation['id'], history_id=invocation['history_id'])
+        allowed_error_states = {'tools': {'filter_tool': None}, 'datasets': set()}
+        while True:
+            error_state, completed = completion_state(gi, progress.poll(), allowed_error_states,
+                                                      wait_for_resubmission=False)
+            if error_state or completed:
+                break
+            time.sleep(0.02)
+        # the failed element is allowed to fail
+        assert (error_state, completed) == (False, True)
+        assert len(allowed_error_states['datasets']) == 1
+
+        output_dir = tmp_path / 'out'
+        output_dir.mkdir()
+        downloaded = download_results(gi, invocation['history_id'], str(output_dir), allowed_error_states,
+                                      use_names=True, workers=2)
+        assert downloaded == 4 * 5000
+        assert sorted(name for name in os.listdir(str(output_dir)) if not name.startswith('.')) == \
+            ['element_0.txt', 'output_0.txt', 'output_1.txt', 'output_2.txt']
+
+        library = gi.libraries.create_library(name='results')
+        export_results_to_data_library(gi, invocation['history_id'], library['id'], allowed_error_states)
+        folders = gi.libraries.get_folders(library['id'])
+        assert sorted(folder['name'] for folder in folders) == ['/results', '/results/elements']
+        assert server.requests['GET /api/datasets/{id}/display'] == 4
+
+
+def _run_with_slow_last_job(server, gi):
+    workflow = gi.workflows.import_workflow_dict(workflow_json)
+    invocation = gi.workflows.invoke_workflow(workflow_id=workflow['id'], history_name='results')
+    # the job of the last output runs for longer than the others
+    jobs = server.invocations[invocation['id']]['steps']['1']
+    jobs[-1]['seconds'] = 10
+    return invocation
+
+
+def test_incremental_downloads_while_the_workflow_runs(tmp_path, clock):
+    with FakeGalaxyServer(datasets=3, dataset_size=1000, scheduling_seconds=0, job_seconds=1, clock=clock) as server:
+        gi = get_galaxy_instance({'url': server.url, 'key': 'fake'})
+        invocation = _run_with_slow_last_job(server, gi)
+        progress = InvocationProgress(gi, invocation_id=invocation['id'], history_id=invocation['history_id'])
+        allowed_error_states = {'tools': {}, 'datasets': set()}
+        downloader = IncrementalDownloader(gi, invocation['history_id'], str(tmp_path), allowed_error_states,
+                                           use_names=True, workers=2)
+        clock.now += 2
+        history = progress.poll()
+        assert history['state'] == 'running'
+        assert downloader.poll(history) == 2
+        wait(downloader.futures)
+        # outputs that are ready are fetched while the last job still runs
+        assert server.requests['GET /api/datasets/{id}/display'] == 2
+        assert sorted(name for name in os.listdir(str(tmp_path)) if not name.startswith('.')) == \
+            ['output_0.txt', 'output_1.txt']
+
+        clock.now += 10
+        history = progress.poll()
+        assert completion_state(gi, history, allowed_error_states, wait_for_resubmission=False) == (False, True)
+        downloader.poll(history)
+        assert downloader.finish() == 3 * 1000
+        # the final pass only fetches what was not downloaded yet
+        assert server.requests['GET /api/datasets/{id}/display'] == 3
+        assert sorted(name for name in os.listdir(str(tmp_path)) if not name.startswith('.')) == \
+            ['output_0.txt', 'output_1.txt', 'output_2.txt']
+
+
+def test_incremental_downloads_hold_collection_elements_for_archives(tmp_path, clock):
+    with FakeGalaxyServer(datasets=1, collection_elements=2, dataset_size=1000, scheduling_seconds=0,
+                          job_seconds=1, clock=clock) as server:
+        gi = get_galaxy_instance({'url': server.url, 'key': 'fake'})
+        invocation = _run_with_slow_last_job(server, gi)
+        progress = InvocationProgress(gi, invocation_id=invocation['id'], history_id=invocation['history_id'])
+        downloader = IncrementalDownloader(gi, invocation['history_id'], str(tmp_path),
+                                           {'tools': {}, 'datasets': set()}, use_names=True,
+                                           collection_archives=True)
+        clock.now += 2
+        # the finished element waits for the archive of its collection
+        assert downloader.poll(progress.poll()) == 1
+        wait(downloader.futures)
+        assert server.requests['GET /api/datasets/{id}/display'] == 1
+
+        clock.now += 10
+        progress.poll()
+        # the fake Galaxy can't produce collection archives, so elements are then downloaded one by one
+        assert downloader.finish() == 3 * 1000
+        assert server.requests['GET /api/datasets/{id}/display'] == 3
+
+
+def test_large_inputs_uploaded_through_tus(tmp_path):
+    workflow_json = {'name': 'wf', 'steps': {
+        '0': {'label': 'matrix', 'type': 'data_input', 'tool_id': None},
+        '1': {'label': 'genes', 'type': 'data_input', 'tool_id': None},
+    }}
+    large_path = tmp_path / 'matrix.txt'
+    large_path.write_bytes(b'1' * (uploads.RESUMABLE_UPLOAD_MIN_SIZE + 1000))
+    small_path = tmp_path / 'genes.txt'
+    small_path.write_bytes(b'g' * 1000)
+    with FakeGalaxyServer(version='23.1') as server:
+        gi = get_galaxy_instance({'url': server.url, 'key': 'fake'})
+        assert supports_resumable_uploads(gi)
+        history = gi.histories.create_history(name='inputs')
+        workflow = gi.workflows.show_workflow(gi.workflows.import_workflow_dict(workflow_json)['id'])
+        datamap = load_input_files(gi, {'matrix': {'path': str(large_path), 'type': 'tabular'},
+                                        'genes': {'path': str(small_path), 'type': 'tabular'}},
+                                   workflow, history, resumable=True)
+        assert server.hdas[datamap['0']['id']]['file_size'] == uploads.RESUMABLE_UPLOAD_MIN_SIZE + 1000
+        assert server.hdas[datamap['1']['id']]['file_size'] == 1000
+        # the large file is sent in two chunks, the small one in a single request of bioblend's upload, which
+        # also goes through tus from 22.01 on
+        assert server.requests['POST /api/upload/resumable_upload'] == 2
+        assert server.requests['PATCH /api/upload/resumable_upload/{id}'] == 2 + 1
+        assert server.requests['POST /api/tools/fetch'] == 2
+
+
+def test_resumable_uploads_need_galaxy_22_01():
+    for version, supported in (('9.1', False), ('21.09', False), ('22.01', True), ('23.1', True)):
+        with FakeGalaxyServer(version=version) as server:
+            gi = get_galaxy_instance({'url': server.url, 'key': 'fake'})
+            assert supports_resumable_uploads(gi) == supported
@@ -0,0 +1,73 @@
+from wfexecutor import export_results_to_data_library
+from wfexecutor.conftest import FakeGalaxy as BaseGalaxy, FakeResponse
+
+
+class FakeLibraries(object):
+
+    def __init__(self):
+        self.folders = {}
+        self.uploads = []
+        self.names = {}
+
+    def get_folders(self, library_id, name):
+        return [{'id': self.folders[name]}] if name in self.folders else []
+
+    def create_folder(self, library_id, folder_name, base_folder_id=None):
+        parent = [path for path, folder_id in self.folders.items() if folder_id == base_folder_id]
+        path = (parent[0] if parent else '') + '/' + folder_name
+        self.folders[path] = 'f{}'.format(len(self.folders))
+        return [{'id': self.folders[path]}]
+
+    def upload_from_galaxy_filesystem(self, library_id, filesystem_paths, folder_id, link_data_only,
+                                      tag_using_filenames):
+        paths = filesystem_paths.split("\n")
+        self.uploads.append((folder_id, paths))
+        return [{'id': 'ld_' + path, 'name': path.rsplit('/', 1)[1]} for path in paths]
+
+    def wait_for_dataset(self, library_id, dataset_id):
+        return {'id': dataset_id, 'state': 'ok'}
+
+    def update_library_dataset(self, dataset_id, name):
+        self.names[dataset_id] = name
+
+
+class FakeGalaxy(BaseGalaxy):
+
+    def __init__(self, contents, datasets):
+        self.libraries = FakeLibraries()
+        self.histories = self
+        self.datasets = self
+        self.dataset_collections = self
+        self.contents = contents
+        self.hda = datasets
+
+    def show_history(self, history_id, **kwargs):
+        return {'id': history_id, 'name': 'run', 'state': 'ok'}
+
+    def make_get_request(self, url, params):
+        return FakeResponse(self.contents[params['offset']:params['offset'] + params['limit']])
+
+    def show_dataset_collection(self, collection_id):
+        return {'id': collection_id, 'elements': [
+            {'object': {'id': 'e{}'.format(i), 'name': 'cell_{}'.format(i), 'state': 'ok'}} for i in range(5)
+        ]}
+
+    def show_dataset(self, dataset_id):
+        return self.hda[dataset_id]
+
+
+def test_export_batches_uploads_per_folder():
+    contents = [
+        {'history_content_type': 'dataset', 'id': 'a', 'name': 'report.html', 'state': 'ok'},
+        {'history_content_type': 'dataset', 'id': 'b', 'name': 'failed.txt', 'state': 'error'},
+        {'history_content_type': 'dataset_collection', 'id': 'c', 'name': 'cells'},
+    ]
+    datasets = {'e{}'.format(i): {'id': 'e{}'.format(i), 'name': 'cell_{}'.format(i), 'state': 'ok',
+                                  'file_name': '/data/e{}.dat'.format(i)} for i in range(5)}
+    datasets['a'] = {'id': 'a', 'name': 'report.html', 'state': 'ok', 'file_name': '/data/a.dat'}
+    gi = FakeGalaxy(contents, datasets)
+    export_results_to_data_library(gi, 'h', 'lib', {'tools': {}, 'datasets': {'b'}}, batch_size=3)
+    assert set(gi.libraries.folders) == {'/run', '/run/cells'}
+    assert [len(paths) for folder_id, paths in gi.libraries.uploads] == [1, 3, 2]
+    assert gi.libraries.names['ld_/data/a.dat'] == 'report.html'
+    assert gi.libraries.names['ld_/data/e4.dat'] == 'cell_4'
@@ -0,0 +1,63 @@
+import json
+
+from bioblend import ConnectionError
+
+from wfexecutor import Metrics, endpoint_name
+from wfexecutor.conftest import FakeGalaxy as BaseGalaxy, FakeResponse
+
+
+class FakeGalaxy(BaseGalaxy):
+    """
+    Galaxy whose requests take 0.2 s, with POST requests failing.
+    """
+
+    def __init__(self, clock):
+        self.clock = clock
+
+    def make_get_request(self, url, **kwargs):
+        self.clock.now += 0.2
+        return FakeResponse()
+
+    def make_post_request(self, url, payload=None, **kwargs):
+        self.clock.now += 0.2
+        raise ConnectionError("Unexpected HTTP status code: 500", status_code=500)
+
+    make_put_request = make_patch_request = make_delete_request = make_get_request
+
+
+def test_endpoint_names_group_identifiers():
+    assert endpoint_name('GET', 'https://galaxy.test/api/histories/1cd8e2f6b131e891/contents?v=dev') == \
+        'GET /api/histories/{id}/contents'
+    assert endpoint_name('PATCH', 'https://galaxy.test/api/upload/resumable_upload/'
+                                  '7f0e1a2b-3c4d-5e6f-7a8b-9c0d1e2f3a4b') == \
+        'PATCH /api/upload/resumable_upload/{id}'
+
+
+def test_phases_calls_and_bytes_are_reported(tmp_path, clock):
+    metrics = Metrics(clock=clock)
+    gi = metrics.install(FakeGalaxy(clock))
+    metrics.start_phase('upload')
+    gi.make_get_request('https://galaxy.test/api/histories/1cd8e2f6b131e891')
+    gi.make_get_request('https://galaxy.test/api/histories/2cd8e2f6b131e891')
+    try:
+        gi.make_post_request('https://galaxy.test/api/tools/fetch')
+    except ConnectionError:
+        pass
+    metrics.add_bytes('upload', 100)
+    metrics.start_phase('download')
+    clock.now += 1.5
+    metrics.write(str(tmp_path / 'metrics' / 'run.json'), prometheus=True)
+
+    with open(str(tmp_path / 'metrics' / 'run.json')) as f:
+        report = json.load(f)
+    assert [phase['name'] for phase in report['phases']] == ['upload', 'download']
+    assert abs(report['phase_totals']['download'] - 1.5) < 1e-9
+    history_calls = report['api_calls']['GET /api/histories/{id}']
+    assert history_calls['count'] == 2 and history_calls['errors'] == 0
+    assert history_calls['buckets']['0.25'] == 2
+    assert report['api_calls']['POST /api/tools/fetch']['errors'] == 1
+    assert report['bytes'] == {'upload': 100, 'download': 0}
+    prometheus = (tmp_path / 'metrics' / 'run.prom').read_text()
+    assert 'wfexecutor_api_request_duration_seconds_bucket{endpoint="GET /api/histories/{id}",le="+Inf"} 2' \
+        in prometheus
+    assert 'wfexecutor_transferred_bytes_total{direction="upload"} 100' in prometheus
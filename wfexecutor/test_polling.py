@@ -0,0 +1,24 @@
+from wfexecutor import PollingPolicy
+
+
+def test_backoff_and_reset():
+    waits = []
+    policy = PollingPolicy(first_check=1, min_interval=10, max_interval=30, backoff=2, jitter=0,
+                           sleep=waits.append)
+    for _ in range(4):
+        policy.wait()
+    assert waits == [1, 10, 20, 30]
+    policy.observe({'ok': 1})
+    policy.observe({'ok': 1})
+    policy.wait()
+    assert waits[-1] == 30
+    assert policy.observe({'ok': 2})
+    policy.wait()
+    assert waits[-1] == 10
+    assert policy.waited == sum(waits)
+
+
+def test_jitter_stays_in_bounds():
+    policy = PollingPolicy(first_check=10, min_interval=10, max_interval=10, jitter=0.2, sleep=lambda s: None)
+    for _ in range(20):
+        assert 8 <= policy.wait() <= 12
@@ -0,0 +1,68 @@
+from bioblend import ConnectionError
+
+from wfexecutor import InvocationProgress, completion_state
+from wfexecutor.conftest import FakeGalaxy as BaseGalaxy, FakeResponse
+
+
+class FakeGalaxy(BaseGalaxy):
+    """
+    Galaxy whose history datasets are given as a dictionary of id to (state, update time), filtered by update
+    time when requested.
+    """
+
+    def __init__(self, datasets):
+        self.invocations = self
+        self.histories = self
+        self.datasets = datasets
+        self.requests = []
+        self.histories_shown = 0
+
+    def get_invocation_step_jobs_summary(self, invocation_id):
+        return [{'id': 's1', 'states': {'ok': 1}}, {'id': 's2', 'states': {'ok': 1, 'running': 1}}]
+
+    def make_get_request(self, url, params):
+        self.requests.append(params)
+        filters = dict(zip(params['q'], params['qv']))
+        since = filters.get('update_time-ge', '')
+        return FakeResponse([{'id': dataset_id, 'state': state, 'update_time': update_time,
+                              'deleted': state == 'deleted'}
+                             for dataset_id, (state, update_time) in sorted(self.datasets.items())
+                             if update_time >= since])
+
+    def show_history(self, history_id):
+        self.histories_shown += 1
+        return {'id': history_id, 'state': 'ok', 'state_details': {'ok': 1}, 'state_ids': {'error': [], 'paused': []}}
+
+
+def test_polls_retrieve_only_updated_datasets():
+    gi = FakeGalaxy({'a': ('ok', '2024-05-01T10:00:00'), 'b': ('running', '2024-05-01T10:05:00'),
+                     'c': ('queued', '2024-05-01T10:05:00')})
+    progress = InvocationProgress(gi, invocation_id='inv', history_id='h')
+    history = progress.poll()
+    assert history['state_details']['running'] == 1 and history['state_details']['queued'] == 1
+    assert completion_state(gi, history, {'tools': {}, 'datasets': set()}) == (False, False)
+    assert progress.jobs == {'ok': 2, 'running': 1}
+
+    gi.datasets.update({'b': ('paused', '2024-05-01T10:10:00'), 'c': ('deleted', '2024-05-01T10:10:00')})
+    history = progress.poll()
+    # updates are retrieved again from a minute before the latest one seen
+    assert gi.requests[-1]['q'] == ['history_content_type', 'update_time-ge']
+    assert gi.requests[-1]['qv'][1] == '2024-05-01T10:04:00'
+    assert progress.retrieved == 3 + 2
+    assert history['state_ids']['paused'] == ['b']
+    assert history['state_details']['queued'] == 0
+    assert history['state_details']['ok'] == 1
+
+
+def test_falls_back_to_history_when_contents_cant_be_filtered():
+    gi = FakeGalaxy({})
+
+    def unsupported(url, params):
+        raise ConnectionError("Unexpected HTTP status code: 400", status_code=400)
+
+    gi.make_get_request = unsupported
+    progress = InvocationProgress(gi, invocation_id='inv', history_id='h')
+    assert progress.poll()['state_details'] == {'ok': 1}
+    assert progress.poll()['state_details'] == {'ok': 1}
+    assert not progress.incremental
+    assert gi.histories_shown == 2
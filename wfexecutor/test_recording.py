@@ -0,0 +1,61 @@
+import os
+import time
+
+from wfexecutor import (InvocationProgress, Metrics, ReplayGalaxyInstance, TrafficRecorder, completion_state,
+                        download_results, get_galaxy_instance, read_traffic, summarize_traffic)
+from wfexecutor.fakegalaxy import FakeGalaxyServer
+
+workflow_json = {'name': 'wf', 'steps': {
+    '0': {'label': 'matrix', 'type': 'data_input', 'tool_id': None},
+    '1': {'label': 'filter', 'type': 'tool', 'tool_id': 'filter_tool', 'tool_version': '1.0'},
+}}
+
+
+def run(gi, output_dir):
+    """
+    Invokes the workflow, polls it until completion and downloads the results, as run_galaxy_workflow does.
+    """
+    metrics = Metrics()
+    metrics.install(gi)
+    metrics.start_phase('invocation')
+    workflow = gi.workflows.import_workflow_dict(workflow_json)
+    invocation = gi.workflows.invoke_workflow(workflow_id=workflow['id'], history_name='results')
+    metrics.start_phase('execution')
+    progress = InvocationProgress(gi, invocation_id=invocation['id'], history_id=invocation['history_id'])
+    allowed_error_states = {'tools': {}, 'datasets': set()}
+    while not any(completion_state(gi, progress.poll(), allowed_error_states)):
+        time.sleep(0.05)
+    metrics.start_phase('download')
+    download_results(gi, invocation['history_id'], output_dir, allowed_error_states, use_names=True, workers=2)
+    metrics.end_phase()
+
+
+def test_recorded_run_replays_offline_within_budget(tmp_path):
+    recording = str(tmp_path / 'traffic.jsonl')
+    with FakeGalaxyServer(datasets=4, dataset_size=3000, scheduling_seconds=0, job_seconds=0.2) as server:
+        gi = get_galaxy_instance({'url': server.url, 'key': 'fake'})
+        recorder = TrafficRecorder()
+        recorder.install(gi)
+        (tmp_path / 'recorded').mkdir()
+        run(gi, str(tmp_path / 'recorded'))
+        recorder.save(recording)
+        assert len(recorder.entries) == server.request_count
+
+    recorded = summarize_traffic(read_traffic(recording))
+    # the first poll lists the whole history, steady state polls only what changed
+    assert recorded['first_poll'] == 2
+    assert recorded['steady_polls'] >= 1
+    assert recorded['steady_poll_max'] == 2
+    assert recorded['download'] == 1 + 2 * 4
+    assert recorded['by_endpoint']['GET /api/datasets/{id}/display'] == 4
+
+    gi = ReplayGalaxyInstance.load(recording)
+    recorder = TrafficRecorder()
+    recorder.install(gi)
+    (tmp_path / 'replayed').mkdir()
+    run(gi, str(tmp_path / 'replayed'))
+    replayed = summarize_traffic(recorder.entries)
+    assert replayed['total'] == recorded['total']
+    assert replayed['by_endpoint'] == recorded['by_endpoint']
+    assert sorted(os.listdir(str(tmp_path / 'replayed'))) == sorted(os.listdir(str(tmp_path / 'recorded')))
+    assert os.path.getsize(str(tmp_path / 'replayed' / 'output_0.txt')) == 3000
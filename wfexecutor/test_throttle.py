@@ -0,0 +1,75 @@
+from bioblend import ConnectionError
+
+from wfexecutor.throttle import DOWNLOAD, METADATA, UPLOAD, RateLimiter, TokenBucket, endpoint_class
+from wfexecutor.conftest import FakeGalaxy as BaseGalaxy, FakeResponse
+
+
+def test_token_bucket_spaces_requests(clock):
+    bucket = TokenBucket(rate=2, burst=2, clock=clock, sleep=clock.sleep)
+    for _ in range(6):
+        bucket.acquire()
+    # two requests are allowed straight away, the following ones at two per second
+    assert clock.now == 2.0
+
+
+def test_endpoint_classes():
+    assert endpoint_class('GET', 'http://g/api/histories/h1/contents?details=all') == METADATA
+    assert endpoint_class('GET', 'http://g/api/datasets/d1/display?to_ext=txt') == DOWNLOAD
+    assert endpoint_class('POST', 'http://g/api/tools/fetch') == UPLOAD
+    assert endpoint_class('POST', 'http://g/api/workflows/w1/invocations') == METADATA
+
+
+class FakeGalaxy(BaseGalaxy):
+
+    def __init__(self, get_responses, post_errors):
+        self.get_responses = get_responses
+        self.post_errors = post_errors
+        self.posts = 0
+
+    def make_get_request(self, url, **kwargs):
+        return self.get_responses.pop(0)
+
+    def make_post_request(self, url, payload=None, params=None, files_attached=False):
+        self.posts += 1
+        if self.post_errors:
+            raise self.post_errors.pop(0)
+        return {'id': 'x'}
+
+    def make_put_request(self, url, payload=None, params=None):
+        return {}
+
+    make_patch_request = make_put_request
+    make_delete_request = make_get_request
+
+
+def test_backoff_on_overload_and_safe_post_retries():
+    sleeps = []
+    limiter = RateLimiter(metadata_rate=0, upload_rate=0, max_retries=3, sleep=sleeps.append)
+    gi = limiter.install(FakeGalaxy([FakeResponse(status_code=429, headers={'Retry-After': '7'}),
+                                     FakeResponse(status_code=502), FakeResponse()],
+                                    [ConnectionError('busy', status_code=503), ConnectionError('bad', status_code=502)]))
+    assert gi.rate_limiter is limiter
+    assert gi.make_get_request('http://g/api/histories').status_code == 200
+    assert sleeps == [7.0, 4]
+    # a POST answered with 503 was not processed and is sent again, but a 502 might have been processed
+    try:
+        gi.make_post_request('http://g/api/workflows/w1/invocations', payload={})
+        assert False, "A POST answered with 502 should not be retried"
+    except ConnectionError as e:
+        assert e.status_code == 502
+    assert gi.posts == 2
+    assert limiter.retries == 3
+
+
+def test_streamed_body_holds_the_in_flight_slot():
+    limiter = RateLimiter(metadata_rate=0, upload_rate=0, download_rate=0, max_in_flight=1, sleep=lambda s: None)
+    responses = [FakeResponse(status_code=502), FakeResponse()]
+
+    def consume(response):
+        # the slot is only released once the body has been read
+        assert not limiter.in_flight.acquire(blocking=False)
+        return response.status_code
+
+    assert limiter.request(DOWNLOAD, lambda: responses.pop(0), consume=consume) == 200
+    assert limiter.retries == 1
+    assert limiter.in_flight.acquire(blocking=False)
@@ -0,0 +1,80 @@
+import tusclient.client
+import tusclient.exceptions
+
+from wfexecutor import RateLimiter, resumable_upload
+from wfexecutor.conftest import FakeGalaxy as BaseGalaxy
+
+content = b'0123456789' * 100
+
+
+class FakeUploader(object):
+    """
+    tus uploader whose server answers 503 to the second chunk, after storing half of it.
+    """
+
+    def __init__(self, server, chunk_size):
+        self.server = server
+        self.chunk_size = chunk_size
+        self.url = None
+        self.offset = None
+
+    def create_url(self):
+        self.server.requests.append('POST')
+        return 'http://galaxy.test/api/upload/resumable_upload/abc'
+
+    def set_url(self, url):
+        self.url = url
+
+    def get_file_size(self):
+        return len(content)
+
+    def get_offset(self):
+        self.server.requests.append('HEAD')
+        return self.server.offset
+
+    def upload_chunk(self):
+        self.server.requests.append('PATCH {}'.format(self.offset))
+        assert self.offset == self.server.offset
+        end = min(len(content), self.offset + self.chunk_size)
+        if self.offset == self.chunk_size and not self.server.failed:
+            self.server.failed = True
+            self.server.offset += (end - self.offset) // 2
+            raise tusclient.exceptions.TusUploadFailed("overloaded", 503, b'')
+        self.server.offset = self.offset = end
+
+
+class FakeTusServer(object):
+
+    def __init__(self):
+        self.requests = []
+        self.offset = 0
+        self.failed = False
+
+    def __call__(self, url, headers):
+        self.url = url
+        return self
+
+    def uploader(self, file_path, chunk_size, url=None):
+        return FakeUploader(self, chunk_size)
+
+
+class FakeGalaxy(BaseGalaxy):
+
+    def __init__(self):
+        self.tools = self
+
+    def post_to_fetch(self, path, history_id, session_id, **kwargs):
+        return {'outputs': [{'id': session_id}]}
+
+
+def test_chunk_retried_from_server_offset(monkeypatch):
+    server = FakeTusServer()
+    monkeypatch.setattr(tusclient.client, 'TusClient', server)
+    sleeps = []
+    gi = FakeGalaxy()
+    gi.rate_limiter = RateLimiter(upload_rate=0, sleep=sleeps.append)
+    result = resumable_upload(gi, 'input.txt', 'h1', chunk_size=400)
+    assert result == {'outputs': [{'id': 'abc'}]}
+    # the overloaded server is given time, and the chunk is sent again from where the server stopped
+    assert sleeps == [2]
+    assert server.requests == ['POST', 'PATCH 0', 'PATCH 400', 'HEAD', 'PATCH 600']
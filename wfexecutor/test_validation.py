@@ -0,0 +1,41 @@
+import subprocess
+import sys
+
+import pytest
+
+from wfexecutor import validate_allowed_errors
+
+wf_json = {'steps': {
+    '0': {'label': 'input', 'type': 'data_input', 'tool_id': None},
+    '1': {'label': 'cut', 'type': 'tool', 'tool_id': 'Cut1'},
+    '2': {'label': None, 'type': 'tool', 'tool_id': 'Grep1'},
+}}
+
+
+def test_allowed_errors_for_tool_steps():
+    validate_allowed_errors({'cut': ['any']}, wf_json)
+    validate_allowed_errors({'cut': [1, 43]}, wf_json)
+
+
+@pytest.mark.parametrize('allowed_errors', [None, {'input': ['any']}, {'missing': ['any']}, {'cut': 'any'},
+                                            {'cut': ['some']}])
+def test_wrong_allowed_errors(allowed_errors):
+    with pytest.raises(ValueError):
+        validate_allowed_errors(allowed_errors, wf_json)
+
+
+def test_validation_does_not_import_galaxy_client():
+    code = ("import sys, wfexecutor; "
+            "from wfexecutor import Metrics, read_yaml_file, validate_input_labels, validate_labels; "
+            "print(','.join(m for m in ('bioblend', 'requests', 'asyncio') if m in sys.modules))")
+    assert subprocess.check_output([sys.executable, '-c', code], text=True).strip() == ''
+
+
+def test_star_import_exports_the_package_names():
+    namespace = {}
+    exec('from wfexecutor import *', namespace)
+    # names generate_params_from_workflow.py and other scripts rely on, including those loaded lazily
+    for name in ('logging', 'yaml', 'Mapping', 'get_instance', 'get_galaxy_instance', 'read_json_file',
+                 'get_workflow_from_file', 'get_workflow_id', 'completion_state', 'ExecutionState',
+                 'export_results_to_data_library', 'download_results'):
+        assert name in namespace
@@ -0,0 +1,77 @@
+from wfexecutor import ToolMetadataCache, produce_versions_file
+from wfexecutor.conftest import FakeGalaxy as BaseGalaxy, FakeResponse
+
+
+class FakeGalaxy(BaseGalaxy):
+    """
+    Galaxy with versions 1.0 and 2.0 of every tool, 2.0 being the default one.
+    """
+
+    def __init__(self):
+        self.tools = self
+        self.calls = []
+
+    @staticmethod
+    def _tool(tool_id, tool_version):
+        return {'id': tool_id, 'name': tool_id.upper(), 'version': tool_version, 'tool_shed_repository': None}
+
+    def show_tool(self, tool_id):
+        self.calls.append(tool_id)
+        return self._tool(tool_id, '2.0')
+
+    def make_get_request(self, url, params):
+        tool_id = url.rsplit('/', 1)[1]
+        self.calls.append(tool_id)
+        return FakeResponse(self._tool(tool_id, params['tool_version']))
+
+
+workflow = {'steps': {
+    '0': {'tool_id': None, 'label': 'input'},
+    '1': {'tool_id': 'cut', 'tool_version': '1.0', 'label': 'cut'},
+    '2': {'subworkflow': {'steps': {
+        '0': {'tool_id': 'sort', 'tool_version': '1.0', 'label': None},
+        '1': {'tool_id': 'cut', 'tool_version': '1.0', 'label': 'inner cut'},
+    }}},
+    '3': {'tool_id': 'paste', 'tool_version': '1.0', 'label': 'paste'},
+}}
+
+
+def test_versions_file_with_cache(tmp_path):
+    table_path = str(tmp_path / 'versions.txt')
+    cache = ToolMetadataCache(str(tmp_path / 'tools.json'))
+    gi = FakeGalaxy()
+    produce_versions_file(gi, workflow, table_path, tool_cache=cache)
+    with open(table_path) as f:
+        lines = f.read().splitlines()
+    assert lines == ["Analysis\tSoftware\tVersion\tCitation",
+                     "paste\tPASTE\t1.0\t",
+                     "inner cut\tCUT\t1.0\t",
+                     "SORT\tSORT\t1.0\t"]
+    assert sorted(gi.calls) == ['cut', 'paste', 'sort']
+    # a second run, even from a new cache object, doesn't need to ask again and doesn't leak state
+    produce_versions_file(gi, workflow, table_path, tool_cache=ToolMetadataCache(str(tmp_path / 'tools.json')))
+    with open(table_path) as f:
+        assert f.read().splitlines() == lines
+    assert len(gi.calls) == 3
+    # expired entries are retrieved again
+    produce_versions_file(gi, workflow, table_path, tool_cache=ToolMetadataCache(str(tmp_path / 'tools.json'),
+                                                                                 ttl=0))
+    assert len(gi.calls) == 6
+
+
+def test_versions_file_reports_the_version_of_each_step(tmp_path):
+    table_path = str(tmp_path / 'versions.txt')
+    two_versions = {'steps': {
+        '0': {'tool_id': 'cut', 'tool_version': '1.0', 'label': 'old cut'},
+        '1': {'tool_id': 'cut', 'tool_version': '2.0', 'label': 'new cut'},
+    }}
+    gi = FakeGalaxy()
+    produce_versions_file(gi, two_versions, table_path, tool_cache=ToolMetadataCache(str(tmp_path / 'tools.json')))
+    with open(table_path) as f:
+        lines = f.read().splitlines()
+    assert lines[1:] == ["new cut\tCUT\t2.0\t", "old cut\tCUT\t1.0\t"]
+    # each version is cached on its own
+    produce_versions_file(gi, two_versions, table_path, tool_cache=ToolMetadataCache(str(tmp_path / 'tools.json')))
+    with open(table_path) as f:
+        assert f.read().splitlines() == lines
+    assert gi.calls == ['cut', 'cut']
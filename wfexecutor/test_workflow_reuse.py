@@ -0,0 +1,49 @@
+import json
+
+from wfexecutor import get_workflow_from_file, workflow_hash
+from wfexecutor.conftest import FakeGalaxy as BaseGalaxy
+
+
+class FakeWorkflows(object):
+
+    def __init__(self):
+        self.workflows = {}
+        self.imports = 0
+
+    def import_workflow_dict(self, wf_json):
+        self.imports += 1
+        wf = {'id': 'wf{}'.format(self.imports), 'name': wf_json['name'], 'tags': [], 'deleted': False}
+        self.workflows[wf['id']] = wf
+        return wf
+
+    def update_workflow(self, workflow_id, tags):
+        self.workflows[workflow_id]['tags'] = tags
+        return self.workflows[workflow_id]
+
+    def get_workflows(self, name=None):
+        return [wf for wf in self.workflows.values() if wf['name'] == name]
+
+    def show_workflow(self, workflow_id):
+        return self.workflows[workflow_id]
+
+
+class FakeGalaxy(BaseGalaxy):
+
+    def __init__(self):
+        self.workflows = FakeWorkflows()
+
+
+def test_hash_ignores_key_order():
+    assert workflow_hash({'a': 1, 'b': [1, 2]}) == workflow_hash({'b': [1, 2], 'a': 1})
+    assert workflow_hash({'a': 1}) != workflow_hash({'a': 2})
+
+
+def test_reuse_imported_workflow(tmp_path):
+    wf_path = tmp_path / 'wf.json'
+    wf_path.write_text(json.dumps({'name': 'test wf', 'steps': {}}))
+    gi = FakeGalaxy()
+    first = get_workflow_from_file(gi, str(wf_path), reuse=True)
+    second = get_workflow_from_file(gi, str(wf_path), reuse=True, index_path=str(tmp_path / 'index.json'))
+    third = get_workflow_from_file(gi, str(wf_path), reuse=True, index_path=str(tmp_path / 'index.json'))
+    assert first[0]['id'] == second[0]['id'] == third[0]['id']
+    assert gi.workflows.imports == 1
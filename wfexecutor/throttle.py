@@ -0,0 +1,208 @@
+import logging
+import threading
+import time
+
+import requests
+from bioblend import ConnectionError
+from urllib3.util.retry import Retry
+
+# Responses that mean the server is overloaded or restarting, so the same request can be tried again later.
+RETRY_STATUS_CODES = (429, 502, 503)
+# Of those, the ones that guarantee that the request was not processed, so that retrying a POST is safe.
+REJECTED_STATUS_CODES = (429, 503)
+
+METADATA = 'metadata'
+UPLOAD = 'upload'
+DOWNLOAD = 'download'
+
+
+class TokenBucket(object):
+    """
+    Allows at most `rate` operations per second on average, with bursts of up to `burst` operations. A rate of
+    0 or None means no limit. Safe to share among threads.
+    """
+
+    def __init__(self, rate, burst=None, clock=time.monotonic, sleep=time.sleep):
+        self.rate = rate
+        self.burst = burst if burst is not None else max(1.0, rate or 1.0)
+        self.clock = clock
+        self.sleep = sleep
+        self.tokens = self.burst
+        self.updated = clock()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Takes a token, waiting until one is available.
+
+        :return: seconds waited.
+        """
+        if not self.rate:
+            return 0.0
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = self.clock()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                wait = (1 - self.tokens) / self.rate
+            self.sleep(wait)
+            waited += wait
+
+
+def endpoint_class(method, url):
+    """
+    Classifies a request to the Galaxy API by the kind of load it puts on the server.
+
+    :param method: HTTP method
+    :param url: request URL
+    :return: one of METADATA, UPLOAD or DOWNLOAD
+    """
+    path = url.split('?', 1)[0].rstrip('/')
+    if method == 'GET' and (path.endswith('/display') or path.endswith('/download') or '/download/' in path):
+        return DOWNLOAD
+    if method in ('POST', 'PATCH') and (path.endswith('/api/tools') or path.endswith('/api/tools/fetch')
+                                        or '/upload/' in path or
+                                        ('/api/libraries/' in path and path.endswith('/contents'))):
+        return UPLOAD
+    return METADATA
+
+
+class RateLimiter(object):
+    """
+    Keeps the requests that the executor makes to a Galaxy instance in check. Each class of endpoint (metadata
+    requests, uploads and downloads) has its own token bucket, and at most max_in_flight requests wait for a
+    response at any time, regardless of how many threads or runs issue them. Requests answered with HTTP 429,
+    502 or 503 and requests that fail to connect are tried again after an exponential backoff, honouring the
+    Retry-After header when the server sends one. POST requests are only tried again when the server
+    guarantees that it didn't process them (429 or 503), to avoid creating things twice.
+    """
+
+    def __init__(self, metadata_rate=10, upload_rate=2, download_rate=5, max_in_flight=8, max_retries=5,
+                 backoff=2, max_backoff=60, sleep=time.sleep):
+        self.buckets = {METADATA: TokenBucket(metadata_rate, sleep=sleep),
+                        UPLOAD: TokenBucket(upload_rate, sleep=sleep),
+                        DOWNLOAD: TokenBucket(download_rate, sleep=sleep)}
+        self.in_flight = threading.BoundedSemaphore(max(1, max_in_flight))
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.sleep = sleep
+        self.lock = threading.Lock()
+        self.retries = 0
+        self.throttled = 0.0
+
+    def _delay(self, attempt, response):
+        headers = getattr(response, 'headers', None)
+        retry_after = headers.get('Retry-After') if headers else None
+        if retry_after is not None:
+            try:
+                return min(self.max_backoff, float(retry_after))
+            except ValueError:
+                pass
+        return min(self.max_backoff, self.backoff ** attempt)
+
+    def request(self, kind, send, idempotent=True, description='', consume=None):
+        """
+        Sends a request within the limits, trying it again when the server is overloaded or can't be reached.
+
+        :param kind: endpoint class, one of METADATA, UPLOAD or DOWNLOAD
+        :param send: callable making the request, returning a response or raising a connection error.
+        :param idempotent: whether the request can be repeated after an ambiguous failure, false for POSTs.
+        :param description: text identifying the request in log messages
+        :param consume: optional callable receiving the final response, like one reading a streamed body. The
+         request counts as in flight until it returns.
+        :return: whatever send returns on the last attempt, or consume returns for it.
+        """
+        bucket = self.buckets[kind]
+        for attempt in range(self.max_retries + 1):
+            waited = bucket.acquire()
+            error = None
+            response = None
+            with self.in_flight:
+                try:
+                    response = send()
+                    status = getattr(response, 'status_code', None)
+                except ConnectionError as e:
+                    error = e
+                    status = e.status_code
+                except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                    error = e
+                    status = None
+                with self.lock:
+                    self.throttled += waited
+                if status is None and error is not None:
+                    retry = idempotent
+                    reason = "connection failed ({})".format(error)
+                else:
+                    retry = status in (RETRY_STATUS_CODES if idempotent else REJECTED_STATUS_CODES)
+                    reason = "server answered {}".format(status)
+                if not retry or attempt == self.max_retries:
+                    if error is not None:
+                        raise error
+                    return response if consume is None else consume(response)
+            delay = self._delay(attempt + 1, response)
+            logging.warning("Request {} {}, reconnecting in {:.1f} s (attempt {} of {})"
+                            .format(description, reason, delay, attempt + 1, self.max_retries))
+            with self.lock:
+                self.retries += 1
+            self.sleep(delay)
+
+    def install(self, gi):
+        """
+        Routes all the requests that bioblend makes through the given galaxy instance object through this
+        rate limiter, and makes it available to other requests to the same instance as gi.rate_limiter. The
+        retries of its pooled session, if any, are turned off, as the rate limiter retries the same requests
+        and each of its attempts would otherwise be retried too.
+
+        :param gi: galaxy instance object
+        :return: the same galaxy instance object
+        """
+        for adapter in getattr(getattr(gi, 'session', None), 'adapters', {}).values():
+            adapter.max_retries = Retry(0, read=False)
+        for method in ('get', 'post', 'put', 'patch', 'delete'):
+            make_request = getattr(gi, 'make_{}_request'.format(method))
+            setattr(gi, 'make_{}_request'.format(method), self._wrap(method.upper(), make_request))
+        gi.rate_limiter = self
+        return gi
+
+    def _wrap(self, method, make_request):
+        def limited_request(url, *args, **kwargs):
+            return self.request(endpoint_class(method, url), lambda: make_request(url, *args, **kwargs),
+                                idempotent=method != 'POST', description="{} {}".format(method, url))
+        return limited_request
+
+    def log_stats(self):
+        logging.info("Rate limiter waited {:.1f} s for request budget and retried {} requests."
+                     .format(self.throttled, self.retries))
+
+
+def limited(gi, kind, send, idempotent=True, description='', consume=None):
+    """
+    Sends a request that doesn't go through bioblend, like a streamed download, within the limits of the rate
+    limiter installed on the galaxy instance object, if any. When metrics or a traffic recorder are installed on
+    it too, each attempt is recorded under the method and URL given in the description. A streamed body should
+    be read by consume, so that the transfer counts as in flight until it is done, see RateLimiter.request.
+    """
+    recorder = getattr(gi, 'recorder', None)
+    if recorder is not None and description:
+        send = _recorded(recorder, gi, description, send)
+    metrics = getattr(gi, 'metrics', None)
+    if metrics is not None and description:
+        send = _timed(metrics, description, send)
+    limiter = getattr(gi, 'rate_limiter', None)
+    if limiter is None:
+        return send() if consume is None else consume(send())
+    return limiter.request(kind, send, idempotent=idempotent, description=description, consume=consume)
+
+
+def _timed(metrics, description, send):
+    return lambda: metrics.timed(description, send)
+
+
+def _recorded(recorder, gi, description, send):
+    method, url = description.split(' ', 1)
+    return lambda: recorder.record(gi, method, url, send, stream=method == 'GET')
@@ -0,0 +1,137 @@
+import logging
+import os
+import re
+
+import tusclient.client
+import tusclient.exceptions
+from bioblend import ConnectionError
+
+from .metrics import record_bytes
+from .throttle import UPLOAD, limited
+
+UPLOAD_CHUNK_SIZE = 10 ** 7
+# Files smaller than a chunk take a single request either way, so they are uploaded in one go, without tracking
+# their progress.
+RESUMABLE_UPLOAD_MIN_SIZE = UPLOAD_CHUNK_SIZE
+RESUMABLE_UPLOADS_VERSION = (22, 1)
+
+
+def supports_resumable_uploads(gi):
+    """
+    Checks whether the Galaxy instance accepts uploads through the tus protocol, available since 22.01.
+
+    :param gi: galaxy instance object
+    :return: boolean
+    """
+    version = tuple(int(part) for part in re.findall(r'\d+', gi.config.get_version()['version_major'])[:2])
+    return version >= RESUMABLE_UPLOADS_VERSION
+
+
+def _tus_request(send):
+    """
+    Wraps a tus request so that its failures are raised as bioblend's, with the HTTP status if any, for the rate
+    limiter to try it again when the server is overloaded or can't be reached.
+    """
+    def tus_request():
+        try:
+            return send()
+        except tusclient.exceptions.TusCommunicationError as e:
+            raise ConnectionError(str(e), body=e.response_content, status_code=e.status_code)
+    return tus_request
+
+
+def _chunk_sender(uploader):
+    """
+    :return: callable sending the next chunk of the upload. When called again after a failure, it first takes the
+     offset from the server, which might have stored part of the chunk.
+    """
+    attempts = []
+
+    def send_chunk():
+        if attempts:
+            uploader.offset = uploader.get_offset()
+        attempts.append(uploader.offset)
+        uploader.upload_chunk()
+    return _tus_request(send_chunk)
+
+
+def resumable_upload(gi, path, history_id, progress=None, on_progress=None, chunk_size=UPLOAD_CHUNK_SIZE, **kwargs):
+    """
+    Uploads a file in chunks through the tus endpoint of the Galaxy instance. If progress holds the upload URL
+    of a previous attempt that the server still knows about, the transfer continues from the offset that the
+    server reports instead of starting from the first byte.
+
+    :param gi: galaxy instance object
+    :param path: path of the local file to upload
+    :param history_id: history where the dataset should be created
+    :param progress: dictionary with url and offset of a previous attempt, if any.
+    :param on_progress: callable receiving the url and offset after each chunk, to persist them.
+    :param chunk_size: number of bytes sent per request
+    :param kwargs: additional arguments for the fetch request, like file_name and file_type.
+    :return: information about the upload job, as given by gi.tools.post_to_fetch
+    """
+    progress = progress or {}
+    client = tusclient.client.TusClient(gi.url + '/upload/resumable_upload', headers={'x-api-key': gi.key})
+    uploader = None
+    if progress.get('url'):
+        try:
+            uploader = client.uploader(file_path=path, url=progress['url'], chunk_size=chunk_size)
+            logging.info("Resuming upload of {} at byte {}".format(path, uploader.offset))
+        except tusclient.exceptions.TusCommunicationError:
+            logging.info("Upload of {} can't be resumed, starting again".format(path))
+    if uploader is None:
+        uploader = client.uploader(file_path=path, chunk_size=chunk_size)
+        uploader.set_url(limited(gi, UPLOAD, _tus_request(uploader.create_url), idempotent=False,
+                                 description="POST {}".format(client.url)))
+        uploader.offset = 0
+    file_size = uploader.get_file_size()
+    start_offset = uploader.offset
+    if on_progress is not None:
+        on_progress(url=uploader.url, offset=uploader.offset, size=file_size)
+    while uploader.offset < file_size:
+        limited(gi, UPLOAD, _chunk_sender(uploader), description="PATCH {}".format(uploader.url))
+        if on_progress is not None:
+            on_progress(url=uploader.url, offset=uploader.offset, size=file_size)
+    record_bytes(gi, 'upload', file_size - start_offset)
+    session_id = uploader.url.rsplit('/', 1)[1]
+    return gi.tools.post_to_fetch(path, history_id, session_id, **kwargs)
+
+
+def upload_path_input(gi, label, input_data, history, upload_cache=None, state=None, resumable=False):
+    """
+    Uploads a single input given by path in the inputs YAML and returns the resulting dataset id. Progress is
+    recorded in the execution state if given, so that a restarted run skips finished uploads and continues
+    interrupted ones. Only files of at least RESUMABLE_UPLOAD_MIN_SIZE bytes are uploaded in chunks.
+
+    :param gi: galaxy instance object
+    :param label: input label, used as dataset name
+    :param input_data: input entry from the inputs YAML, with path and type
+    :param history: the history object to where the file should be uploaded
+    :param upload_cache: optional UploadCache
+    :param state: optional ExecutionState
+    :param resumable: whether to use chunked, resumable uploads for large files
+    :return: dataset id
+    """
+    if upload_cache is not None:
+        return upload_cache.upload(gi, path=input_data['path'], file_name=label, file_type=input_data['type'])
+
+    progress = state.upload_progress(label) if state is not None else {}
+    if progress.get('dataset_id'):
+        logging.info("Input {} was already uploaded as dataset {}".format(label, progress['dataset_id']))
+        return progress['dataset_id']
+
+    def record(**values):
+        if state is not None:
+            state.update_upload(label, **values)
+
+    if resumable and os.path.getsize(input_data['path']) >= RESUMABLE_UPLOAD_MIN_SIZE:
+        upload_res = resumable_upload(gi, input_data['path'], history['id'], progress=progress, on_progress=record,
+                                      file_name=label, file_type=input_data['type'])
+    else:
+        upload_res = gi.tools.upload_file(path=input_data['path'], history_id=history['id'],
+                                          file_name=label,
+                                          file_type=input_data['type'])
+        record_bytes(gi, 'upload', os.path.getsize(input_data['path']))
+    dataset_id = upload_res['outputs'][0]['id']
+    record(dataset_id=dataset_id)
+    return dataset_id